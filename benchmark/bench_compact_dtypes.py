@@ -0,0 +1,57 @@
+"""
+Report the memory saved by the compact mode ('compact': true) of AIRModel, GEOModel and the DCRNN windows
+
+Usage:
+    python -m benchmark.bench_compact_dtypes --stations 300 --hours 5088
+"""
+import argparse
+
+import numpy as np
+
+from benchmark.synthetic import InMemoryConnection, synthetic_tables
+from data_model.air_model import AIRModel
+from data_model.geo_model import GEOModel
+from preprocess.generate_data_for_DCRNN import _prepare_npdata, generate_x_y_series_data
+
+
+def memory_report(conn, compact, x_window=24, y_window=6):
+    config = {'air_quality': {'table_name': 'air_quality', 'column_set': ['station_id', 'date_observed', 'value'],
+                              'request_condition': '', 'compact': compact},
+              'geo_feature': {'table_name_pr': 'geo_features', 'additional_features': {}, 'compact': compact,
+                              'column_set': ['gid', 'geo_feature', 'feature_type', 'buffer_size', 'value']}}
+    air_quality_model = AIRModel(config, conn)
+    report = {'air_quality_df': air_quality_model.air_quality_df.memory_usage(deep=True).sum()}
+
+    time_series = air_quality_model.build_time_series()
+    report['time_series'] = time_series.memory_usage(deep=True).sum()
+
+    df = time_series.reset_index()
+    npdata = _prepare_npdata(df, 'index', np.float32 if compact else None)
+    xs, ys = generate_x_y_series_data(npdata, x_window, y_window)
+    report['window_tensors'] = xs.size * xs.itemsize + ys.size * ys.itemsize
+
+    geo_feature_model = GEOModel(air_quality_model.get_locations(), ['roads'], config, conn)
+    report['geo_feature_vector'] = geo_feature_model.geo_feature_vector.memory_usage(deep=True).sum()
+    matrix = geo_feature_model.geo_feature_matrix
+    report['geo_feature_matrix'] = matrix.data.nbytes + matrix.indices.nbytes + matrix.indptr.nbytes
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--stations', type=int, default=300)
+    parser.add_argument('--hours', type=int, default=24 * 212)
+    args = parser.parse_args()
+
+    conn = InMemoryConnection(synthetic_tables(args.stations, args.hours))
+    default = memory_report(conn, compact=False)
+    compact = memory_report(conn, compact=True)
+
+    print('{:<20} {:>12} {:>12} {:>8}'.format('', 'default MB', 'compact MB', 'saved'))
+    for name in default:
+        print('{:<20} {:>12.1f} {:>12.1f} {:>7.0f}%'.format(name, default[name] / 2 ** 20, compact[name] / 2 ** 20,
+                                                             100 * (1 - compact[name] / default[name])))
+
+
+if __name__ == '__main__':
+    main()
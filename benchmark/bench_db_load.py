@@ -0,0 +1,70 @@
+"""
+Compare the fetchall path of Connection.read with the COPY path of Connection.copy_as_dataframe
+
+Usage:
+    python -m benchmark.bench_db_load --host jonsnow.usc.edu --database air_quality_dev \
+        --table air_quality_data.utah_purple_air_ground_level_hourly \
+        --condition "where date_observed >= '2017-11-01' and date_observed < '2018-06-01'"
+"""
+import argparse
+import time
+
+import pandas as pd
+
+from services.postgres_connection import Connection
+
+
+def fetchall_load(conn, table_name, column_set, request_condition, columns):
+    data = conn.read(table_name, column_set, request_condition)
+    return pd.DataFrame(data, columns=columns)
+
+
+def copy_load(conn, table_name, column_set, request_condition, columns):
+    return conn.copy_as_dataframe(table_name, column_set, request_condition, columns=columns,
+                                  dtype={'value': 'float64'}, parse_dates=['date_observed'])
+
+
+def compare_load_methods(conn, table_name, column_set, request_condition='', columns=None, repeat=3):
+    """
+    Time both load paths on the same query, keeping the best of `repeat` runs
+
+    :return: {method: {'seconds': best wall time, 'rows': number of rows}}
+    """
+    columns = columns or ['station_id', 'date_observed', 'value']
+    result = {}
+    for method, load in [('fetchall', fetchall_load), ('copy', copy_load)]:
+        best = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            df = load(conn, table_name, column_set, request_condition, columns)
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        result[method] = {'seconds': best, 'rows': len(df)}
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', default='5432')
+    parser.add_argument('--user', default='')
+    parser.add_argument('--password', default='')
+    parser.add_argument('--database', default='air_quality_dev')
+    parser.add_argument('--table', required=True)
+    parser.add_argument('--columns', default='station_id,date_observed::TIMESTAMP WITHOUT TIME ZONE,value')
+    parser.add_argument('--condition', default='')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    conn = Connection(host=args.host, port=args.port, user=args.user, password=args.password,
+                      database=args.database)
+    result = compare_load_methods(conn, args.table, args.columns.split(','), args.condition, repeat=args.repeat)
+    conn.close_conn()
+
+    for method, stats in result.items():
+        print('{:<10} {:>10} rows {:>10.3f} s'.format(method, stats['rows'], stats['seconds']))
+    print('speedup: {:.2f}x'.format(result['fetchall']['seconds'] / result['copy']['seconds']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+"""
+Compare the whole-frame time_series_smoothing with the previous per-column loop
+
+Usage:
+    python -m benchmark.bench_smoothing --stations 300 --hours 5088
+"""
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+
+from services.timeseries_preprocess import time_series_smoothing
+
+
+def per_column_smoothing(time_series, window_size=24, method='mean'):
+    """
+    The previous implementation, one rolling call and one column insert per station
+    """
+    times = pd.date_range(start=min(time_series.index), end=max(time_series.index), freq='1H')
+    time_series_smooth = pd.DataFrame(index=times)
+    for key in time_series.columns:
+        rolling = time_series[key].rolling(window=window_size, min_periods=1, center=True)
+        time_series_smooth[key] = rolling.mean() if method == 'mean' else rolling.median()
+    return time_series_smooth
+
+
+def synthetic_time_series(num_stations, num_hours, missing_rate=0.1, seed=0):
+    rng = np.random.RandomState(seed)
+    values = rng.gamma(2.0, 5.0, size=(num_hours, num_stations))
+    values[rng.rand(num_hours, num_stations) < missing_rate] = np.nan
+    return pd.DataFrame(values, index=pd.date_range('2017-11-01', periods=num_hours, freq='1H'))
+
+
+def best_time(func, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--stations', type=int, default=300)
+    parser.add_argument('--hours', type=int, default=24 * 212)
+    parser.add_argument('--window', type=int, default=24)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    time_series = synthetic_time_series(args.stations, args.hours)
+    for method in ['mean', 'median']:
+        loop = best_time(lambda: per_column_smoothing(time_series, args.window, method), args.repeat)
+        frame = best_time(lambda: time_series_smoothing(time_series, args.window, method), args.repeat)
+        print('{:<8} per-column {:>8.3f} s  whole-frame {:>8.3f} s  speedup {:>6.2f}x'
+              .format(method, loop, frame, loop / frame))
+    for method in ['ewma', 'hampel']:
+        frame = best_time(lambda: time_series_smoothing(time_series, args.window, method), args.repeat)
+        print('{:<8} whole-frame {:>8.3f} s'.format(method, frame))
+
+
+if __name__ == '__main__':
+    main()
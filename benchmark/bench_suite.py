@@ -0,0 +1,166 @@
+"""
+Offline benchmark of the preprocessing stages on synthetic data, no database or network needed
+
+Every stage is timed (best of --repeat runs) and its peak Python heap (tracemalloc, which also tracks the numpy
+buffers) is measured in a separate run. The report is printed and can be saved as JSON, and compared with a
+previously saved report to spot performance regressions.
+
+Usage:
+    python -m benchmark.bench_suite --scales small,medium --output bench.json
+    python -m benchmark.bench_suite --scales small,medium --baseline bench.json
+"""
+import argparse
+import json
+import platform
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+from benchmark.synthetic import InMemoryConnection, synthetic_tables
+from data_model.air_model import AIRModel
+from data_model.geo_model import GEOModel
+from preprocess.generate_data_for_DCRNN import _prepare_npdata, _split_windows
+from services.instrumentation import stage_report
+from services.timeseries_preprocess import time_series_smoothing
+
+# NOTE: (number of stations, number of hours)
+SCALES = {'small': (50, 24 * 30),
+          'medium': (200, 24 * 90),
+          'large': (500, 24 * 212)}
+
+GEO_FEATURES = ('roads', 'landuse', 'water')
+
+
+def _config():
+    return {'air_quality': {'table_name': 'air_quality', 'column_set': ['station_id', 'date_observed', 'value'],
+                            'request_condition': ''},
+            'geo_feature': {'table_name_pr': 'geo_features', 'additional_features': {},
+                            'column_set': ['gid', 'geo_feature', 'feature_type', 'buffer_size', 'value']}}
+
+
+def _build_time_series(air_quality_model, cleaned_df):
+    air_quality_model.air_quality_df = cleaned_df
+    return air_quality_model.build_time_series()
+
+
+def pipeline_stages(conn, config, x_window=24, y_window=6):
+    """
+    Prepare the input of every stage once, so that a stage only measures its own work
+
+    :return: [(stage name, function)] in pipeline order
+    """
+    air_quality_model = AIRModel(config, conn)
+    cleaned_df = air_quality_model.air_quality_df
+    time_series = _build_time_series(air_quality_model, cleaned_df)
+    locations = air_quality_model.get_locations()
+    npdata = _prepare_npdata(time_series.reset_index(), 'index')
+
+    return [('load', lambda: AIRModel(config, conn)),
+            ('duplicate_statistics', lambda: air_quality_model.get_duplicate_statistics()),
+            ('time_series_construction', lambda: _build_time_series(air_quality_model, cleaned_df)),
+            ('smoothing_mean', lambda: time_series_smoothing(time_series, 24, 'mean')),
+            ('smoothing_median', lambda: time_series_smoothing(time_series, 24, 'median')),
+            ('geo_feature_matrix', lambda: GEOModel(locations, list(GEO_FEATURES), config, conn)),
+            ('dcrnn_windows', lambda: _split_windows(npdata, x_window, y_window, '3week1week'))]
+
+
+def measure(func, repeat):
+    """
+    :return: (best wall time in seconds, peak traced memory in bytes)
+    """
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    # NOTE: measured as a stage of the process-wide report, whose nested stages reset the tracemalloc peak
+    report = stage_report()
+    with report.tracing(trace_memory=True):
+        with report.stage('benchmark') as record:
+            func()
+    report.reset()
+    return best, record['tracemalloc_peak_mb'] * 2 ** 20
+
+
+def run_suite(scales, repeat=3, duplicate_rate=0.5, missing_rate=0.1, seed=0):
+    """
+    :param scales: names of SCALES
+    :return: {'environment': {...}, 'results': {scale: {stage: {'seconds': ..., 'peak_mb': ...}}}}
+    """
+    report = {'environment': {'python': platform.python_version(), 'numpy': np.__version__,
+                              'pandas': pd.__version__, 'machine': platform.machine(),
+                              'repeat': repeat, 'seed': seed},
+              'results': {}}
+    for scale in scales:
+        num_stations, num_hours = SCALES[scale]
+        conn = InMemoryConnection(synthetic_tables(num_stations, num_hours, duplicate_rate=duplicate_rate,
+                                                   missing_rate=missing_rate, geo_features=GEO_FEATURES, seed=seed))
+        results = {}
+        for stage, func in pipeline_stages(conn, _config()):
+            seconds, peak = measure(func, repeat)
+            results[stage] = {'seconds': seconds, 'peak_mb': peak / 2 ** 20}
+        report['results'][scale] = results
+    return report
+
+
+def compare_reports(report, baseline, tolerance=1.2, min_seconds=0.01):
+    """
+    Ratio of each (scale, stage) to the baseline, a ratio above `tolerance` is a regression
+    Stages faster than `min_seconds` are too noisy for their time ratio to count
+
+    :return: [(scale, stage, time ratio, memory ratio, regressed)]
+    """
+    comparison = []
+    for scale, results in report['results'].items():
+        for stage, stats in results.items():
+            base = baseline['results'].get(scale, {}).get(stage)
+            if base is None:
+                continue
+            time_ratio = stats['seconds'] / base['seconds'] if base['seconds'] else float('inf')
+            memory_ratio = stats['peak_mb'] / base['peak_mb'] if base['peak_mb'] else float('inf')
+            slower = time_ratio > tolerance and stats['seconds'] >= min_seconds
+            comparison.append((scale, stage, time_ratio, memory_ratio, slower or memory_ratio > tolerance))
+    return comparison
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scales', default='small,medium', help='comma separated, of ' + ','.join(SCALES))
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--duplicate-rate', type=float, default=0.5)
+    parser.add_argument('--missing-rate', type=float, default=0.1)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='save the report as JSON')
+    parser.add_argument('--baseline', help='JSON report to compare with')
+    parser.add_argument('--tolerance', type=float, default=1.2, help='max time / memory ratio to the baseline')
+    args = parser.parse_args()
+
+    report = run_suite(args.scales.split(','), repeat=args.repeat, duplicate_rate=args.duplicate_rate,
+                       missing_rate=args.missing_rate, seed=args.seed)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    print('{:<8} {:<26} {:>10} {:>10}'.format('scale', 'stage', 'seconds', 'peak MB'))
+    for scale, results in report['results'].items():
+        for stage, stats in results.items():
+            print('{:<8} {:<26} {:>10.3f} {:>10.1f}'.format(scale, stage, stats['seconds'], stats['peak_mb']))
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        comparison = compare_reports(report, baseline, args.tolerance)
+        print('\n{:<8} {:<26} {:>10} {:>10}'.format('scale', 'stage', 'time x', 'memory x'))
+        for scale, stage, time_ratio, memory_ratio, regressed in comparison:
+            print('{:<8} {:<26} {:>10.2f} {:>10.2f}{}'.format(scale, stage, time_ratio, memory_ratio,
+                                                               '  REGRESSION' if regressed else ''))
+        if any(regressed for *_, regressed in comparison):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
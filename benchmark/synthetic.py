@@ -0,0 +1,194 @@
+"""
+Synthetic air quality and geo feature tables, and an in-memory stand-in for services.postgres_connection.Connection,
+so that the pipeline can be exercised without the database
+"""
+import operator
+import re
+
+import numpy as np
+import pandas as pd
+
+from services.postgres_connection import build_select
+
+
+def synthetic_air_quality_rows(num_stations, num_hours, duplicate_rate=0.5, missing_rate=0.1, start='2017-11-01',
+                               seed=0):
+    """
+    Hourly readings of `num_stations` stations
+
+    :param num_stations: number of stations
+    :param num_hours: time span in hours
+    :param duplicate_rate: fraction of the readings reported a second time, with a different value
+    :param missing_rate: fraction of the (station, hour) readings that are missing
+    :param start: first timestamp
+    :param seed: random seed
+    :return: a DataFrame columned ['station_id', 'date_observed', 'value']
+    """
+    rng = np.random.RandomState(seed)
+    stations = np.repeat(np.arange(num_stations), num_hours)
+    times = np.tile(pd.date_range(start, periods=num_hours, freq='1H').values, num_stations)
+    keep = rng.rand(len(stations)) >= missing_rate
+    stations, times = stations[keep], times[keep]
+    duplicated = rng.rand(len(stations)) < duplicate_rate
+    stations = np.concatenate([stations, stations[duplicated]])
+    times = np.concatenate([times, times[duplicated]])
+    return pd.DataFrame({'station_id': stations, 'date_observed': times,
+                         'value': rng.gamma(2.0, 5.0, size=len(stations))})
+
+
+def synthetic_geo_feature_rows(num_stations, geo_features=('roads',), num_types=40,
+                               buffer_sizes=(100, 500, 1000, 2000), density=0.3, seed=0):
+    """
+    Geo features around `num_stations` stations, only `density` of the (station, feature) cells are present
+
+    :return: a DataFrame columned ['gid', 'geo_feature', 'feature_type', 'buffer_size', 'value']
+    """
+    rng = np.random.RandomState(seed)
+    gid, geo_feature, feature_type, buffer_size = np.meshgrid(np.arange(num_stations), np.arange(len(geo_features)),
+                                                              np.arange(num_types), buffer_sizes, indexing='ij')
+    keep = rng.rand(gid.size) < density
+    return pd.DataFrame({'gid': gid.ravel()[keep],
+                         'geo_feature': np.asarray(geo_features, dtype=object)[geo_feature.ravel()[keep]],
+                         'feature_type': ['type_{}'.format(t) for t in feature_type.ravel()[keep]],
+                         'buffer_size': buffer_size.ravel()[keep], 'value': rng.rand(keep.sum()) * 1000})
+
+
+def synthetic_tables(num_stations, num_hours, duplicate_rate=0.5, missing_rate=0.1, geo_features=('roads',),
+                     air_quality_table='air_quality', geo_feature_table_pr='geo_features', seed=0):
+    """
+    :return: {table_name: DataFrame} for InMemoryConnection, geo feature tables are named table_pr + '_' + feature
+    """
+    tables = {air_quality_table: synthetic_air_quality_rows(num_stations, num_hours, duplicate_rate=duplicate_rate,
+                                                            missing_rate=missing_rate, seed=seed)}
+    geo_feature_df = synthetic_geo_feature_rows(num_stations, geo_features=geo_features, seed=seed)
+    for geo_feature, df in geo_feature_df.groupby('geo_feature'):
+        tables['{}_{}'.format(geo_feature_table_pr, geo_feature)] = df.reset_index(drop=True)
+    return tables
+
+
+def _source_column(column):
+    """
+    'station_id as gid' -> ('station_id', 'gid'), 'date_observed::TIMESTAMP WITHOUT TIME ZONE' -> ('date_observed', ..)
+    """
+    parts = re.split(r'\s+as\s+', column.strip(), flags=re.IGNORECASE)
+    source = parts[0].split('::')[0].strip()
+    name = parts[1].strip() if len(parts) > 1 else source
+    return source, name
+
+
+_COMPARISON = re.compile(r"^(?P<column>.+?)\s*(?P<operator>>=|<=|<>|!=|=|>|<)\s*(?P<value>%s|'[^']*'|-?[\d.]+)$")
+_OPERATORS = {'>=': operator.ge, '<=': operator.le, '<>': operator.ne, '!=': operator.ne, '=': operator.eq,
+              '>': operator.gt, '<': operator.lt}
+
+
+def _condition_mask(df, condition, params):
+    """
+    Evaluate a conjunction of simple comparisons ("column >= %s and column < '2018-02-01'"),
+    e.g. the request conditions of the configs and the since / until bounds of AIRModel
+
+    :param df: table
+    :param condition: where clause, the "where" keyword and the parentheses are optional
+    :param params: values of the %s placeholders, consumed in order
+    :return: boolean mask of the rows of df
+    """
+    condition = re.sub(r'^\s*where\s+', '', condition.strip(), flags=re.IGNORECASE)
+    mask = np.ones(len(df), dtype=bool)
+    for comparison in re.split(r'\s+and\s+', condition, flags=re.IGNORECASE):
+        match = _COMPARISON.match(comparison.strip().strip('()').strip())
+        if match is None:
+            raise ValueError('InMemoryConnection cannot evaluate the condition: {}'.format(comparison))
+        column = _source_column(match.group('column'))[0]
+        value = match.group('value')
+        if value == '%s':
+            value = params.pop(0)
+        elif value.startswith("'"):
+            value = value[1:-1]
+        else:
+            value = float(value)
+        if pd.api.types.is_datetime64_any_dtype(df[column]):
+            value = pd.Timestamp(value)
+        mask &= _OPERATORS[match.group('operator')](df[column], value).values
+    return mask
+
+
+class InMemoryConnection:
+
+    def __init__(self, tables, cache=None):
+        """
+        Serve DataFrames through the read interface of services.postgres_connection.Connection
+        Columns are selected by name (aliases and casts are honoured), `filters` are applied and so are
+        request_condition and `conditions` made of simple comparisons (see _condition_mask), `group_by` is not
+
+        :param tables: {table_name: DataFrame}
+        :param cache: optional services.query_cache.QueryCache, keyed by the SQL the Connection would send,
+                      `queries` only records the misses (the reads that would reach the database)
+        """
+        self.tables = tables
+        self.queries = []
+        self._cache = cache
+
+    def _select(self, table_name, column_set, request_condition='', filters=None, distinct=False, **select_args):
+        if self._cache is None:
+            return self._select_table(table_name, column_set, request_condition, filters, distinct, **select_args)
+        key = self._cache.key(table_name, *build_select(table_name, column_set, request_condition, filters=filters,
+                                                        distinct=distinct, **select_args))
+        df = self._cache.get(key)
+        if df is None:
+            df = self._select_table(table_name, column_set, request_condition, filters, distinct, **select_args)
+            self._cache.put(key, df)
+        return df
+
+    def _select_table(self, table_name, column_set, request_condition='', filters=None, distinct=False, params=None,
+                      conditions=None, group_by=None):
+        self.queries.append((table_name, list(column_set), filters))
+        if table_name not in self.tables:
+            raise ValueError('unknown table {}'.format(table_name))
+        df = self.tables[table_name]
+        params = list(params or [])
+        for condition in [request_condition] + list(conditions or []):
+            if condition.strip():
+                df = df[_condition_mask(df, condition, params)]
+        for column, value in (filters or {}).items():
+            if pd.api.types.is_list_like(value):
+                df = df[df[column].isin(list(value))]
+            else:
+                df = df[df[column] == value]
+
+        selected = [_source_column(column) for column in column_set]
+        missing = [source for source, _ in selected if source not in df.columns]
+        if missing:
+            raise ValueError('unknown columns {} in {}'.format(missing, table_name))
+        result = pd.DataFrame({name: df[source].values for source, name in selected})
+        if distinct:
+            result = result.drop_duplicates()
+        return result.reset_index(drop=True)
+
+    def read(self, table_name, column_set, request_condition='', **select_args):
+        return list(self._select(table_name, column_set, request_condition, **select_args).itertuples(index=False,
+                                                                                                       name=None))
+
+    def read_as_dataframe(self, table_name, column_set, request_condition='', **select_args):
+        return self._select(table_name, column_set, request_condition, **select_args)
+
+    def read_chunks(self, table_name, column_set, request_condition='', chunk_size=50000, columns=None,
+                    **select_args):
+        df = self._select(table_name, column_set, request_condition, **select_args)
+        if columns is not None:
+            df.columns = columns
+        for start in range(0, len(df), chunk_size):
+            yield df.iloc[start:start + chunk_size].reset_index(drop=True)
+
+    def copy_as_dataframe(self, table_name, column_set, request_condition='', columns=None, dtype=None,
+                          parse_dates=None, **select_args):
+        df = self._select(table_name, column_set, request_condition, **select_args)
+        if columns is not None:
+            df.columns = columns
+        if dtype:
+            df = df.astype(dtype)
+        return df
+
+    def get_conn(self):
+        return self
+
+    def close_conn(self):
+        pass
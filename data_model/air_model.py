@@ -1,5 +1,22 @@
+import json
+import os
+import re
+
+import numpy as np
 import pandas as pd
 
+from services.instrumentation import instrumented, stage
+from services.storage import save_time_series, load_time_series
+from services.utils import duplicate_sums, raw_duplicate_sums, duplicate_statistics_from_sums
+from services.timeseries_preprocess import time_series_pivot, time_series_tensor
+
+
+def _column_expression(column):
+    """
+    Strip the alias of a selected column, e.g. 'date_observed::TIMESTAMP as date_observed' -> 'date_observed::TIMESTAMP'
+    """
+    return re.split(r'\s+as\s+', column, flags=re.IGNORECASE)[0]
+
 
 class AIRModel:
 
@@ -10,9 +27,54 @@ class AIRModel:
         self._time_col = time_col
         self._value_col = value_col
 
-        self._raw_air_quality_df = self._get_air_quality(conn)
-        self.air_quality_df = self._df_simple_cleaning(self._raw_air_quality_df)
+        # NOTE: with 'aggregate', cleaning and averaging of the duplicates are done by the database
+        self.aggregated = self._config.get('aggregate', False)
+        # NOTE: with 'compact', station ids are categorical and values are float32
+        self.compact = self._config.get('compact', False)
+        # NOTE: with 'parameters', the rows of all these parameters ('parameter_column' of the table) are fetched
+        #       in one query, the first one is the target of time_series and of the duplicate statistics
+        self.parameters = self._config.get('parameters')
+        self._parameter_col = 'parameter' if self.parameters else None
+        self.removed_stations = set()
+        # NOTE: the latest date_observed included in time_series, see build_time_series and refresh
+        self.watermark = None
+
+        self._raw_air_quality_df = None
+        self.air_quality_df = None
+        # NOTE: without a connection, the data is fetched later, see fetch and fetch_async
+        if conn is not None:
+            self._load(self._get_air_quality(conn))
         self.time_series = None
+        self.tensor, self.tensor_index, self.tensor_stations = None, None, None
+
+    def _load(self, raw_air_quality_df):
+        self._raw_air_quality_df = raw_air_quality_df
+        with stage('air_quality.cleaning', rows_in=len(self._raw_air_quality_df)) as record:
+            self.air_quality_df = self._compact_keys(self._df_simple_cleaning(self._raw_air_quality_df))
+            record['rows_out'] = len(self.air_quality_df)
+
+    def fetch(self, conn, since=None, until=None):
+        """
+        Fetch the air quality data observed in [since, until), for a model created without connection
+
+        :param conn: database connection
+        :param since: first observation time, not bounded if None
+        :param until: end of the observation time (excluded), not bounded if None
+        :return: the model
+        """
+        self._load(self._get_air_quality(conn, since=since, until=until))
+        return self
+
+    async def fetch_async(self, conn):
+        """
+        Fetch the air quality data with a services.async_postgres_connection.AsyncConnection,
+        for a model created without connection
+
+        :param conn: asynchronous database connection
+        :return: the model
+        """
+        self._load(await self._get_air_quality_async(conn))
+        return self
 
     def _df_simple_cleaning(self, df):
         """
@@ -25,18 +87,168 @@ class AIRModel:
         """
         cleaned_df = df.drop_duplicates()
         cleaned_df = cleaned_df[cleaned_df[self._value_col] > 0.0]
+        if self.compact:
+            value_cols = [c for c in [self._value_col, self._value_col + '_min', self._value_col + '_max']
+                          if c in cleaned_df.columns]
+            cleaned_df = cleaned_df.astype({c: 'float32' for c in value_cols})
         return cleaned_df
 
-    def _get_air_quality(self, conn):
+    def _compact_keys(self, df):
+        """
+        Store the station ids as categorical codes in compact mode
+        Done once on the whole DataFrame, categoricals of separate chunks would not concatenate
+
+        :param df: cleaned air quality data
+        :return: the DataFrame with categorical station ids
+        """
+        if not self.compact:
+            return df
+        return df.assign(**{self._key_col: df[self._key_col].astype('category')})
 
+    def _aggregate_query(self, column_set):
+        """
+        Query averaging the duplicates of each (station, hour) in the database, after removing
+        the exact duplicates and the non-positive values (as _df_simple_cleaning does)
+
+        :param column_set: configured [station, time, value] columns
+        :return: (column_set, select_args) of the aggregation query
+        """
+        key_expression, time_expression, value_expression = [_column_expression(c) for c in column_set]
+        aggregate_column_set = ['{} as {}'.format(key_expression, self._key_col),
+                                'date_trunc(\'hour\', {}) as {}'.format(time_expression, self._time_col),
+                                'avg(distinct {}) as {}'.format(value_expression, self._value_col),
+                                'min({}) as {}_min'.format(value_expression, self._value_col),
+                                'max({}) as {}_max'.format(value_expression, self._value_col),
+                                'count(distinct {}) as {}_count'.format(value_expression, self._value_col)]
+        select_args = {'conditions': ['{} > 0'.format(value_expression)], 'group_by': [1, 2]}
+        return aggregate_column_set, select_args
+
+    def _air_quality_query(self, since=None, until=None):
+        """
+        :param since: only query the rows observed from `since` on
+        :param until: only query the rows observed before `until`
+        :return: (table_name, column_set, request_condition, columns, select_args) of the air quality query
+        """
         table_name = self._config['table_name']
         column_set = self._config['column_set']
         request_condition = self._config['request_condition']
 
-        air_quality_data = conn.read(table_name, column_set, request_condition)
-        air_quality_df = pd.DataFrame(air_quality_data, columns=['station_id', 'date_observed', 'value'])
+        columns = ['station_id', 'date_observed', 'value']
+        select_args = {}
+        # NOTE: only fetch the rows observed in [since, until)
+        time_conditions, params = [], []
+        for operator, bound in [('>=', since), ('<', until)]:
+            if bound is not None:
+                time_conditions.append('{} {} %s'.format(_column_expression(column_set[1]), operator))
+                params.append(pd.Timestamp(bound).to_pydatetime())
+        if time_conditions:
+            time_condition = ' and '.join(time_conditions)
+            if request_condition.strip():
+                request_condition = '{} and {}'.format(request_condition, time_condition)
+            else:
+                request_condition = 'where ' + time_condition
+            select_args['params'] = params
+        if self.aggregated:
+            column_set, aggregate_args = self._aggregate_query(column_set)
+            select_args.update(aggregate_args)
+            columns = columns + ['value_min', 'value_max', 'value_count']
+        if self.parameters:
+            parameter_column = self._config['parameter_column']
+            column_set = column_set + ['{} as {}'.format(parameter_column, self._parameter_col)]
+            columns = columns + [self._parameter_col]
+            select_args['filters'] = {parameter_column: list(self.parameters)}
+            if self.aggregated:
+                select_args['group_by'] = select_args['group_by'] + [len(column_set)]
+        return table_name, column_set, request_condition, columns, select_args
+
+    @instrumented('air_quality.fetch')
+    def _get_air_quality(self, conn, since=None, until=None):
+        table_name, column_set, request_condition, columns, select_args = self._air_quality_query(since, until)
+
+        # NOTE: Stream the table in chunks and clean each chunk before keeping it
+        chunk_size = self._config.get('chunk_size')
+        if chunk_size:
+            cleaned_chunks = [self._df_simple_cleaning(chunk) for chunk in
+                              conn.read_chunks(table_name, column_set, request_condition,
+                                               chunk_size=chunk_size, columns=columns, **select_args)]
+            if not cleaned_chunks:
+                return pd.DataFrame(columns=columns)
+            return pd.concat(cleaned_chunks, ignore_index=True)
+
+        # NOTE: Bulk export with COPY instead of fetching row tuples
+        if self._config.get('load_method') == 'copy':
+            return conn.copy_as_dataframe(table_name, column_set, request_condition, columns=columns,
+                                          dtype={'value': 'float64'}, parse_dates=['date_observed'], **select_args)
+
+        air_quality_data = conn.read(table_name, column_set, request_condition, **select_args)
+        air_quality_df = pd.DataFrame(air_quality_data, columns=columns)
         return air_quality_df
 
+    async def _get_air_quality_async(self, conn, since=None):
+        """
+        Same as _get_air_quality with an AsyncConnection, each chunk is cleaned as soon as it arrives
+        """
+        table_name, column_set, request_condition, columns, select_args = self._air_quality_query(since)
+
+        chunk_size = self._config.get('chunk_size')
+        if chunk_size:
+            cleaned_chunks = [self._df_simple_cleaning(chunk) async for chunk in
+                              conn.read_chunks(table_name, column_set, request_condition,
+                                               chunk_size=chunk_size, columns=columns, **select_args)]
+            if not cleaned_chunks:
+                return pd.DataFrame(columns=columns)
+            return pd.concat(cleaned_chunks, ignore_index=True)
+
+        if self._config.get('load_method') == 'copy':
+            return await conn.copy_as_dataframe(table_name, column_set, request_condition, columns=columns,
+                                                dtype={'value': 'float64'}, parse_dates=['date_observed'],
+                                                **select_args)
+
+        air_quality_data = await conn.read(table_name, column_set, request_condition, **select_args)
+        return pd.DataFrame(air_quality_data, columns=columns)
+
+    def _target_df(self):
+        """
+        :return: the rows of the target (first) parameter, all the rows without 'parameters'
+        """
+        if not self.parameters:
+            return self.air_quality_df
+        return self.air_quality_df[self.air_quality_df[self._parameter_col] == self.parameters[0]]
+
+    def get_duplicate_sums(self):
+        """
+        Additive sums of the duplicates of each station, see services.utils.duplicate_sums
+
+        :return: a DataFrame indexed by station
+        """
+        if self.aggregated:
+            return duplicate_sums(self._target_df(), self._key_col, min_col=self._value_col + '_min',
+                                  max_col=self._value_col + '_max', count_col=self._value_col + '_count')
+        return raw_duplicate_sums(self._target_df(), self._key_col, self._time_col, self._value_col)
+
+    @instrumented('air_quality.duplicate_statistics', rows_in=lambda self, *args, **kwargs: len(self.air_quality_df))
+    def get_duplicate_statistics(self):
+        """
+        Statistics of the duplicates of each station, see services.utils.duplicate_statistics
+
+        :return: a DataFrame indexed by station
+        """
+        return duplicate_statistics_from_sums(self.get_duplicate_sums())
+
+    @instrumented('air_quality.average_duplicates', rows_in=lambda self, *args, **kwargs: len(self.air_quality_df),
+                  rows_out=lambda result, self: len(self.air_quality_df))
+    def average_duplicates(self):
+        """
+        Take the mean of the duplicates of each (station, time, parameter), already done by the database if aggregated
+        """
+        if self.aggregated:
+            return
+        keys = [self._key_col, self._time_col] + ([self._parameter_col] if self.parameters else [])
+        self.air_quality_df = self.air_quality_df.groupby(keys, observed=True).mean()
+        self.air_quality_df.reset_index(inplace=True)
+
+    @instrumented('air_quality.remove_stations', rows_in=lambda self, *args, **kwargs: len(self.air_quality_df),
+                  rows_out=lambda result, self, *args: len(self.air_quality_df))
     def remove_stations(self, removers):
         """
         Remove the stations with given removers
@@ -44,6 +256,7 @@ class AIRModel:
         :param removers: A list of station ids
         :return:
         """
+        self.removed_stations.update(removers)
         self.air_quality_df = self.air_quality_df[~self.air_quality_df['station_id'].isin(removers)]
 
     def get_locations(self):
@@ -54,3 +267,105 @@ class AIRModel:
         """
         locations = self.air_quality_df[self._key_col].drop_duplicates()
         return list(locations)
+
+    @instrumented('air_quality.build_time_series', rows_in=lambda self, *args, **kwargs: len(self.air_quality_df))
+    def build_time_series(self):
+        """
+        Average the duplicates and construct the time series of the current air quality data,
+        the latest observation becomes the watermark of later refreshes
+
+        :return: the time series, indexed by hour, columned by locations
+        """
+        self.average_duplicates()
+        self.time_series = time_series_pivot(self._target_df(), self._key_col, self._time_col, self._value_col)
+        self.watermark = self.air_quality_df[self._time_col].max()
+        return self.time_series
+
+    @instrumented('air_quality.build_tensor', rows_in=lambda self, *args, **kwargs: len(self.air_quality_df),
+                  rows_out=lambda result, *args, **kwargs: len(result))
+    def build_tensor(self, dtype=np.float32):
+        """
+        Average the duplicates and construct the (time, station, parameter) tensor of all the fetched parameters,
+        see services.timeseries_preprocess.time_series_tensor, the parameter axis follows 'parameters'
+
+        :param dtype: dtype of the tensor
+        :return: the tensor, its axes are tensor_index, tensor_stations and parameters
+        """
+        self.average_duplicates()
+        self.tensor, self.tensor_index, self.tensor_stations, _ = \
+            time_series_tensor(self.air_quality_df, self._key_col, self._time_col, self._value_col,
+                               parameter_col=self._parameter_col, parameters=self.parameters, dtype=dtype)
+        return self.tensor
+
+    def save_state(self, state_dir):
+        """
+        Persist the time series together with its watermark
+
+        :param state_dir: directory of the state files
+        """
+        os.makedirs(state_dir, exist_ok=True)
+        save_time_series(self.time_series, os.path.join(state_dir, 'time_series.arrow'))
+        # NOTE: no watermark if the time series was not built by build_time_series (e.g. by a pipeline stage)
+        state = {'watermark': self.watermark.isoformat() if self.watermark is not None else None,
+                 'removed_stations': sorted(self.removed_stations)}
+        with open(os.path.join(state_dir, 'state.json'), 'w') as f:
+            json.dump(state, f, default=str)
+
+    @classmethod
+    def from_state(cls, config, state_dir, key_col='station_id', time_col='date_observed', value_col='value'):
+        """
+        Load a model saved by save_state, without fetching anything
+
+        :param config: same config as the saved model
+        :param state_dir: directory of the state files
+        :return: an AIRModel with the saved time series and watermark
+        """
+        model = cls(config, None, key_col=key_col, time_col=time_col, value_col=value_col)
+        # NOTE: loaded in memory, refresh writes into the time series
+        model.time_series = load_time_series(os.path.join(state_dir, 'time_series.arrow'), memory_map=False)
+        with open(os.path.join(state_dir, 'state.json')) as f:
+            state = json.load(f)
+        model.watermark = pd.Timestamp(state['watermark']) if state['watermark'] is not None else None
+        model.removed_stations = set(state['removed_stations'])
+        return model
+
+    @instrumented('air_quality.refresh', rows_in=lambda self, *args, **kwargs: len(self.time_series))
+    def refresh(self, conn, lookback_hours=None):
+        """
+        Fetch the rows newer than the watermark and extend the time series with them
+        The last lookback_hours hours before the watermark are fetched again and rebuilt, to pick up late data,
+        older hours are kept as they are. New stations are added as new columns
+        Without watermark, everything is fetched again and rebuilt
+
+        :param conn: database connection
+        :param lookback_hours: hours of late data, defaults to 'late_data_lookback' of the config (0)
+        :return: the extended time series
+        """
+        if lookback_hours is None:
+            lookback_hours = self._config.get('late_data_lookback', 0)
+        since = None
+        if self.watermark is not None:
+            since = self.watermark.floor('1H') - pd.Timedelta(hours=lookback_hours)
+
+        self.air_quality_df = self._compact_keys(self._df_simple_cleaning(self._get_air_quality(conn, since=since)))
+        self.air_quality_df = self.air_quality_df[~self.air_quality_df[self._key_col].isin(self.removed_stations)]
+        if self.air_quality_df.empty:
+            return self.time_series
+        self.average_duplicates()
+        increment = time_series_pivot(self._target_df(), self._key_col, self._time_col, self._value_col)
+
+        start_time = min(self.time_series.index[0], increment.index[0])
+        end_time = max(self.time_series.index[-1], increment.index[-1])
+        new_columns = [column for column in increment.columns if column not in self.time_series.columns]
+        if start_time < self.time_series.index[0] or end_time > self.time_series.index[-1] or new_columns:
+            index = pd.date_range(start=start_time, end=end_time, freq='1H')
+            self.time_series = self.time_series.reindex(index=index, columns=list(self.time_series.columns) +
+                                                        new_columns)
+
+        # NOTE: every hour from `since` on was fetched again, so it is fully replaced
+        rebuilt = self.time_series.index >= since if since is not None else slice(None)
+        self.time_series.loc[rebuilt] = increment.reindex(index=self.time_series.index[rebuilt],
+                                                          columns=self.time_series.columns).values
+        latest = self.air_quality_df[self._time_col].max()
+        self.watermark = max(self.watermark, latest) if self.watermark is not None else latest
+        return self.time_series
@@ -1,16 +1,22 @@
+import asyncio
+import warnings
+from concurrent.futures import ThreadPoolExecutor
+
+from services.instrumentation import instrumented
 from services.utils import *
 
 import pandas as pd
 import numpy as np
+from scipy import sparse
 
 
 class GEOModel:
 
-    def __init__(self, locations, feature_set, config, conn):
+    def __init__(self, locations, feature_set, config, conn, pool=None):
         self._config = config['geo_feature']
         self._geo_feature_set = feature_set
 
-        geo_feature_table_name_dic = self._get_geo_feature_table_name(self._config['table_name_pr'])
+        self._geo_feature_table_name_dic = self._get_geo_feature_table_name(self._config['table_name_pr'])
 
         self._column_set = self._config['column_set']
         self._gid_col = self._column_set[0]
@@ -18,12 +24,65 @@ class GEOModel:
         self._feature_type_col = self._column_set[2]
         self._buffer_size_col = self._column_set[3]
         self._value_col = self._column_set[4]
+        # NOTE: with 'compact', the feature vectors are float32
+        self._dtype = np.float32 if self._config.get('compact', False) else np.float64
+
+        self.locations = list(locations)
+        self._geo_feature_df = None
+        self.geo_feature_matrix, self.geo_feature_name = None, None
+        self.scaled_geo_feature_matrix, self._scaled_feature_offset = None, None
+        # NOTE: without a connection (or pool), the features are fetched later, see fetch_async
+        if conn is not None or pool is not None:
+            self._build(self._get_geo_feature(self.locations, self._geo_feature_table_name_dic, conn, pool))
+
+    def _build(self, geo_feature_df):
+        self._geo_feature_df = geo_feature_df
+        self.geo_feature_matrix, self.geo_feature_name = self._constructing_feature_vector(self.locations)
+        self.scaled_geo_feature_matrix, self._scaled_feature_offset = self._scaling_feature_vector()
+
+    async def fetch_async(self, conn):
+        """
+        Fetch the geographic features with a services.async_postgres_connection.AsyncConnection,
+        for a model created without connection, all tables are read concurrently
+
+        :param conn: asynchronous database connection
+        :return: the model
+        """
+        self._build(await self._get_geo_feature_async(self.locations, self._geo_feature_table_name_dic, conn))
+        return self
+
+    def select_locations(self, locations):
+        """
+        Rebuild the features for a subset of the fetched locations (e.g. once stations are removed),
+        without fetching them again
+
+        :param locations: selected locations, all of them among the fetched locations
+        :return: the model
+        """
+        self.locations = list(locations)
+        geo_feature_df = self._geo_feature_df
+        self._build(geo_feature_df[geo_feature_df[self._gid_col].isin(self.locations)])
+        return self
+
+    @property
+    def geo_feature_vector(self):
+        """
+        Dense view of geo_feature_matrix, built on request
 
-        self._geo_feature_df = self._get_geo_feature(locations, geo_feature_table_name_dic, conn)
+        :return: a DataFrame columned by locations, indexed by geographic feature types
+        """
+        return pd.DataFrame(self.geo_feature_matrix.toarray(), index=self.geo_feature_name, columns=self.locations)
+
+    @property
+    def scaled_geo_feature_vector(self):
+        """
+        Dense view of the scaled geographic features (zero mean, unit variance for each feature), built on request
 
-        self.geo_feature_vector = self._constructing_feature_vector(locations)
-        self.geo_feature_name = self._get_feature_name()
-        self.scaled_geo_feature_vector = self._scaling_feature_vector(locations)
+        :return: a DataFrame columned by locations, indexed by geographic feature types
+        """
+        scaled = self.scaled_geo_feature_matrix.toarray() - self._scaled_feature_offset[:, np.newaxis]
+        return pd.DataFrame(scaled.astype(self._dtype, copy=False), index=self.geo_feature_name,
+                            columns=self.locations)
 
     def _get_geo_feature_table_name(self, geo_feature_table_name_pr):
         geo_feature_table_name = {}
@@ -31,78 +90,121 @@ class GEOModel:
             geo_feature_table_name[geo_feature] = geo_feature_table_name_pr + '_' + geo_feature
         return geo_feature_table_name
 
-    def _get_feature_name(self):
+    @instrumented('geo_feature.scaling',
+                  rows_in=lambda self: self.geo_feature_matrix.nnz, rows_out=lambda result, self: result[0].nnz)
+    def _scaling_feature_vector(self):
         """
-        Get geographic feature types from the index of geo_feature_vector
+        Scale each geographic feature over the locations without densifying the sparse matrix
+        The stored matrix is only divided by the standard deviation, the mean (offset) is subtracted
+        when the dense view is requested, since it would turn every zero into a non-zero value
 
-        :return: A list of geographic feature type names
+        :return: (scaled sparse matrix, offset of each feature)
         """
-        geo_feature_name = self.geo_feature_vector.index
-        return list(geo_feature_name)
-
-    def _scaling_feature_vector(self, locations):
-        """
-        Get a scaled geographic feature vector, scaled by column
-
-        :param locations: selected location
-        :return: Scaled geographic feature vector
-        """
-        scaled_geo_feature_vector = standard_scaler(self.geo_feature_vector.T)
-        scaled_geo_feature_vector = pd.DataFrame(scaled_geo_feature_vector.T,
-                                                 index=self.geo_feature_name, columns=locations)
-        return scaled_geo_feature_vector
+        scaled_transposed, offset = sparse_standard_scaler(self.geo_feature_matrix.T.tocsr())
+        return scaled_transposed.T.tocsr().astype(self._dtype), offset
 
+    @instrumented('geo_feature.construction',
+                  rows_in=lambda self, *args: len(self._geo_feature_df), rows_out=lambda result, *args: result[0].nnz)
     def _constructing_feature_vector(self, locations):
         """
-        Construct the feature vector, indexed by distinct geo features, columned by locations
+        Construct the sparse feature matrix, rows are distinct geo features (sorted by name), columns are locations
+        Features and locations are factorized into codes and all values are scattered in one pass,
+        locations without geographic features around them are all zeros
 
         :param locations: selected location
-        :return: a DataFrame columned (available) station name, indexed by geographic feature types
+        :return: (scipy.sparse.csr_matrix shaped (features, locations), list of feature names)
         """
+        df = self._geo_feature_df
+        # NOTE: pd.factorize codes a missing value as -1, which would mix up the feature codes
+        named = (df[self._geo_feature_col].notna() & df[self._feature_type_col].notna()
+                 & df[self._buffer_size_col].notna()).values
+        if not named.all():
+            df = df[named]
+        geo_codes, geo_uniques = pd.factorize(df[self._geo_feature_col])
+        type_codes, type_uniques = pd.factorize(df[self._feature_type_col])
+        buffer_codes, buffer_uniques = pd.factorize(df[self._buffer_size_col])
 
-        df_grouped = self._geo_feature_df.groupby(self._gid_col)
+        # NOTE: the feature name is only built once per distinct (geo_feature, feature_type, buffer_size)
+        combined_codes = (geo_codes.astype(np.int64) * len(type_uniques) + type_codes) * len(buffer_uniques) \
+            + buffer_codes
+        feature_codes, combined_uniques = pd.factorize(combined_codes)
+        geo_index, rest = np.divmod(combined_uniques, len(type_uniques) * len(buffer_uniques))
+        type_index, buffer_index = np.divmod(rest, len(buffer_uniques))
+        feature_name = ['{}_{}_{}'.format(geo_uniques[g], type_uniques[t], buffer_uniques[b])
+                        for g, t, b in zip(geo_index, type_index, buffer_index)]
 
-        self._geo_feature_df['feature_name'] = self._geo_feature_df[self._geo_feature_col] + '_' \
-                                               + self._geo_feature_df[self._feature_type_col] + '_' \
-                                               + self._geo_feature_df[self._buffer_size_col].map(str)
-        feature_vector_list = []
+        order = np.argsort(feature_name, kind='stable')
+        rank = np.empty_like(order)
+        rank[order] = np.arange(len(order))
+        feature_codes = rank[feature_codes]
+        feature_name = [feature_name[i] for i in order]
 
-        for each_group in df_grouped.groups:
-            group = df_grouped.get_group(each_group)
-            series = pd.Series(data=group[self._value_col].values, index=group['feature_name'], name=each_group)
-            feature_vector_list.append(series)
+        location_codes = pd.Index(locations).get_indexer(df[self._gid_col])
+        values = np.asarray(df[self._value_col].values, dtype=np.float64)
+        # NOTE: missing values are 0.0, as well as rows of unknown locations
+        keep = (location_codes >= 0) & ~np.isnan(values)
 
-        feature_vector = pd.concat(feature_vector_list, axis=1)
+        feature_codes, location_codes, values = feature_codes[keep], location_codes[keep], values[keep]
 
-        # NOTE: In case there is no geographic features around certain locations, set value = 0.0
-        for each_loc in locations:
-            if each_loc not in feature_vector.columns:
-                feature_vector[each_loc] = np.nan
+        # NOTE: coo_matrix would sum duplicated (feature, location) values, e.g. two distinct coordinates of a
+        #       station in the additional features, only the first one is kept
+        _, first = np.unique(feature_codes.astype(np.int64) * len(locations) + location_codes, return_index=True)
+        if len(first) < len(values):
+            warnings.warn('{} duplicated (geo feature, location) values, the first one is kept'.format(
+                len(values) - len(first)))
+            first.sort()
+            feature_codes, location_codes, values = feature_codes[first], location_codes[first], values[first]
 
-        feature_vector = feature_vector.fillna(0.0)
-        feature_vector = feature_vector[locations]
-        return feature_vector
+        feature_matrix = sparse.coo_matrix((values, (feature_codes, location_codes)),
+                                           shape=(len(feature_name), len(locations))).tocsr()
+        feature_matrix.eliminate_zeros()
+        return feature_matrix.astype(self._dtype), feature_name
 
-    def _get_geo_feature(self, locations, geo_feature_table_name_dic, conn):
+    def _read_geo_feature_table(self, conn, table_name, column_set, filters, distinct=False):
         """
-        Get all the geographic features for all locations from database
+        Read one geographic feature table, the location filter and dedup are done by the database
+        If 'chunk_size' is configured, the table is streamed chunk by chunk
+        If 'load_method' is 'copy', the table is bulk exported with COPY
 
-        :param locations: selected location
-        :param geo_feature_table_name_dic: {geo_feature: related_table_name}
         :param conn: database connection
+        :param table_name: geographic feature table
+        :param column_set: columns to select, aliased to the geo feature column set
+        :param filters: {column: selected locations}
+        :param distinct: select distinct rows
         :return: a DataFrame columned ["id", "geo_feature", "feature_type", "buffer_size", "value"]
         """
+        chunk_size = self._config.get('chunk_size')
+        if chunk_size:
+            geo_feature_df_list = list(conn.read_chunks(table_name, column_set, chunk_size=chunk_size,
+                                                        columns=self._column_set, filters=filters,
+                                                        distinct=distinct))
+            if not geo_feature_df_list:
+                return pd.DataFrame(columns=self._column_set)
+            return pd.concat(geo_feature_df_list, ignore_index=True)
+
+        if self._config.get('load_method') == 'copy':
+            return conn.copy_as_dataframe(table_name, column_set, columns=self._column_set,
+                                          dtype={self._geo_feature_col: str, self._feature_type_col: str,
+                                                 self._value_col: 'float64'},
+                                          filters=filters, distinct=distinct)
 
+        geo_feature_data = conn.read(table_name, column_set, filters=filters, distinct=distinct)
+        geo_feature_df = pd.DataFrame(geo_feature_data, columns=self._column_set)
+        return geo_feature_df
+
+    def _geo_feature_reads(self, locations, geo_feature_table_name_dic):
+        """
+        :param locations: selected location
+        :param geo_feature_table_name_dic: {geo_feature: related_table_name}
+        :return: a list of reads, each read is (table_name, column_set, filters, distinct)
+        """
         additional_features = self._config['additional_features']
-        geo_feature_df_list = []
+        # NOTE: filter the location based on the provided air quality locations
+        reads = []
 
         for geo_feature in self._geo_feature_set:
             this_geo_feature_table_name = geo_feature_table_name_dic[geo_feature]
-            geo_feature_data = conn.read(this_geo_feature_table_name, self._column_set)
-            geo_feature_df = pd.DataFrame(geo_feature_data, columns=self._column_set)
-            # NOTE: filter the location based on the provided air quality locations
-            geo_feature_df = geo_feature_df.loc[geo_feature_df[self._gid_col].isin(locations)]
-            geo_feature_df_list.append(geo_feature_df)
+            reads.append((this_geo_feature_table_name, self._column_set, {self._gid_col: locations}, False))
 
         for geo_feature in additional_features.keys():
             this_geo_feature_table_name = additional_features[geo_feature]['table_name']
@@ -112,13 +214,72 @@ class GEOModel:
                           '\'{}\' as '.format(geo_feature) + self._feature_type_col,
                           '0 as ' + self._buffer_size_col,
                           '{} as '.format(column_list[1]) + self._value_col]
+            # NOTE: hourly tables repeat the coordinates on every row, only one row per station is needed
+            reads.append((this_geo_feature_table_name, column_set, {column_list[0]: locations}, True))
+        return reads
+
+    @instrumented('geo_feature.fetch',
+                  rows_in=lambda self, locations, *args, **kwargs: len(locations))
+    def _get_geo_feature(self, locations, geo_feature_table_name_dic, conn, pool=None):
+        """
+        Get all the geographic features for all locations from database
+        If a connection pool is provided, the tables are fetched concurrently,
+        with at most 'max_workers' (at most the pool size) queries in flight
+
+        :param locations: selected location
+        :param geo_feature_table_name_dic: {geo_feature: related_table_name}
+        :param conn: database connection
+        :param pool: optional services.postgres_connection.ConnectionPool
+        :return: a DataFrame columned ["id", "geo_feature", "feature_type", "buffer_size", "value"]
+        """
+
+        reads = self._geo_feature_reads(locations, geo_feature_table_name_dic)
 
-            geo_feature_data = conn.read(this_geo_feature_table_name, column_set)
-            geo_feature_df = pd.DataFrame(geo_feature_data, columns=self._column_set)
-            geo_feature_df.drop_duplicates(inplace=True)
-            # NOTE: filter the location based on the provided air quality locations
-            geo_feature_df = geo_feature_df.loc[geo_feature_df[self._gid_col].isin(locations)]
-            geo_feature_df_list.append(geo_feature_df)
+        def pooled_read(each_read):
+            with pool.connection() as pooled_conn:
+                return self._read_geo_feature_table(pooled_conn, *each_read)
+
+        if pool is None:
+            geo_feature_df_list = [self._read_geo_feature_table(conn, *each_read) for each_read in reads]
+        else:
+            # NOTE: more threads than pooled connections would make the pool raise (it does not block)
+            max_workers = min(self._config.get('max_workers', pool.maxconn), pool.maxconn)
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                geo_feature_df_list = list(executor.map(pooled_read, reads))
 
         all_geo_feature_df = pd.concat(geo_feature_df_list)
         return all_geo_feature_df
+
+    async def _read_geo_feature_table_async(self, conn, table_name, column_set, filters, distinct=False):
+        """
+        Same as _read_geo_feature_table with an AsyncConnection
+        """
+        chunk_size = self._config.get('chunk_size')
+        if chunk_size:
+            geo_feature_df_list = [chunk async for chunk in
+                                   conn.read_chunks(table_name, column_set, chunk_size=chunk_size,
+                                                    columns=self._column_set, filters=filters, distinct=distinct)]
+            if not geo_feature_df_list:
+                return pd.DataFrame(columns=self._column_set)
+            return pd.concat(geo_feature_df_list, ignore_index=True)
+
+        if self._config.get('load_method') == 'copy':
+            return await conn.copy_as_dataframe(table_name, column_set, columns=self._column_set,
+                                                dtype={self._geo_feature_col: str, self._feature_type_col: str,
+                                                       self._value_col: 'float64'},
+                                                filters=filters, distinct=distinct)
+
+        geo_feature_data = await conn.read(table_name, column_set, filters=filters, distinct=distinct)
+        return pd.DataFrame(geo_feature_data, columns=self._column_set)
+
+    async def _get_geo_feature_async(self, locations, geo_feature_table_name_dic, conn):
+        """
+        Same as _get_geo_feature with an AsyncConnection, all the tables are read concurrently
+        (bounded by the pool of the connection) and each one is decoded as soon as it arrives
+
+        :return: a DataFrame columned ["id", "geo_feature", "feature_type", "buffer_size", "value"]
+        """
+        reads = self._geo_feature_reads(locations, geo_feature_table_name_dic)
+        geo_feature_df_list = await asyncio.gather(*[self._read_geo_feature_table_async(conn, *each_read)
+                                                     for each_read in reads])
+        return pd.concat(geo_feature_df_list)
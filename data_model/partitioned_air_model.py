@@ -0,0 +1,199 @@
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from data_model.air_model import AIRModel, _column_expression
+from services.instrumentation import stage
+from services.timeseries_preprocess import time_series_pivot, time_series_smoothing
+from services.utils import combine_duplicate_sums, duplicate_statistics_from_sums
+
+# NOTE: pandas frequencies of the partition boundaries
+_PARTITION_FREQ = {'month': 'MS', 'week': 'W-MON'}
+_HOUR = pd.Timedelta('1H')
+
+
+def _create_matrix(path, shape, dtype, index, columns):
+    """
+    Create a NaN filled matrix on disk, with a JSON file describing its index and columns
+    """
+    matrix = np.lib.format.open_memmap(path + '.npy', mode='w+', dtype=dtype, shape=shape)
+    matrix[:] = np.nan
+    with open(path + '.json', 'w') as f:
+        json.dump({'start': index[0].isoformat(), 'freq': '1H', 'columns': list(columns)}, f, default=str)
+    return matrix
+
+
+def open_time_series(path, mode='r'):
+    """
+    Open a time series matrix written by PartitionedAIRModel, without loading it in memory
+
+    :param path: path of the matrix, without extension
+    :param mode: memmap mode
+    :return: a DataFrame backed by the memory mapped matrix
+    """
+    with open(path + '.json') as f:
+        meta = json.load(f)
+    matrix = np.load(path + '.npy', mmap_mode=mode)
+    index = pd.date_range(start=meta['start'], periods=len(matrix), freq=meta['freq'])
+    return pd.DataFrame(matrix, index=index, columns=meta['columns'], copy=False)
+
+
+class PartitionedAIRModel:
+
+    def __init__(self, config, conn, work_dir, partition=None, key_col='station_id', time_col='date_observed',
+                 value_col='value'):
+        """
+        Build the time series of a long time range one partition (month or week) at a time
+        Each partition is fetched, cleaned, deduplicated and pivoted on its own, and written into a matrix on disk,
+        so that the peak memory depends on the partition size instead of the whole range
+
+        :param config: same config as AIRModel
+        :param conn: database connection
+        :param work_dir: directory of the on-disk matrices
+        :param partition: 'month' or 'week', defaults to 'partition' of the air quality config ('month')
+        """
+        self._config = config
+        self._air_quality_config = config['air_quality']
+        self._key_col = key_col
+        self._time_col = time_col
+        self._value_col = value_col
+        self._work_dir = work_dir
+        os.makedirs(work_dir, exist_ok=True)
+
+        partition = partition or self._air_quality_config.get('partition', 'month')
+        if partition not in _PARTITION_FREQ:
+            raise ValueError('Invalid partition: {}'.format(partition))
+        self._partition = partition
+        self._dtype = np.float32 if self._air_quality_config.get('compact', False) else np.float64
+
+        self.removed_stations = set()
+        self.duplicate_sums = None
+        self.stored_time_series = self._build_time_series(conn)
+
+    @property
+    def time_series(self):
+        """
+        The time series without the removed stations. The stored matrix is returned as it is (memory mapped)
+        when no station is removed, otherwise the remaining columns are copied in memory
+
+        :return: a DataFrame indexed by time, columned by stations
+        """
+        if not self.removed_stations.intersection(self.stored_time_series.columns):
+            return self.stored_time_series
+        return self.stored_time_series[self.get_locations()]
+
+    def _model(self):
+        return AIRModel(self._config, None, key_col=self._key_col, time_col=self._time_col,
+                        value_col=self._value_col)
+
+    def _range_and_stations(self, conn):
+        """
+        :return: (first hour, last hour, sorted stations) of the cleaned (positive) readings
+        :raise ValueError: if the requested range has no positive reading
+        """
+        table_name = self._air_quality_config['table_name']
+        request_condition = self._air_quality_config['request_condition']
+        key_expression, time_expression, value_expression = [_column_expression(c) for c in
+                                                             self._air_quality_config['column_set']]
+        conditions = ['{} > 0'.format(value_expression)]
+        (min_time, max_time), = conn.read(table_name, ['min({})'.format(time_expression),
+                                                       'max({})'.format(time_expression)],
+                                          request_condition, conditions=conditions)
+        if pd.isna(min_time) or pd.isna(max_time):
+            raise ValueError('No positive reading in {} with condition: {}'.format(table_name, request_condition))
+        stations = conn.read(table_name, [key_expression], request_condition, conditions=conditions, distinct=True)
+        return pd.Timestamp(min_time).floor(_HOUR), pd.Timestamp(max_time).floor(_HOUR), \
+            sorted(station for station, in stations)
+
+    def partitions(self, first_hour, last_hour):
+        """
+        :return: [(since, until)] hour aligned partitions covering [first_hour, last_hour]
+        """
+        boundaries = pd.date_range(first_hour, last_hour, freq=_PARTITION_FREQ[self._partition])
+        boundaries = [first_hour] + [b for b in boundaries if b > first_hour] + [last_hour + _HOUR]
+        return list(zip(boundaries[:-1], boundaries[1:]))
+
+    def _build_time_series(self, conn):
+        first_hour, last_hour, stations = self._range_and_stations(conn)
+        index = pd.date_range(first_hour, last_hour, freq='1H')
+        columns = pd.Index(stations)
+        path = os.path.join(self._work_dir, 'time_series')
+        matrix = _create_matrix(path, (len(index), len(columns)), self._dtype, index, columns)
+
+        sums_list = []
+        for since, until in self.partitions(first_hour, last_hour):
+            with stage('partition.build', rows_in=None) as record:
+                model = self._model().fetch(conn, since=since, until=until)
+                record['rows_in'] = len(model.air_quality_df)
+                if model.air_quality_df.empty:
+                    continue
+                sums_list.append(model.get_duplicate_sums())
+                model.average_duplicates()
+                # NOTE: partitions are hour aligned, so every (station, hour) lives in a single partition
+                partition_series = time_series_pivot(model.air_quality_df, self._key_col, self._time_col,
+                                                     self._value_col, dtype=self._dtype)
+                start = (partition_series.index[0] - first_hour) // _HOUR
+                matrix[start: start + len(partition_series), columns.get_indexer(partition_series.columns)] = \
+                    partition_series.values
+                record['rows_out'] = len(partition_series)
+        matrix.flush()
+
+        self.duplicate_sums = combine_duplicate_sums(sums_list) if sums_list else None
+        return open_time_series(path, mode='r+')
+
+    def get_duplicate_statistics(self):
+        """
+        Statistics of the duplicates of each station over all the partitions, see AIRModel.get_duplicate_statistics
+
+        :return: a DataFrame indexed by station
+        """
+        return duplicate_statistics_from_sums(self.duplicate_sums)
+
+    def remove_stations(self, removers):
+        """
+        Remove the stations with given removers, they are left out of time_series, get_locations and the smoothed
+        matrix. The stored matrix keeps their columns
+
+        :param removers: A list of station ids
+        """
+        self.removed_stations.update(removers)
+
+    def get_locations(self):
+        return [station for station in self.stored_time_series.columns if station not in self.removed_stations]
+
+    def smooth(self, window_size=24, method='mean', n_sigmas=3.0, block_size=None):
+        """
+        Smooth the time series block by block into another on-disk matrix, see time_series_smoothing
+        Each block is smoothed with `window_size` extra rows on both sides, so the windows at the block
+        boundaries see the same values as in a full-range run. Removed stations are left out
+
+        :param window_size: size of the rolling window
+        :param method: 'mean', 'median' or 'hampel', the EWMA has no finite window
+        :param n_sigmas: threshold of the hampel filter
+        :param block_size: rows smoothed at once, defaults to 4 weeks
+        :return: a DataFrame backed by the smoothed matrix
+        """
+        if method not in {'mean', 'median', 'hampel'}:
+            raise ValueError('Smoothing method {} cannot be run by partition'.format(method))
+        block_size = block_size or 4 * 7 * 24
+
+        time_series = self.stored_time_series
+        locations = self.get_locations()
+        column_indexer = time_series.columns.get_indexer(locations)
+        path = os.path.join(self._work_dir, 'time_series_smooth')
+        smooth = _create_matrix(path, (len(time_series), len(locations)), time_series.values.dtype,
+                                time_series.index, locations)
+
+        values = time_series.values
+        for start in range(0, len(time_series), block_size):
+            end = min(start + block_size, len(time_series))
+            margin_start = max(start - window_size, 0)
+            margin_end = min(end + window_size, len(time_series))
+            block = pd.DataFrame(values[margin_start: margin_end, column_indexer],
+                                 index=time_series.index[margin_start: margin_end], columns=locations)
+            smooth_block = time_series_smoothing(block, window_size=window_size, method=method, n_sigmas=n_sigmas)
+            smooth[start: end] = smooth_block.values[start - margin_start: end - margin_start]
+        smooth.flush()
+        return open_time_series(path)
@@ -0,0 +1,43 @@
+import asyncio
+
+from data_model.air_model import AIRModel
+from data_model.geo_model import GEOModel
+from services.async_postgres_connection import AsyncConnection
+from services.instrumentation import stage
+
+
+async def load_models_async(feature_set, config, conn):
+    """
+    Fetch the air quality data, then the geographic features of its stations, the geo feature tables being read
+    concurrently on the pool
+    The stations are narrowed down later (e.g. once the duplicates are checked) with GEOModel.select_locations
+
+    :param feature_set: geographic features
+    :param config: config with the 'air_quality' and 'geo_feature' sections
+    :param conn: services.async_postgres_connection.AsyncConnection
+    :return: (AIRModel, GEOModel of the stations of the air quality data)
+    """
+    air_quality_model = await AIRModel(config, None).fetch_async(conn)
+    # NOTE: only the stations of the fetched rows, as the synchronous path does
+    geo_feature_model = GEOModel(air_quality_model.get_locations(), feature_set, config, None)
+    await geo_feature_model.fetch_async(conn)
+    return air_quality_model, geo_feature_model
+
+
+def load_models(feature_set, config, host='localhost', port='5432', user='', password='', database='prisms',
+                cache=None):
+    """
+    Blocking wrapper of load_models_async, on an asyncpg pool opened for the run
+
+    :return: (AIRModel, GEOModel of the stations of the air quality data)
+    """
+    async def run():
+        conn = await AsyncConnection.connect(host=host, port=port, user=user, password=password, database=database,
+                                             max_size=config.get('max_connections', 8), cache=cache)
+        try:
+            return await load_models_async(feature_set, config, conn)
+        finally:
+            await conn.close_conn()
+
+    with stage('async_fetch'):
+        return asyncio.run(run())
@@ -0,0 +1,201 @@
+"""
+Run the preprocessing of several (region, source, parameter) jobs on a process pool
+
+Every job runs in its own worker process (one process per job), under an optional address space limit, and writes
+its outputs and stage report into <output>/<region>_<source>_<parameter>/. Each job opens a single database
+connection, so at most --workers connections are open at a time. All the jobs read through one query cache on disk,
+so the geographic features (and any other query) are only fetched by the first job needing them.
+A summary of the status, time and memory of each job is written as batch_summary.json.
+The regions are utah and los_angeles, the sources epa and purple_air (see PREPROCESSORS).
+
+Usage:
+    python -m preprocess.batch --config utah=../data/config/utah_model_config.json \
+        --jobs utah:epa:pm25,utah:purple_air:pm25 --workers 2 --memory-limit-mb 8192 \
+        --cache-dir ../data/cache --output ../data/batch
+"""
+import argparse
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from preprocess.los_angeles_epa import los_angeles_epa_preprocess
+from preprocess.los_angeles_purple_air import los_angeles_ppa_preprocess
+from preprocess.utah_epa import utah_epa_preprocess
+from preprocess.utah_purple_air import utah_purple_air_preprocess
+from services.instrumentation import _max_rss
+from services.storage import save_geo_feature_matrix, save_rows, save_time_series
+
+try:
+    import resource
+except ImportError:  # NOTE: not available on Windows, the memory limits are then not applied
+    resource = None
+
+PREPROCESSORS = {('utah', 'epa'): utah_epa_preprocess,
+                 ('utah', 'purple_air'): utah_purple_air_preprocess,
+                 ('los_angeles', 'epa'): los_angeles_epa_preprocess,
+                 ('los_angeles', 'purple_air'): los_angeles_ppa_preprocess}
+PARAMETERS = ('pm25', 'pm10', 'o3')
+_MB = 2 ** 20
+
+
+def load_config(file_path):
+    """
+    Load a model config merged with its data config (the 'data_config' path)
+    """
+    with open(file_path) as f:
+        config = json.load(f)
+    with open(config['data_config']) as f:
+        return dict(config, **json.load(f))
+
+
+def job_name(job):
+    return '_'.join(job)
+
+
+def job_config(config, job, output_path, cache_dir=None):
+    """
+    Config of a job, the section of config whose air quality 'data_source' is the job source,
+    with the top level options (feature_set, async_backend, ...) and the job parameter
+    The parameter is selected by the query if the table has a 'parameter_column', otherwise the table only holds
+    the 'parameter_name' of the air quality section (or of the region), and the other parameters are rejected
+
+    :param config: output of load_config of the job region
+    :param job: (region, source, parameter)
+    :param output_path: output directory of the job
+    :param cache_dir: directory of the query cache shared by all the jobs
+    :return: the job config
+    """
+    region, source, parameter = job
+    if parameter not in PARAMETERS:
+        raise ValueError('Unknown parameter: {}'.format(parameter))
+
+    sections = {name: value for name, value in config.items() if isinstance(value, dict) and 'air_quality' in value}
+    section = next((value for value in sections.values() if value['air_quality'].get('data_source') == source), None)
+    if section is None:
+        raise ValueError('No {} section in the {} config'.format(source, region))
+    options = {name: value for name, value in config.items() if name not in sections}
+    merged = dict(options, **section)
+
+    air_quality = section['air_quality']
+    if 'parameter_column' in air_quality:
+        merged['air_quality'] = dict(air_quality, parameters=[parameter])
+    elif air_quality.get('parameter_name', config.get('parameter_name')) != parameter:
+        raise ValueError('The {} {} table cannot select {}, only {}'.format(
+            region, source, parameter, air_quality.get('parameter_name', config.get('parameter_name'))))
+    # NOTE: one connection per job (the async pool included), so max_workers bounds the open connections
+    merged.update(parameter_name=parameter, output_path=output_path, max_connections=1)
+    if cache_dir is not None:
+        merged['query_cache'] = dict(config.get('query_cache') or {}, cache_dir=cache_dir)
+    return merged
+
+
+def _set_memory_limit(memory_limit_mb):
+    if memory_limit_mb is None or resource is None:
+        return
+    limit = int(memory_limit_mb * _MB)
+    # NOTE: the address space of the worker, an allocation over the limit raises a MemoryError in the job
+    resource.setrlimit(resource.RLIMIT_AS, (limit, resource.getrlimit(resource.RLIMIT_AS)[1]))
+
+
+def write_outputs(output_path, air_quality_model, geo_feature_model):
+    """
+    Write the models of a job with services.storage
+    """
+    save_rows(air_quality_model.air_quality_df, os.path.join(output_path, 'rows.parquet'))
+    if air_quality_model.time_series is not None:
+        save_time_series(air_quality_model.time_series, os.path.join(output_path, 'time_series.arrow'))
+    save_geo_feature_matrix(geo_feature_model.geo_feature_matrix, geo_feature_model.geo_feature_name,
+                            geo_feature_model.locations, os.path.join(output_path, 'geo_features.arrow'))
+
+
+def run_job(preprocessor, feature_set, config, memory_limit_mb=None):
+    """
+    Run one job in the current (worker) process, the models are written to disk instead of being sent back
+
+    :return: summary of the job
+    """
+    summary = {'output_path': config['output_path'], 'status': 'done', 'error': None}
+    start = time.perf_counter()
+    try:
+        _set_memory_limit(memory_limit_mb)
+        os.makedirs(config['output_path'], exist_ok=True)
+        air_quality_model, geo_feature_model = preprocessor(feature_set, config)
+        write_outputs(config['output_path'], air_quality_model, geo_feature_model)
+    except Exception as e:
+        summary.update(status='failed', error='{}: {}'.format(type(e).__name__, e))
+    summary['seconds'] = time.perf_counter() - start
+    summary['max_rss_mb'] = _max_rss() / _MB if _max_rss() is not None else None
+    return summary
+
+
+def run_batch(jobs, configs, output_path, max_workers=1, memory_limit_mb=None, cache_dir=None,
+              preprocessors=None):
+    """
+    Run the jobs on a process pool and write batch_summary.json
+
+    :param jobs: list of (region, source, parameter)
+    :param configs: {region: output of load_config}
+    :param output_path: output directory, one sub directory per job
+    :param max_workers: number of jobs running at the same time (and of open database connections,
+                        job_config limits each job to one connection)
+    :param memory_limit_mb: address space limit of each job in MB, no limit if None
+    :param cache_dir: query cache shared by the jobs, defaults to <output_path>/query_cache
+    :param preprocessors: {(region, source): preprocess function}, defaults to PREPROCESSORS
+    :return: the summary
+    """
+    preprocessors = preprocessors or PREPROCESSORS
+    cache_dir = cache_dir or os.path.join(output_path, 'query_cache')
+    os.makedirs(output_path, exist_ok=True)
+
+    # NOTE: every job is checked before any of them starts
+    job_configs = []
+    for job in jobs:
+        region, source, _ = job
+        if (region, source) not in preprocessors:
+            raise ValueError('Unknown region / source: {} / {}'.format(region, source))
+        job_configs.append(job_config(configs[region], job, os.path.join(output_path, job_name(job)), cache_dir))
+
+    start = time.perf_counter()
+    summaries = []
+    # NOTE: a fresh process per job, so that the memory limit, the max RSS and the leaks stay per job
+    with ProcessPoolExecutor(max_workers=max_workers, max_tasks_per_child=1) as executor:
+        futures = [executor.submit(run_job, preprocessors[job[:2]], config['feature_set'], config, memory_limit_mb)
+                   for job, config in zip(jobs, job_configs)]
+        for job, future in zip(jobs, futures):
+            try:
+                summary = future.result()
+            except Exception as e:  # NOTE: e.g. the worker was killed
+                summary = {'status': 'failed', 'error': '{}: {}'.format(type(e).__name__, e)}
+            region, source, parameter = job
+            summaries.append(dict({'region': region, 'source': source, 'parameter': parameter}, **summary))
+
+    report = {'max_workers': max_workers, 'memory_limit_mb': memory_limit_mb,
+              'seconds': time.perf_counter() - start, 'jobs': summaries}
+    with open(os.path.join(output_path, 'batch_summary.json'), 'w') as f:
+        json.dump(report, f, indent=2, default=str)
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--config', action='append', required=True, help='region=model config path, repeatable')
+    parser.add_argument('--jobs', required=True, help='comma separated region:source:parameter')
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--memory-limit-mb', type=float)
+    parser.add_argument('--cache-dir')
+    parser.add_argument('--output', required=True)
+    args = parser.parse_args()
+
+    configs = {region: load_config(path) for region, path in (c.split('=', 1) for c in args.config)}
+    jobs = [tuple(job.split(':')) for job in args.jobs.split(',')]
+    report = run_batch(jobs, configs, args.output, max_workers=args.workers, memory_limit_mb=args.memory_limit_mb,
+                       cache_dir=args.cache_dir)
+    for job in report['jobs']:
+        print('{:<12} {:<11} {:<5} {:<7} {:>9.1f}s {}'.format(job['region'], job['source'], job['parameter'],
+                                                              job['status'], job.get('seconds', float('nan')),
+                                                              job['error'] or ''))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,10 +1,21 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import tempfile
+
 import numpy as np
+from numpy.lib.stride_tricks import as_strided
 import pandas as pd
-import pickle
 import os
 import sys
 import yaml
 
+from services import timeseries_preprocess
+from services.postgres_connection import Connection
+from services.query_cache import QueryCache
+from services.spatial import save_adjacency
+from services.storage import save_time_series
+
 
 def time_series_data_constrution(df, key_col='station_id', time_col='date_observed', value_col='value'):
     """
@@ -58,25 +69,165 @@ def split_train_val_test(chunk, train_size, val_size, test_size):
 
 
 def generate_x_y_series_data(data, x_size, y_size):
-    xs, ys = [], []
-    x_indices = np.arange(x_size)
-    y_indices = np.arange(x_size, x_size + y_size, 1)
-    for i in range(0, len(data) - x_size - y_size + 1, 1):
-        x = data[x_indices + i]
-        y = data[y_indices + i]
-        xs.append(x)
-        ys.append(y)
-
-    xs = np.array(xs)
-    ys = np.array(ys)
+    """
+    Generate every (x, y) window pair of the data, in order
+    The windows are strided views of the data, nothing is copied until they are written
+
+    :param data: array shaped (time, ...)
+    :param x_size: input window length
+    :param y_size: output window length
+    :return: xs shaped (num_windows, x_size, ...), ys shaped (num_windows, y_size, ...)
+    """
+    num_windows = max(len(data) - x_size - y_size + 1, 0)
+    windows = as_strided(data, shape=(num_windows, x_size + y_size) + data.shape[1:],
+                         strides=(data.strides[0],) + data.strides, writeable=False)
+    xs = windows[:, :x_size]
+    ys = windows[:, x_size:]
 
     return xs, ys
 
 
-def generate_yaml(input_yaml, output_path, x_window, y_window):
+def _segment_window_starts(start, length, x_size, y_size):
+    return start + np.arange(max(length - x_size - y_size + 1, 0))
+
+
+def split_window_indices(num_time, x_window, y_window, split_rule='normal'):
+    """
+    Start indices of the (x, y) windows of each split, following the same rules and order
+    as the materialized windows of generate_data_config_for_training
+
+    :param num_time: length of the time axis
+    :param x_window: input window length
+    :param y_window: output window length
+    :param split_rule: 'normal', 'shuffle' or '3week1week'
+    :return: {'train': starts, 'val': starts, 'test': starts}
+    """
+    if split_rule == '3week1week':
+        total_week = 4 * 24 * 7
+        train_week = round(3 * 24 * 7 * 0.875)
+        test_week = 1 * 24 * 7
+        val_week = total_week - train_week - test_week
+
+        train, val, test = [], [], []
+        # NOTE: same chunking as split_by_chunk, a trailing full chunk is handled as the last part
+        chunk_ends = list(range(total_week, num_time, total_week))
+        for end in chunk_ends:
+            start = end - total_week
+            train.append(_segment_window_starts(start, train_week, x_window, y_window))
+            val.append(_segment_window_starts(start + train_week, val_week, x_window, y_window))
+            test.append(_segment_window_starts(end - test_week, test_week, x_window, y_window))
+
+        last_start = chunk_ends[-1] if chunk_ends else 0
+        if last_start < num_time:
+            # NOTE: np.array_split puts the extra element in the first half
+            last_train_size = (num_time - last_start + 1) // 2
+            train.append(_segment_window_starts(last_start, last_train_size, x_window, y_window))
+            val.append(_segment_window_starts(last_start + last_train_size, num_time - last_start - last_train_size,
+                                              x_window, y_window))
+
+        empty = [np.arange(0)]
+        return {'train': np.concatenate(train + empty),
+                'val': np.concatenate(val + empty),
+                'test': np.concatenate(test + empty)}
+
+    elif split_rule in {'normal', 'shuffle'}:
+        starts = _segment_window_starts(0, num_time, x_window, y_window)
+        if split_rule == 'shuffle':
+            starts = starts[np.random.permutation(len(starts))]
+
+        num_samples = len(starts)
+        num_test = round(num_samples * 0.2)
+        num_train = round(num_samples * 0.7)
+        num_val = num_samples - num_test - num_train
+        return {'train': starts[:num_train],
+                'val': starts[num_train: num_train + num_val],
+                'test': starts[-num_test:]}
+    else:
+        print('no such split rule')
+        sys.exit(1)
+
+
+class WindowDataset:
+
+    def __init__(self, data, x_window, y_window, split_indices):
+        """
+        Lazy (x, y) window dataset, only the dense (time, station, feature) data and the
+        window start indices of each split are kept, windows are gathered on demand
+
+        :param data: array shaped (time, station, feature)
+        :param x_window: input window length
+        :param y_window: output window length
+        :param split_indices: {split: window start indices}
+        """
+        self.data = data
+        self.x_window = x_window
+        self.y_window = y_window
+        self.split_indices = {split: np.asarray(starts, dtype=np.int64) for split, starts in split_indices.items()}
+
+        self._x_indices = np.arange(x_window)
+        self._y_indices = np.arange(x_window, x_window + y_window)
+
+    @classmethod
+    def from_split_rule(cls, data, x_window, y_window, split_rule='normal'):
+        return cls(data, x_window, y_window, split_window_indices(len(data), x_window, y_window, split_rule))
+
+    @property
+    def x_offsets(self):
+        return np.arange(-self.x_window, 1, 1)
+
+    @property
+    def y_offsets(self):
+        return np.arange(1, 1 + self.y_window, 1)
+
+    def num_samples(self, split):
+        return len(self.split_indices[split])
+
+    def get_windows(self, split, positions=None):
+        """
+        Gather the windows of a split
+
+        :param split: 'train', 'val' or 'test'
+        :param positions: positions of the windows within the split, all windows if None
+        :return: x shaped (num_windows, x_window, ...), y shaped (num_windows, y_window, ...)
+        """
+        starts = self.split_indices[split]
+        if positions is not None:
+            starts = starts[positions]
+        starts = starts[:, np.newaxis]
+        return self.data[starts + self._x_indices], self.data[starts + self._y_indices]
+
+    def iter_batches(self, split, batch_size, shuffle=True, seed=None):
+        """
+        Yield (x, y) mini-batches of a split, only one batch is materialized at a time
+
+        :param split: 'train', 'val' or 'test'
+        :param batch_size: number of windows per batch
+        :param shuffle: shuffle the window order
+        :param seed: seed of the shuffle
+        :return: a generator of (x, y)
+        """
+        positions = np.arange(self.num_samples(split))
+        if shuffle:
+            positions = np.random.RandomState(seed).permutation(positions)
+        for i in range(0, len(positions), batch_size):
+            yield self.get_windows(split, positions[i: i + batch_size])
+
+    def save(self, file_path):
+        np.savez_compressed(file_path, data=self.data, x_window=self.x_window, y_window=self.y_window,
+                            **self.split_indices)
+
+    @classmethod
+    def load(cls, file_path):
+        with np.load(file_path) as stored:
+            splits = [name for name in stored.files if name not in {'data', 'x_window', 'y_window'}]
+            return cls(stored['data'], int(stored['x_window']), int(stored['y_window']),
+                       {split: stored[split] for split in splits})
+
+
+def generate_yaml(input_yaml, output_path, x_window, y_window, graph_pkl_filename=None):
     with open(input_yaml, 'r') as stream:
         try:
-            y = yaml.load(stream)
+            y = yaml.load(stream, Loader=yaml.SafeLoader)
         except yaml.YAMLError as exc:
             print(exc)
     d = 'data/'+ os.path.basename(output_path)
@@ -84,6 +235,9 @@ def generate_yaml(input_yaml, output_path, x_window, y_window):
     y['data']['dataset_dir'] = d
     y['model']['seq_len'] = x_window
     y['model']['horizon'] = y_window
+    # NOTE: the station graph written by services.spatial.save_adjacency next to the data
+    if graph_pkl_filename is not None:
+        y['data']['graph_pkl_filename'] = d + '/' + graph_pkl_filename
 
     yaml_path = output_path+'/config.yaml'
 
@@ -93,87 +247,110 @@ def generate_yaml(input_yaml, output_path, x_window, y_window):
     print('yaml file saved at %s' % (yaml_path))
 
 
-def generate_data_config_for_training(df, x_window=6, y_window=6, yaml_path=None, save_path=None,
-                                      date_column='date_observed',
-                                      split_rule='normal',
-                                      **feature_args):
-    npdata = np.expand_dims(df.drop(columns=[date_column]).values, axis=-1)
+def _prepare_npdata(df, date_column, dtype=None, time_of_day=False, time_index=None):
+    """
+    :param df: time series DataFrame columned by stations and date_column,
+               or a (time, station, feature) tensor (e.g. AIRModel.build_tensor), left unchanged
+    :param time_of_day: append the time of day of each step as a last feature, the time feature of DCRNN
+    :param time_index: time of each step, df[date_column] by default
+    :return: array shaped (time, station, feature), NaN replaced by 0
+    """
+    if isinstance(df, np.ndarray):
+        if df.ndim != 3:
+            raise ValueError('Expected a (time, station, feature) tensor, got {} dimensions'.format(df.ndim))
+        # NOTE: copied, the NaN of the caller's tensor are replaced below (time_of_day copies it anyway)
+        npdata = np.array(df, dtype=dtype, copy=not time_of_day)
+    else:
+        if time_of_day and time_index is None:
+            time_index = df[date_column]
+        # NOTE: casting before expand_dims keeps a single (possibly float32) copy of the matrix
+        npdata = np.expand_dims(np.asarray(df.drop(columns=[date_column]).values, dtype=dtype), axis=-1)
+
+    if time_of_day:
+        if time_index is None:
+            raise ValueError('time_of_day requires the time_index of the tensor')
+        # NOTE: the features and the time of day are written into one preallocated array
+        features = npdata
+        npdata = np.empty(features.shape[:2] + (features.shape[2] + 1,), dtype=features.dtype)
+        npdata[..., :-1] = features
+        npdata[..., -1] = timeseries_preprocess.time_of_day(time_index)[:, np.newaxis]
     npdata[np.isnan(npdata)] = 0
+    return npdata
 
-    # feature args
-    if feature_args:
-        pass
-    if split_rule == '3week1week':
-        total_week = 4 * 24 * 7
-        train_week = round(3 * 24 * 7 * 0.875)
-        test_week = 1 * 24 * 7
-        val_week = total_week - train_week - test_week
 
-        months, last = split_by_chunk(npdata, total_week)
-
-        x_train, x_val, x_test = [], [], []
-        y_train, y_val, y_test = [], [], []
-
-        for mo in months:
-            train, val, test = split_train_val_test(mo, train_week, val_week, test_week)
-            _x_train, _y_train = generate_x_y_series_data(train, x_window, y_window)
-            _x_val, _y_val = generate_x_y_series_data(val, x_window, y_window)
-            _x_test, _y_test = generate_x_y_series_data(test, x_window, y_window)
-            x_train.append(_x_train)
-            x_val.append(_x_val)
-            x_test.append(_x_test)
-            y_train.append(_y_train)
-            y_val.append(_y_val)
-            y_test.append(_y_test)
-
-        if last is not None:
-            train, val = np.array_split(last, 2)
-            _x_train, _y_train = generate_x_y_series_data(train, x_window, y_window)
-            _x_val, _y_val = generate_x_y_series_data(val, x_window, y_window)
-            x_train.append(_x_train)
-            x_val.append(_x_val)
-            y_train.append(_y_train)
-            y_val.append(_y_val)
-
-        x_train = np.concatenate(x_train)
-        x_val = np.concatenate(x_val)
-        x_test = np.concatenate(x_test)
-
-        y_train = np.concatenate(y_train)
-        y_val = np.concatenate(y_val)
-        y_test = np.concatenate(y_test)
-
-    # normal spliting method
-    elif split_rule in {'normal', 'shuffle'}:
-        x, y = generate_x_y_series_data(npdata, x_window, y_window)
-        if split_rule == 'normal':
-            pass
-        elif split_rule == 'shuffle':
-            shuffle_indices = np.random.permutation(x.shape[0])
-            x = x[shuffle_indices]
-            y = y[shuffle_indices]
-        else:
-            pass
-
-        num_samples = len(x)
-        num_test = round(num_samples * 0.2)
-        num_train = round(num_samples * 0.7)
-        num_val = num_samples - num_test - num_train
+def _sensor_ids(df, date_column, sensor_ids):
+    if sensor_ids is not None:
+        return sensor_ids
+    if isinstance(df, np.ndarray):
+        raise ValueError('sensor_ids are required to save the adjacency of a tensor')
+    return df.drop(columns=[date_column]).columns
 
-        # train
-        x_train, y_train = x[:num_train], y[:num_train]
 
-        # val
-        x_val, y_val = (
-            x[num_train: num_train + num_val],
-            y[num_train: num_train + num_val],
-        )
-        # test
-        x_test, y_test = x[-num_test:], y[-num_test:]
+def _gather_windows(npdata, starts, offsets, out_path=None):
+    """
+    Gather the windows starting at `starts` once, into their final array
+
+    :param npdata: array shaped (time, station, feature)
+    :param starts: window start indices
+    :param offsets: time offsets of the window, relative to its start
+    :param out_path: .npy file of a memory mapped output, the output is in memory if None
+    :return: array shaped (len(starts), len(offsets), station, feature)
+    """
+    shape = (len(starts), len(offsets)) + npdata.shape[1:]
+    # NOTE: consecutive starts (e.g. the 'normal' split) are a strided view of npdata, nothing is copied
+    if out_path is None and len(starts) and np.all(np.diff(starts) == 1):
+        step = npdata.strides[0]
+        return as_strided(npdata[starts[0] + offsets[0]:], shape=shape, strides=(step, step) + npdata.strides[1:],
+                          writeable=False)
+
+    if out_path is None:
+        out = np.empty(shape, dtype=npdata.dtype)
     else:
-        print('no such split rule')
-        sys.exit(1)
+        out = np.lib.format.open_memmap(out_path, mode='w+', dtype=npdata.dtype, shape=shape)
+    # NOTE: the indices are in range, 'clip' lets np.take write into out without a buffered copy
+    np.take(npdata, starts[:, np.newaxis] + offsets, axis=0, out=out, mode='clip')
+    return out
+
+
+@contextmanager
+def _scratch_dir(memmap_dir):
+    """
+    Temporary directory of the memory mapped windows within memmap_dir, removed once they are saved
+    """
+    if memmap_dir is None:
+        yield None
+        return
+    os.makedirs(memmap_dir, exist_ok=True)
+    with tempfile.TemporaryDirectory(dir=memmap_dir) as scratch:
+        yield scratch
+
+
+def _split_windows(npdata, x_window, y_window, split_rule, memmap_dir=None):
+    """
+    Generate the (x, y) windows of each split
+    The splits are drawn on the window start indices (see split_window_indices), then the windows
+    of each split are gathered once into their output, so the peak memory is about the size of the outputs
+
+    :param npdata: array shaped (time, station, feature)
+    :param x_window: input window length
+    :param y_window: output window length
+    :param split_rule: 'normal', 'shuffle' or '3week1week'
+    :param memmap_dir: directory of memory mapped outputs (x_train.npy, ...), the outputs are in memory if None
+    :return: {'x_train': ..., 'y_train': ..., 'x_val': ..., 'y_val': ..., 'x_test': ..., 'y_test': ...}
+    """
+    split_indices = split_window_indices(len(npdata), x_window, y_window, split_rule)
+    offsets = {'x': np.arange(x_window), 'y': np.arange(x_window, x_window + y_window)}
+
+    split_data = {}
+    for cat in ['train', 'val', 'test']:
+        for name in ['x', 'y']:
+            key = '{}_{}'.format(name, cat)
+            out_path = os.path.join(memmap_dir, key + '.npy') if memmap_dir is not None else None
+            split_data[key] = _gather_windows(npdata, split_indices[cat], offsets[name], out_path)
+    return split_data
 
+
+def _save_training_data(split_data, x_window, y_window, yaml_path, save_path, graph_pkl_filename=None):
     x_offsets = np.sort(
         # np.concatenate(([-week_size + 1, -day_size + 1], np.arange(-11, 1, 1)))
         np.concatenate((np.arange(-x_window, 1, 1),))
@@ -183,7 +360,7 @@ def generate_data_config_for_training(df, x_window=6, y_window=6, yaml_path=None
 
     os.makedirs(os.path.dirname(os.path.join(save_path, "train.npz")), exist_ok=True)
     for cat in ["train", "val", "test"]:
-        _x, _y = locals()["x_" + cat], locals()["y_" + cat]
+        _x, _y = split_data["x_" + cat], split_data["y_" + cat]
         print(cat, "x: ", _x.shape, "y:", _y.shape)
         np.savez_compressed(
             os.path.join(save_path, "%s.npz" % cat),
@@ -199,10 +376,122 @@ def generate_data_config_for_training(df, x_window=6, y_window=6, yaml_path=None
     # names['sensor_ids'] = df.drop(columns=[date_column]).columns.values.tolist()
     # with open('names.dict', 'wb') as f:
     #     pickle.dump(names, f)
-    generate_yaml(input_yaml=yaml_path, output_path=save_path, x_window=x_window, y_window=y_window)
+    generate_yaml(input_yaml=yaml_path, output_path=save_path, x_window=x_window, y_window=y_window,
+                  graph_pkl_filename=graph_pkl_filename)
     print()
 
 
+def _save_window_dataset(dataset, yaml_path, save_path, graph_pkl_filename=None):
+    os.makedirs(save_path, exist_ok=True)
+    dataset.save(os.path.join(save_path, 'window_dataset.npz'))
+    for cat in ['train', 'val', 'test']:
+        print(cat, 'windows: ', dataset.num_samples(cat))
+    generate_yaml(input_yaml=yaml_path, output_path=save_path, x_window=dataset.x_window, y_window=dataset.y_window,
+                  graph_pkl_filename=graph_pkl_filename)
+
+
+def generate_data_config_for_training(df, x_window=6, y_window=6, yaml_path=None, save_path=None,
+                                      date_column='date_observed',
+                                      split_rule='normal',
+                                      lazy=False,
+                                      dtype=None,
+                                      adjacency=None,
+                                      time_of_day=False,
+                                      time_index=None,
+                                      sensor_ids=None,
+                                      memmap_dir=None):
+    """
+    Generate the DCRNN training data (and config) of one window configuration
+
+    :param df: time series DataFrame, columned by stations and date_column,
+               or a (time, station, feature) tensor, e.g. AIRModel.build_tensor of several pollutants
+    :param x_window: input window length
+    :param y_window: output window length
+    :param yaml_path: DCRNN yaml template
+    :param save_path: output directory
+    :param date_column: name of the time column of df
+    :param split_rule: 'normal', 'shuffle' or '3week1week'
+    :param lazy: save a WindowDataset (data and window start indices) instead of the expanded windows
+    :param dtype: dtype of the windows, e.g. np.float32, the dtype of df by default
+    :param adjacency: sparse station adjacency saved as adj_mx.npz and as the DCRNN graph adj_mx.pkl
+                      (the graph_pkl_filename of the yaml), rows ordered as the stations of df
+    :param time_of_day: add the time of day as a last feature
+    :param time_index: time of each step of a tensor, needed by time_of_day
+    :param sensor_ids: stations of a tensor, needed by adjacency
+    :param memmap_dir: gather the windows into memory mapped files in this directory instead of memory,
+                       they are removed once train/val/test.npz are written
+    """
+    npdata = _prepare_npdata(df, date_column, dtype, time_of_day=time_of_day, time_index=time_index)
+
+    # NOTE: the station graph (e.g. services.spatial.gaussian_adjacency), rows ordered as the columns of df
+    graph_pkl_filename = None
+    if adjacency is not None:
+        _, pkl_path = save_adjacency(adjacency, _sensor_ids(df, date_column, sensor_ids), save_path)
+        graph_pkl_filename = os.path.basename(pkl_path)
+
+    # NOTE: store the matrix and the window start indices instead of every expanded window
+    if lazy:
+        dataset = WindowDataset.from_split_rule(npdata, x_window, y_window, split_rule)
+        _save_window_dataset(dataset, yaml_path, save_path, graph_pkl_filename)
+        return dataset
+
+    with _scratch_dir(memmap_dir) as scratch:
+        split_data = _split_windows(npdata, x_window, y_window, split_rule, memmap_dir=scratch)
+        _save_training_data(split_data, x_window, y_window, yaml_path, save_path, graph_pkl_filename)
+
+
+def generate_data_configs_for_training(df, specs, yaml_path=None, date_column='date_observed', max_workers=1,
+                                       dtype=None, adjacency=None, time_of_day=False, time_index=None,
+                                       sensor_ids=None, memmap_dir=None):
+    """
+    Generate the training data of several window configurations in one run
+    The station matrix is prepared once and shared by all the specs,
+    the windows are split in order (so 'shuffle' draws the same permutations as sequential calls)
+    and written by up to max_workers threads
+
+    :param df: time series DataFrame, columned by stations and date_column, or a (time, station, feature) tensor
+    :param specs: list of {'x_window': ..., 'y_window': ..., 'split_rule': ..., 'save_path': ..., 'lazy': False}
+    :param yaml_path: DCRNN yaml template
+    :param date_column: name of the time column
+    :param max_workers: number of outputs written at the same time
+    :param dtype: dtype of the windows, e.g. np.float32, the dtype of df by default
+    :param adjacency: sparse station adjacency saved as adj_mx.npz and adj_mx.pkl next to the outputs of each spec
+    :param time_of_day: see generate_data_config_for_training
+    :param time_index: see generate_data_config_for_training
+    :param sensor_ids: see generate_data_config_for_training
+    :param memmap_dir: see generate_data_config_for_training
+    """
+    npdata = _prepare_npdata(df, date_column, dtype, time_of_day=time_of_day, time_index=time_index)
+    graph_pkl_filename = None
+    if adjacency is not None:
+        sensor_ids = _sensor_ids(df, date_column, sensor_ids)
+        for spec in specs:
+            _, pkl_path = save_adjacency(adjacency, sensor_ids, spec['save_path'])
+            graph_pkl_filename = os.path.basename(pkl_path)
+
+    # NOTE: at most max_workers splits are kept in memory while they are being written
+    pending = deque()
+    with _scratch_dir(memmap_dir) as scratch, ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for i, spec in enumerate(specs):
+            x_window, y_window, split_rule = spec['x_window'], spec['y_window'], spec['split_rule']
+            if spec.get('lazy', False):
+                dataset = WindowDataset.from_split_rule(npdata, x_window, y_window, split_rule)
+                future = executor.submit(_save_window_dataset, dataset, yaml_path, spec['save_path'],
+                                         graph_pkl_filename)
+            else:
+                spec_scratch = os.path.join(scratch, str(i)) if scratch is not None else None
+                if spec_scratch is not None:
+                    os.makedirs(spec_scratch)
+                split_data = _split_windows(npdata, x_window, y_window, split_rule, memmap_dir=spec_scratch)
+                future = executor.submit(_save_training_data, split_data, x_window, y_window, yaml_path,
+                                         spec['save_path'], graph_pkl_filename)
+            pending.append(future)
+            if len(pending) >= max_workers:
+                pending.popleft().result()
+        for future in pending:
+            future.result()
+
+
 def generate_utah_data():
     df = pd.read_csv("../data/utah_purplar_air_pm25.csv", parse_dates=["date_observed"], infer_datetime_format=True)
     df.index = df.iloc[:, -1]
@@ -212,52 +501,41 @@ def generate_utah_data():
                                              save_path='../../DCRNN-master/data/UTAH-AQI_3week1week')
 
 
-from services.postgres_connection import Connection
-from services import timeseries_preprocess
-
-
-def generate_utah_data_from_database():
-    # con= Connection(host='128.125.184.132', database='air_quality_dev')
-    # df=con.read_as_dataframe(table_name='air_quality_data.utah_purple_air_ground_level_hourly', column_set=["station_id", "date_observed::TIMESTAMP WITHOUT TIME ZONE as date_observed", "value"], request_condition="where  date_observed >= '2017-11-01' and date_observed < '2018-06-01'")
-    # import pickle
-    # pickle.dump(df, open('utah_db_data_in_pd.pickle', 'wb'))
-
-    df = pickle.load(open('utah_db_data_in_pd.pickle', 'rb'))
+def generate_utah_data_from_database(max_workers=2):
+    """
+    :param max_workers: number of window configurations whose splits are held in memory (and written) at a time
+    """
+    # NOTE: the query result is cached locally, only the first run needs the database
+    con = Connection(host='128.125.184.132', database='air_quality_dev', cache=QueryCache('utah_query_cache'))
+    df = con.read_as_dataframe(table_name='air_quality_data.utah_purple_air_ground_level_hourly', column_set=["station_id", "date_observed::TIMESTAMP WITHOUT TIME ZONE as date_observed", "value"], request_condition="where  date_observed >= '2017-11-01' and date_observed < '2018-06-01'")
+    con.close_conn()
     df = time_series_data_constrution(df=df, key_col='station_id', time_col='date_observed', value_col='value')
-    # pickle.dump(df, open('utah_db_data_in_ts.pickle', 'wb'))
-    # df = pickle.load(open('utah_db_data_in_ts.pickle', 'rb'))
+    # save_time_series(df, 'utah_db_data_in_ts.arrow')
+    # df = load_time_series('utah_db_data_in_ts.arrow')
     # print(df.head())
 
     df = df[
         ['1', '2', '3', '10', '19', '20', '22', '23', '25', '26', '27', '28', '29', '30', '31', '32', '34', '35', '36',
          '37', '38', '40']]
+    save_time_series(df, '../../DCRNN-master/data/all_utah_data_df.arrow')
     df.reset_index(inplace=True)
-    pickle.dump(df, open('../../DCRNN-master/data/all_utah_data_df.pickle', 'wb'))
     # x, y = generate_x_y(df, window=6, save_path='../../DCRNN-master/data/UTAH-AQI_all_data', date_column='index')
-    generate_data_config_for_training(df, x_window=24, y_window=6, split_rule='normal',
-                                             save_path='../../DCRNN-master/data/UTAH-AQI_all_24_6_normal_split',
-                                             date_column='index',
-                                             yaml_path='../../DCRNN-master/data/dcrnn_utah_3week1week.yaml')
-
-    generate_data_config_for_training(df, x_window=24, y_window=6, split_rule='shuffle',
-                                             save_path='../../DCRNN-master/data/UTAH-AQI_all_24_6_shuffle_split',
-                                             date_column='index',
-                                             yaml_path='../../DCRNN-master/data/dcrnn_utah_3week1week.yaml')
-
-
-
-    generate_data_config_for_training(df, x_window=24, y_window=6, split_rule='3week1week',
-                                             save_path='../../DCRNN-master/data/UTAH-AQI_all_24_6_3week1week_split',
-                                             date_column='index',
-                                             yaml_path='../../DCRNN-master/data/dcrnn_utah_3week1week.yaml')
-    generate_data_config_for_training(df, x_window=24, y_window=24, split_rule='3week1week',
-                                             save_path='../../DCRNN-master/data/UTAH-AQI_all_24_24_3week1week_split',
-                                             date_column='index',
-                                             yaml_path='../../DCRNN-master/data/dcrnn_utah_3week1week.yaml')
-    generate_data_config_for_training(df, x_window=6, y_window=24, split_rule='3week1week',
-                                             save_path='../../DCRNN-master/data/UTAH-AQI_all_6_24_3week1week_split',
-                                             date_column='index',
-                                             yaml_path='../../DCRNN-master/data/dcrnn_utah_3week1week.yaml')
-
-
-generate_utah_data_from_database()
+    specs = [
+        {'x_window': 24, 'y_window': 6, 'split_rule': 'normal',
+         'save_path': '../../DCRNN-master/data/UTAH-AQI_all_24_6_normal_split'},
+        {'x_window': 24, 'y_window': 6, 'split_rule': 'shuffle',
+         'save_path': '../../DCRNN-master/data/UTAH-AQI_all_24_6_shuffle_split'},
+        {'x_window': 24, 'y_window': 6, 'split_rule': '3week1week',
+         'save_path': '../../DCRNN-master/data/UTAH-AQI_all_24_6_3week1week_split'},
+        {'x_window': 24, 'y_window': 24, 'split_rule': '3week1week',
+         'save_path': '../../DCRNN-master/data/UTAH-AQI_all_24_24_3week1week_split'},
+        {'x_window': 6, 'y_window': 24, 'split_rule': '3week1week',
+         'save_path': '../../DCRNN-master/data/UTAH-AQI_all_6_24_3week1week_split'},
+    ]
+    generate_data_configs_for_training(df, specs, date_column='index',
+                                       yaml_path='../../DCRNN-master/data/dcrnn_utah_3week1week.yaml',
+                                       max_workers=max_workers)
+
+
+if __name__ == '__main__':
+    generate_utah_data_from_database()
@@ -1,34 +1,43 @@
 from data_model.air_model import AIRModel
 from data_model.geo_model import GEOModel
-from services.postgres_connection import Connection
+from services.postgres_connection import Connection, ConnectionPool
+from services.query_cache import QueryCache
+from services.instrumentation import stage, stage_report
 
+# NOTE: stations removed because they are repeated/duplicated, for each parameter
+REMOVERS = {'pm25': [1, 2, 3, 23], 'pm10': [], 'o3': []}
 
-def los_angeles_epa_preprocess(feature_set, config):
 
-    conn = Connection(host='jonsnow.usc.edu', database='air_quality_dev')
+def los_angeles_epa_preprocess(feature_set, config, output_path=None):
+    """
+    :param output_path: directory of the stage report, defaults to config['output_path'], no report if None
+    """
     parameter_name = config['parameter_name']
-
-    air_quality_model = AIRModel(config, conn=conn)
-    locations = air_quality_model.air_quality_locations
-
-    # NOTE: Remove the stations because they are repeated/duplicated if they have
-    remover = []
-    if parameter_name == 'pm25':
-        remover = [1, 2, 3, 23]
-    elif parameter_name == 'pm10':
-        remover = []
-    elif parameter_name == 'o3':
-        remover = []
-    else:
-        exit(1)
-
-    # NOTE: Remove some repeated stations
-    air_quality_model.air_quality_locations = [x for x in locations if x not in remover]
-    air_quality_model.air_quality_time_series = \
-        air_quality_model.air_quality_time_series[air_quality_model.air_quality_locations]
-
-    geo_feature_model = GEOModel(locations, feature_set, config, conn=conn)
-
-    conn.close_conn()
-    print('EPA air quality data and geographic data construction finished.')
+    if parameter_name not in REMOVERS:
+        raise ValueError('Unknown parameter: {}'.format(parameter_name))
+    output_path = output_path or config.get('output_path')
+
+    with stage_report().tracing(trace_memory=config.get('trace_memory', False)):
+        with stage('los_angeles_epa_preprocess'):
+            conn = Connection(host='jonsnow.usc.edu', database='air_quality_dev',
+                              cache=QueryCache.from_config(config))
+            air_quality_model = AIRModel(config, conn=conn)
+            conn.close_conn()
+
+            # NOTE: Remove some repeated stations
+            air_quality_model.remove_stations(REMOVERS[parameter_name])
+            air_quality_model.build_time_series()
+
+            # NOTE: the geographic feature tables are fetched concurrently on a pool of 'max_connections'
+            pool = ConnectionPool(minconn=0, maxconn=config.get('max_connections', 8), host='jonsnow.usc.edu',
+                                  database='air_quality_dev', cache=QueryCache.from_config(config))
+            try:
+                geo_feature_model = GEOModel(air_quality_model.get_locations(), feature_set, config, conn=None,
+                                             pool=pool)
+            finally:
+                pool.close_all()
+            print('EPA air quality data and geographic data construction finished.')
+
+        if output_path:
+            stage_report().write(output_path, 'los_angeles_epa_preprocess_stages.json')
     return air_quality_model, geo_feature_model
@@ -0,0 +1,110 @@
+from data_model.air_model import AIRModel
+from data_model.geo_model import GEOModel
+from services.pipeline import Pipeline
+from services.postgres_connection import Connection, ConnectionPool
+from services.query_cache import QueryCache
+from services.timeseries_preprocess import time_series_construction1, time_series_smoothing
+
+
+def build_utah_pipeline(feature_set, config, remover, connection, smooth=False, min_duplicate_corr=0.8,
+                        pool=None, source=None):
+    """
+    fetch -> duplicate statistics -> remove stations and average duplicates -> construct -> (smooth) -> geo features
+    as stages of a services.pipeline.Pipeline, e.g. changing 'smoothing' only smooths the cached time series again
+
+    :param feature_set: geographic features
+    :param config: output of load_config, with an optional 'pipeline_cache' section
+    :param remover: stations always removed
+    :param connection: callable returning the Connection, only called by the stages that are not cached
+    :param smooth: add the smoothing stage, configured by the optional 'smoothing' section
+                   ({'window_size': ..., 'method': ..., 'n_sigmas': ...})
+    :param min_duplicate_corr: stations whose duplicates are less correlated are removed
+    :param pool: optional callable returning a ConnectionPool, the geo feature tables are then fetched concurrently
+                 on it instead of on the connection
+    :param source: identity of the database (e.g. {'host': ..., 'database': ...}), part of the keys of the stages
+                   fetching from it, so that the results fetched from another database are not reused
+    :return: a Pipeline
+    """
+    def fetch(config, source):
+        return AIRModel(config, conn=connection()).air_quality_df
+
+    def duplicate_statistics(config, air_quality_df):
+        model = AIRModel(config, None)
+        model.air_quality_df = air_quality_df
+        return model.get_duplicate_statistics()
+
+    def average(config, air_quality_df, duplicate_stats, remover, min_duplicate_corr):
+        model = AIRModel(config, None)
+        model.air_quality_df = air_quality_df
+        low_corr = duplicate_stats.index[duplicate_stats['corr'] < min_duplicate_corr]
+        model.remove_stations(list(remover) + list(low_corr))
+        model.average_duplicates()
+        return model
+
+    def construct(config, air_quality_model):
+        return time_series_construction1(air_quality_model.air_quality_df)
+
+    def smoothing(config, time_series):
+        return time_series_smoothing(time_series, **config.get('smoothing', {}))
+
+    def geo_features(config, air_quality_model, feature_set, source):
+        if pool is not None:
+            return GEOModel(air_quality_model.get_locations(), feature_set, config, conn=None, pool=pool())
+        return GEOModel(air_quality_model.get_locations(), feature_set, config, conn=connection())
+
+    pipeline = Pipeline.from_config(config)
+    pipeline.add('air_quality', fetch, config_keys=['air_quality'], params={'source': source})
+    pipeline.add('duplicate_statistics', duplicate_statistics, ['air_quality'], config_keys=['air_quality'])
+    pipeline.add('average_duplicates', average, ['air_quality', 'duplicate_statistics'], config_keys=['air_quality'],
+                 params={'remover': list(remover), 'min_duplicate_corr': min_duplicate_corr})
+    pipeline.add('time_series', construct, ['average_duplicates'])
+    if smooth:
+        pipeline.add('smoothing', smoothing, ['time_series'], config_keys=['smoothing'])
+    pipeline.add('geo_feature', geo_features, ['average_duplicates'], config_keys=['geo_feature'],
+                 params={'feature_set': list(feature_set), 'source': source})
+    return pipeline
+
+
+def run_utah_pipeline(feature_set, config, remover, smooth=False, host='localhost', port='5432', user='',
+                      password='', database='prisms'):
+    """
+    Run the stages of build_utah_pipeline, the database is only connected if a stage is not cached
+    The geo feature tables are fetched on a pool of 'max_connections' connections
+
+    :return: (AIRModel, GEOModel), the AIRModel time series is the smoothed one if smooth, None otherwise
+    """
+    conns, pools = [], []
+
+    def connection():
+        if not conns:
+            conns.append(Connection(host=host, port=port, user=user, password=password, database=database,
+                                    cache=QueryCache.from_config(config)))
+        return conns[0]
+
+    def pool():
+        if not pools:
+            # NOTE: the air quality stages are done, at most 'max_connections' connections are open at a time
+            for conn in conns:
+                conn.close_conn()
+            pools.append(ConnectionPool(minconn=0, maxconn=config.get('max_connections', 8), host=host, port=port,
+                                        user=user, password=password, database=database,
+                                        cache=QueryCache.from_config(config)))
+        return pools[0]
+
+    pipeline = build_utah_pipeline(feature_set, config, remover, connection, smooth=smooth, pool=pool,
+                                   source={'host': host, 'port': port, 'database': database})
+    try:
+        results = pipeline.run(config, ['average_duplicates', 'smoothing' if smooth else 'time_series',
+                                        'geo_feature'])
+    finally:
+        for conn in conns:
+            conn.close_conn()
+        for each_pool in pools:
+            each_pool.close_all()
+
+    air_quality_model = results['average_duplicates']
+    if smooth:
+        air_quality_model.time_series = results['smoothing']
+    else:
+        assert results['time_series'] is not None
+    return air_quality_model, results['geo_feature']
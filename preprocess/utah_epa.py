@@ -1,38 +1,76 @@
 from data_model.air_model import AIRModel
 from data_model.geo_model import GEOModel
-from services.utils import check_max_min_correlation
 from services.timeseries_preprocess import time_series_construction1
-from services.postgres_connection import Connection
+from services.postgres_connection import Connection, ConnectionPool
+from services.query_cache import QueryCache
+from services.instrumentation import stage, stage_report
+from preprocess.async_loading import load_models
+from preprocess.pipelines import run_utah_pipeline
 
 
-def utah_epa_preprocess(feature_set, config):
-    conn = Connection(host='jonsnow.usc.edu', database='air_quality_dev')
-    remover = [65, 67, 68]
+def utah_epa_preprocess(feature_set, config, output_path=None):
+    """
+    :param output_path: directory of the stage report, defaults to config['output_path'], no report if None
+    """
+    output_path = output_path or config.get('output_path')
+    # NOTE: 'trace_memory' adds the tracemalloc peak of each stage to the report, at some cost in speed
+    with stage_report().tracing(trace_memory=config.get('trace_memory', False)):
+        with stage('utah_epa_preprocess'):
+            remover = [65, 67, 68]
 
-    air_quality_model = AIRModel(config, conn=conn)
+            # NOTE: with 'pipeline_cache', each stage result is cached on disk and a config change only runs again
+            #       the stages reading the changed sections and the ones downstream of them
+            if config.get('pipeline_cache'):
+                air_quality_model, geo_feature_model = run_utah_pipeline(feature_set, config, remover,
+                                                                         host='jonsnow.usc.edu',
+                                                                         database='air_quality_dev')
+            else:
+                air_quality_model, geo_feature_model = _utah_epa_models(feature_set, config, remover)
+            print('Utah EPA air quality data and geographic data construction finished.')
+
+        if output_path:
+            stage_report().write(output_path, 'utah_epa_preprocess_stages.json')
+    return air_quality_model, geo_feature_model
+
+
+def _utah_epa_models(feature_set, config, remover):
+    # NOTE: with 'async_backend', the geo feature tables are fetched concurrently on an asyncpg pool
+    if config.get('async_backend', False):
+        conn = None
+        air_quality_model, geo_feature_model = load_models(feature_set, config, host='jonsnow.usc.edu',
+                                                           database='air_quality_dev',
+                                                           cache=QueryCache.from_config(config))
+    else:
+        conn = Connection(host='jonsnow.usc.edu', database='air_quality_dev',
+                          cache=QueryCache.from_config(config))
+        air_quality_model = AIRModel(config, conn=conn)
+        # NOTE: closed before the pool is opened, at most 'max_connections' connections are open at a time
+        conn.close_conn()
 
     # NOTE: Utah PurpleAir data have duplicates for each pair [Station, Date_observed]
     # NOTE: 1. check the duplicates if the duplicates would effect (too different btw duplicates)
-    max_min_corr_dic = check_max_min_correlation(air_quality_model.air_quality_df, air_quality_model.get_locations(),
-                                                 key_col='station_id', time_col='date_observed')
+    duplicate_stats = air_quality_model.get_duplicate_statistics()
 
     #       2. remove the stations that correlation of the values is low
-    for k in max_min_corr_dic:
-        if max_min_corr_dic[k] < 0.8:
-            remover.append(k)
+    remover.extend(duplicate_stats.index[duplicate_stats['corr'] < 0.8])
     air_quality_model.remove_stations(remover)
 
     #       3. take the mean of the duplicates for the rest of the stations
-    air_quality_model.air_quality_df = air_quality_model.air_quality_df.groupby(['station_id', 'date_observed']).mean()
-    air_quality_model.air_quality_df.reset_index(inplace=True)
+    air_quality_model.average_duplicates()
     time_series = time_series_construction1(air_quality_model.air_quality_df)
 
     assert time_series is not None
 
     # NOTE: Get the geographic features
-    geo_feature_model = GEOModel(air_quality_model.get_locations(), feature_set, config, conn=conn)
-
-    conn.close_conn()
-    print('Utah EPA air quality data and geographic data construction finished.')
+    if conn is None:
+        geo_feature_model.select_locations(air_quality_model.get_locations())
+    else:
+        # NOTE: the geographic feature tables are fetched concurrently on a pool of 'max_connections'
+        pool = ConnectionPool(minconn=0, maxconn=config.get('max_connections', 8), host='jonsnow.usc.edu',
+                              database='air_quality_dev', cache=QueryCache.from_config(config))
+        try:
+            geo_feature_model = GEOModel(air_quality_model.get_locations(), feature_set, config, conn=None,
+                                         pool=pool)
+        finally:
+            pool.close_all()
     return air_quality_model, geo_feature_model
-
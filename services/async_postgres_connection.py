@@ -0,0 +1,173 @@
+import asyncio
+import io
+import re
+
+import pandas as pd
+
+from services.postgres_connection import build_select
+
+try:
+    import asyncpg
+except ImportError:  # NOTE: only needed to open a pool with AsyncConnection.connect
+    asyncpg = None
+
+
+_PLACEHOLDER = re.compile(r'%(s|%)')
+
+
+def to_asyncpg_sql(sql, params):
+    """
+    Rewrite the psycopg2 placeholders of build_select for asyncpg, '%s' -> '$1', '$2', ... and '%%' -> '%'
+    Like psycopg2, the placeholders are only interpreted if there are parameters
+
+    :return: (sql, list of parameters)
+    """
+    if params is None:
+        return sql, []
+    count = [0]
+
+    def replace(match):
+        if match.group(1) == '%':
+            return '%'
+        count[0] += 1
+        return '${}'.format(count[0])
+
+    return _PLACEHOLDER.sub(replace, sql), list(params)
+
+
+class AsyncConnection:
+
+    def __init__(self, pool, cache=None):
+        """
+        Asyncio counterpart of services.postgres_connection.Connection, with the same read API as coroutines
+        Every read acquires its own connection of the pool, so reads gathered together run concurrently
+
+        :param pool: an asyncpg pool, or any object with the same acquire() / close() API (e.g. a test stub)
+        :param cache: optional services.query_cache.QueryCache, shared with Connection (same keys)
+        """
+        self._pool = pool
+        self._cache = cache
+        get_max_size = getattr(pool, 'get_max_size', None)
+        self.maxconn = get_max_size() if get_max_size is not None else None
+
+    @classmethod
+    async def connect(cls, host='localhost', port='5432', user='', password='', database='prisms', min_size=1,
+                      max_size=8, cache=None):
+        if asyncpg is None:
+            raise ImportError('AsyncConnection.connect requires asyncpg')
+        pool = await asyncpg.create_pool(host=host, port=int(port), user=user or None, password=password or None,
+                                         database=database, min_size=min_size, max_size=max_size)
+        return cls(pool, cache=cache)
+
+    async def _fetch_dataframe(self, sql, params):
+        async with self._pool.acquire() as conn:
+            sql, params = to_asyncpg_sql(sql, params)
+            statement = await conn.prepare(sql)
+            records = await statement.fetch(*params)
+            columns = [attribute.name for attribute in statement.get_attributes()]
+        return pd.DataFrame([tuple(record) for record in records], columns=columns)
+
+    async def _read_cached(self, table_name, sql, params):
+        loop = asyncio.get_running_loop()
+        key = self._cache.key(table_name, sql, params)
+        df = await loop.run_in_executor(None, self._cache.get, key)
+        if df is None:
+            df = await self._fetch_dataframe(sql, params)
+            await loop.run_in_executor(None, self._cache.put, key, df)
+        return df
+
+    async def read(self, table_name, column_set, request_condition='', **select_args):
+        sql, params = build_select(table_name, column_set, request_condition, **select_args)
+        if self._cache is not None:
+            df = await self._read_cached(table_name, sql, params)
+            return list(df.itertuples(index=False, name=None))
+        return await self.execute_wi_return(sql, params)
+
+    async def read_as_dataframe(self, table_name, column_set, request_condition='', **select_args):
+        sql, params = build_select(table_name, column_set, request_condition, **select_args)
+        if self._cache is not None:
+            return await self._read_cached(table_name, sql, params)
+        return await self._fetch_dataframe(sql, params)
+
+    async def read_chunks(self, table_name, column_set, request_condition='', chunk_size=50000, columns=None,
+                          **select_args):
+        """
+        Stream the query result through a server-side cursor, see Connection.read_chunks (and its caching)
+
+        :return: an async generator of DataFrames
+        """
+        sql, params = build_select(table_name, column_set, request_condition, **select_args)
+        loop = asyncio.get_running_loop()
+        key = self._cache.key(table_name, sql, params) if self._cache is not None else None
+        cached = await loop.run_in_executor(None, self._cache.get, key) if key is not None else None
+        if cached is not None:
+            for start in range(0, len(cached), chunk_size):
+                chunk = cached.iloc[start: start + chunk_size].reset_index(drop=True)
+                yield chunk if columns is None else chunk.set_axis(columns, axis=1)
+            return
+
+        chunks = []
+        async with self._pool.acquire() as conn:
+            # NOTE: cursors only live inside a transaction
+            async with conn.transaction():
+                asyncpg_sql, asyncpg_params = to_asyncpg_sql(sql, params)
+                statement = await conn.prepare(asyncpg_sql)
+                names = [attribute.name for attribute in statement.get_attributes()]
+                cursor = await statement.cursor(*asyncpg_params)
+                while True:
+                    records = await cursor.fetch(chunk_size)
+                    if not records:
+                        break
+                    # NOTE: cached under the names of the statement, the same entry as read_as_dataframe
+                    chunk = pd.DataFrame([tuple(record) for record in records], columns=names)
+                    if key is not None:
+                        chunks.append(chunk)
+                    yield chunk if columns is None else chunk.set_axis(columns, axis=1)
+        if key is not None:
+            df = pd.concat(chunks, ignore_index=True) if chunks else pd.DataFrame(columns=names)
+            await loop.run_in_executor(None, self._cache.put, key, df)
+
+    async def copy_as_dataframe(self, table_name, column_set, request_condition='', columns=None, dtype=None,
+                                parse_dates=None, **select_args):
+        """
+        Bulk export the query result with COPY ... TO STDOUT, see Connection.copy_as_dataframe (and its caching)
+
+        :return: a DataFrame of the query result
+        """
+        sql, params = build_select(table_name, column_set, request_condition, **select_args)
+        if self._cache is None:
+            return await self._copy_as_dataframe(sql, params, columns, dtype, parse_dates)
+
+        # NOTE: the same key as Connection.copy_as_dataframe
+        loop = asyncio.get_running_loop()
+        key = self._cache.key(table_name, 'copy ({}) to stdout with csv header'.format(sql),
+                              [params, columns, dtype, parse_dates])
+        df = await loop.run_in_executor(None, self._cache.get, key)
+        if df is None:
+            df = await self._copy_as_dataframe(sql, params, columns, dtype, parse_dates)
+            await loop.run_in_executor(None, self._cache.put, key, df)
+        return df
+
+    async def _copy_as_dataframe(self, sql, params, columns, dtype, parse_dates):
+        sql, params = to_asyncpg_sql(sql, params)
+        buffer = io.BytesIO()
+        async with self._pool.acquire() as conn:
+            await conn.copy_from_query(sql, *params, output=buffer, format='csv', header=True)
+
+        buffer.seek(0)
+        if columns is None:
+            return pd.read_csv(buffer, dtype=dtype, parse_dates=parse_dates)
+        return pd.read_csv(buffer, header=0, names=columns, dtype=dtype, parse_dates=parse_dates)
+
+    async def execute_wi_return(self, sql, params=None):
+        sql, params = to_asyncpg_sql(sql, params)
+        async with self._pool.acquire() as conn:
+            records = await conn.fetch(sql, *params)
+        return [tuple(record) for record in records]
+
+    async def execute_wo_return(self, sql):
+        async with self._pool.acquire() as conn:
+            await conn.execute(sql)
+
+    async def close_conn(self):
+        await self._pool.close()
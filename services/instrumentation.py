@@ -0,0 +1,194 @@
+import datetime
+import functools
+import json
+import os
+import sys
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+import numpy as np
+import pandas as pd
+
+try:
+    import resource
+except ImportError:  # NOTE: not available on Windows, max RSS is then not reported
+    resource = None
+
+_MB = 2 ** 20
+
+
+def _max_rss():
+    """
+    :return: high water mark of the resident memory of the process in bytes, or None
+    """
+    if resource is None:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # NOTE: ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    return max_rss if sys.platform == 'darwin' else max_rss * 1024
+
+
+def _num_rows(obj):
+    if isinstance(obj, (pd.DataFrame, pd.Series, np.ndarray, list)):
+        return len(obj)
+    if hasattr(obj, 'shape'):
+        return obj.shape[0]
+    return None
+
+
+class StageReport:
+
+    def __init__(self):
+        """
+        Records of the instrumented stages, in the order they finished
+        Each record has the wall time, rows in and out, and the growth of the max RSS of the stage,
+        plus its tracemalloc peak when tracing is on
+        Stages are only recorded inside a tracing() scope, so library use of the models does not accumulate records
+        """
+        self.stages = []
+        self.active = False
+        self._stack = []
+        self._started = None
+        self._traced_by_report = False
+
+    def reset(self, trace_memory=False):
+        """
+        Drop the previous records
+
+        :param trace_memory: start tracemalloc to report the peak Python heap of each stage (slower)
+        """
+        self.stages = []
+        self._stack = []
+        self._started = time.time()
+        if trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._traced_by_report = True
+
+    @contextmanager
+    def tracing(self, trace_memory=False):
+        """
+        Record the stages run inside the scope, the previous records are dropped (see reset)
+        The records are kept once the scope exits, until the next reset
+
+        :param trace_memory: see reset
+        :return: the report
+        """
+        self.reset(trace_memory=trace_memory)
+        self.active = True
+        try:
+            yield self
+        finally:
+            self.active = False
+            self.stop_tracing()
+
+    def stop_tracing(self):
+        """
+        Stop tracemalloc if it was started by reset
+        """
+        if self._traced_by_report:
+            tracemalloc.stop()
+            self._traced_by_report = False
+
+    def to_dict(self):
+        return {'started': datetime.datetime.fromtimestamp(self._started).isoformat() if self._started else None,
+                'max_rss_mb': _max_rss() / _MB if _max_rss() is not None else None,
+                'stages': self.stages}
+
+    def write(self, output_path, file_name='stage_report.json'):
+        """
+        Write the report as JSON and stop the tracing started by reset
+
+        :param output_path: output directory of the pipeline
+        :param file_name: name of the report file
+        :return: path of the report
+        """
+        self.stop_tracing()
+        os.makedirs(output_path, exist_ok=True)
+        report_path = os.path.join(output_path, file_name)
+        with open(report_path, 'w') as f:
+            json.dump(self.to_dict(), f, indent=2, default=str)
+        return report_path
+
+    def _update_traced_peaks(self):
+        # NOTE: a nested stage resets the tracemalloc peak, so the enclosing stages keep their own running peak
+        peak = tracemalloc.get_traced_memory()[1]
+        for record in self._stack:
+            record['_traced_peak'] = max(record['_traced_peak'], peak)
+
+    @contextmanager
+    def stage(self, name, rows_in=None):
+        """
+        Instrument a block, the caller may set record['rows_out']
+        The record is only kept in the report inside a tracing() scope
+
+        :param name: stage name, e.g. 'air_quality.fetch'
+        :param rows_in: number of input rows
+        :return: the record of the stage
+        """
+        record = {'stage': name, 'parent': self._stack[-1]['stage'] if self._stack else None,
+                  'rows_in': rows_in, 'rows_out': None}
+        tracing = tracemalloc.is_tracing()
+        if tracing:
+            self._update_traced_peaks()
+            tracemalloc.reset_peak()
+            record['_traced_start'] = record['_traced_peak'] = tracemalloc.get_traced_memory()[0]
+        max_rss = _max_rss()
+        self._stack.append(record)
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record['seconds'] = time.perf_counter() - start
+            if tracing and tracemalloc.is_tracing():
+                self._update_traced_peaks()
+                record['tracemalloc_peak_mb'] = (record['_traced_peak'] - record['_traced_start']) / _MB
+            for key in ['_traced_start', '_traced_peak']:
+                record.pop(key, None)
+            if max_rss is not None:
+                record['max_rss_growth_mb'] = (_max_rss() - max_rss) / _MB
+            self._stack.pop()
+            if self.active:
+                self.stages.append(record)
+
+
+# NOTE: the process-wide report, the preprocess entry points trace and write it
+_report = StageReport()
+
+
+def stage_report():
+    return _report
+
+
+def stage(name, rows_in=None):
+    """
+    Context manager recording a stage in the process-wide report, see StageReport.stage
+    """
+    return _report.stage(name, rows_in=rows_in)
+
+
+def instrumented(name, rows_in=None, rows_out=None):
+    """
+    Decorator recording each call of a function as a stage
+
+    :param name: stage name
+    :param rows_in: callable(*args, **kwargs) -> number of input rows,
+                    defaults to the length of the first DataFrame / array argument
+    :param rows_out: callable(result, *args, **kwargs) -> number of output rows, defaults to the length of the result
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _report.active:
+                return func(*args, **kwargs)
+            if rows_in is not None:
+                num_rows_in = rows_in(*args, **kwargs)
+            else:
+                num_rows_in = next((_num_rows(arg) for arg in args if _num_rows(arg) is not None), None)
+            with _report.stage(name, rows_in=num_rows_in) as record:
+                result = func(*args, **kwargs)
+                record['rows_out'] = rows_out(result, *args, **kwargs) if rows_out is not None \
+                    else _num_rows(result)
+            return result
+        return wrapper
+    return decorator
@@ -0,0 +1,163 @@
+import hashlib
+import inspect
+import json
+import os
+import pickle
+from collections import OrderedDict
+
+from services.instrumentation import stage
+
+
+def _func_name(func):
+    return '{}.{}'.format(getattr(func, '__module__', None), getattr(func, '__qualname__', repr(func)))
+
+
+def _code_digest(code, digest):
+    digest.update(code.co_code)
+    digest.update(repr(code.co_names).encode())
+    for const in code.co_consts:
+        if inspect.iscode(const):
+            # NOTE: the repr of a nested function code has its address, hash its code instead
+            _code_digest(const, digest)
+        elif isinstance(const, frozenset):
+            # NOTE: the order of a frozenset depends on the hash seed of the process
+            digest.update(repr(sorted(const, key=repr)).encode())
+        else:
+            digest.update(repr(const).encode())
+
+
+def _func_code(func):
+    """
+    :param func: stage function
+    :return: hash of the bytecode and constants of func, so that editing its body changes the key of the stage.
+             The functions it calls are not hashed, bump the stage version when they change
+    """
+    code = getattr(inspect.unwrap(func), '__code__', None)
+    if code is None:
+        return None
+    digest = hashlib.sha1()
+    _code_digest(code, digest)
+    return digest.hexdigest()
+
+
+class Pipeline:
+
+    def __init__(self, cache_dir=None):
+        """
+        DAG of preprocessing stages whose results are cached on disk
+        The key of a stage hashes its function (name and code), its params, the config sections it reads and the keys of its inputs,
+        so a config change only runs again the stages reading the changed sections and the stages downstream of them
+
+        :param cache_dir: directory of the cached results (one pickle per stage and key), nothing is cached if None
+        """
+        self._stages = OrderedDict()
+        self._cache_dir = cache_dir
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        Create the pipeline from the optional 'pipeline_cache' section of a config
+
+        :param config: {'pipeline_cache': {'cache_dir': ...}}
+        :return: a Pipeline, caching nothing if the config has no 'pipeline_cache' section
+        """
+        cache_config = config.get('pipeline_cache') or {}
+        return cls(cache_config.get('cache_dir'))
+
+    def add(self, name, func, inputs=(), config_keys=(), params=None, version=None):
+        """
+        Add a stage, called as func(config, *input results, **params), where config only has the config_keys sections
+        Inputs must be added before, so the stages are always in topological order
+
+        :param name: stage name
+        :param func: stage function, its result must be picklable
+        :param inputs: names of the stages whose results are passed to func
+        :param config_keys: top level config sections read by func
+        :param params: keyword arguments of func, JSON serializable as they are part of the key
+        :param version: bump it to invalidate the cached results when a function called by func changes,
+                        changes of the body of func already change the key
+        :return: the pipeline
+        """
+        if name in self._stages:
+            raise ValueError('Duplicate stage: {}'.format(name))
+        unknown = [i for i in inputs if i not in self._stages]
+        if unknown:
+            raise ValueError('Unknown inputs of stage {}: {}'.format(name, unknown))
+        self._stages[name] = {'func': func, 'inputs': list(inputs), 'config_keys': list(config_keys),
+                              'params': dict(params or {}), 'version': version}
+        return self
+
+    def _sinks(self):
+        used = {i for s in self._stages.values() for i in s['inputs']}
+        return [name for name in self._stages if name not in used]
+
+    @staticmethod
+    def _config_slice(config, config_keys):
+        # NOTE: missing sections are left out, stages fall back to their defaults
+        return {key: config[key] for key in config_keys if key in config}
+
+    def keys(self, config):
+        """
+        :param config: output of load_config
+        :return: {stage name: key of its result under this config}
+        """
+        keys = {}
+        for name, s in self._stages.items():
+            payload = {'stage': name, 'func': _func_name(s['func']), 'code': _func_code(s['func']),
+                       'version': s['version'], 'params': s['params'],
+                       'config': self._config_slice(config, s['config_keys']),
+                       'inputs': [keys[i] for i in s['inputs']]}
+            keys[name] = hashlib.sha1(json.dumps(payload, sort_keys=True, default=str).encode()).hexdigest()
+        return keys
+
+    def _path(self, name, key):
+        return os.path.join(self._cache_dir, '{}-{}.pkl'.format(name, key))
+
+    def _cached(self, name, key):
+        return self._cache_dir is not None and os.path.exists(self._path(name, key))
+
+    def _load(self, name, key):
+        with open(self._path(name, key), 'rb') as f:
+            return pickle.load(f)
+
+    def _save(self, name, key, result):
+        if self._cache_dir is None:
+            return
+        path = self._path(name, key)
+        # NOTE: written then renamed, so that concurrent runs never read a partial file
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(result, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+
+    def run(self, config, targets=None):
+        """
+        Evaluate the targets, a cached stage is loaded without evaluating (or loading) its inputs
+
+        :param config: output of load_config
+        :param targets: names of the stages to evaluate, the stages without dependents by default
+        :return: {target: result}
+        """
+        keys = self.keys(config)
+        results = {}
+
+        def evaluate(name):
+            if name in results:
+                return results[name]
+            s = self._stages[name]
+            if self._cached(name, keys[name]):
+                with stage('pipeline.' + name) as record:
+                    result = self._load(name, keys[name])
+                    record['cached'] = True
+            else:
+                inputs = [evaluate(i) for i in s['inputs']]
+                with stage('pipeline.' + name) as record:
+                    result = s['func'](self._config_slice(config, s['config_keys']), *inputs, **s['params'])
+                    record['cached'] = False
+                self._save(name, keys[name], result)
+            results[name] = result
+            return result
+
+        return {name: evaluate(name) for name in (targets or self._sinks())}
@@ -1,36 +1,215 @@
+import io
+import re
+from contextlib import contextmanager
+
 import psycopg2
+import psycopg2.pool
+import numpy as np
 import pandas as pd
 
+
+_IDENTIFIER = re.compile(r'^[A-Za-z_][A-Za-z0-9_$]*(\.[A-Za-z_][A-Za-z0-9_$]*)*$')
+
+
+def _check_identifier(name):
+    if not _IDENTIFIER.match(name):
+        raise ValueError('Invalid SQL identifier: {}'.format(name))
+    return name
+
+
+def _to_sql_value(value):
+    # NOTE: psycopg2 cannot adapt numpy scalars (e.g. station ids taken out of a DataFrame)
+    return value.item() if hasattr(value, 'item') else value
+
+
+def build_select(table_name, column_set, request_condition='', params=None, filters=None, distinct=False,
+                 conditions=None, group_by=None):
+    """
+    Build a parameterized select query, values are never formatted into the SQL string
+
+    :param table_name: table to read from, optionally schema qualified
+    :param column_set: column expressions to select
+    :param request_condition: where clause, may contain %s placeholders bound by params
+    :param params: values of the placeholders in request_condition
+    :param filters: {column: value}, a list-like value is sent as "column = ANY(%s)"
+    :param distinct: select distinct rows
+    :param conditions: additional SQL predicates (without placeholders), and-ed with the request condition
+    :param group_by: group by expressions (or select list positions)
+    :return: (sql, params), params is None if there is nothing to bind
+    """
+    conditions = list(conditions or [])
+    query_params = list(params or [])
+
+    request_condition = request_condition.strip()
+    if request_condition[:5].lower() == 'where':
+        request_condition = request_condition[5:].strip()
+    if request_condition:
+        conditions.insert(0, '({})'.format(request_condition))
+
+    for column, value in (filters or {}).items():
+        _check_identifier(column)
+        if isinstance(value, (list, tuple, set, np.ndarray, pd.Index, pd.Series)):
+            conditions.append('{} = ANY(%s)'.format(column))
+            query_params.append([_to_sql_value(v) for v in value])
+        else:
+            conditions.append('{} = %s'.format(column))
+            query_params.append(_to_sql_value(value))
+
+    sql = 'select {distinct}{columns} from {table}'.format(distinct='distinct ' if distinct else '',
+                                                           columns=','.join(column_set),
+                                                           table=_check_identifier(table_name))
+    if conditions:
+        sql += ' where ' + ' and '.join(conditions)
+    if group_by:
+        sql += ' group by ' + ','.join(str(expression) for expression in group_by)
+    return sql, query_params or None
+
+
 class Connection:
 
-    def __init__(self, host='localhost', port='5432', user='', password='', database='prisms'):
+    def __init__(self, host='localhost', port='5432', user='', password='', database='prisms', conn=None,
+                 cache=None):
+        # NOTE: an already opened psycopg2 connection (e.g. from ConnectionPool) can be wrapped directly
+        self._conn = conn
+        self._connect_args = dict(host=host, port=port, user=user, password=password, database=database)
+        self._cache = cache
+        self.sql = ''
+        self._cursor_count = 0
+
+        # NOTE: with a services.query_cache.QueryCache, the database is only connected on the first cache miss
+        if self._conn is None and self._cache is None:
+            self._connect()
+
+    def _connect(self):
         try:
-            self._conn = psycopg2.connect(host=host, port=port, user=user, password=password, database=database)
-            self.sql = ''
+            self._conn = psycopg2.connect(**self._connect_args)
         except:
             print("Database connection failed!")
             exit(1)
 
-    def read(self, table_name, column_set, request_condition=''):
-        sql = 'select {columns} from {table} {where}'\
-            .format(columns=','.join(column_set), table=table_name, where=request_condition)
-        res = self.execute_wi_return(sql)
+    def _read_cached(self, table_name, sql, params):
+        key = self._cache.key(table_name, sql, params)
+        df = self._cache.get(key)
+        if df is None:
+            df = pd.read_sql(sql, con=self.get_conn(), params=params)
+            self._cache.put(key, df)
+        return df
+
+    def read(self, table_name, column_set, request_condition='', **select_args):
+        sql, params = build_select(table_name, column_set, request_condition, **select_args)
+        if self._cache is not None:
+            df = self._read_cached(table_name, sql, params)
+            return list(df.itertuples(index=False, name=None))
+        res = self.execute_wi_return(sql, params)
         return res
 
-    def read_as_dataframe(self,  table_name, column_set, request_condition=''):
-        sql = 'select {columns} from {table} {where}'\
-            .format(columns=','.join(column_set), table=table_name, where=request_condition)
-        df=pd.read_sql(sql, con=self._conn)
+    def read_as_dataframe(self, table_name, column_set, request_condition='', **select_args):
+        sql, params = build_select(table_name, column_set, request_condition, **select_args)
+        if self._cache is not None:
+            return self._read_cached(table_name, sql, params)
+        df = pd.read_sql(sql, con=self.get_conn(), params=params)
+        return df
+
+    def read_chunks(self, table_name, column_set, request_condition='', chunk_size=50000, columns=None,
+                    **select_args):
+        """
+        Stream the query result through a named (server-side) cursor
+        Only chunk_size rows are transferred from the server and held in memory at a time
+        With a query cache, a hit is yielded in chunks of the cached result, a miss is streamed and kept
+        for the cache once exhausted (so the whole result is held in memory in that case)
+
+        :param table_name: table to read from
+        :param column_set: columns to select
+        :param request_condition: where clause
+        :param chunk_size: number of rows fetched per round trip
+        :param columns: column names of the yielded DataFrames, defaults to the names of the cursor
+        :param select_args: params, filters, distinct, conditions and group_by of build_select
+        :return: a generator of DataFrames
+        """
+        sql, params = build_select(table_name, column_set, request_condition, **select_args)
+        key = self._cache.key(table_name, sql, params) if self._cache is not None else None
+        cached = self._cache.get(key) if key is not None else None
+        if cached is not None:
+            for start in range(0, len(cached), chunk_size):
+                chunk = cached.iloc[start: start + chunk_size].reset_index(drop=True)
+                yield chunk if columns is None else chunk.set_axis(columns, axis=1)
+            return
+
+        self._cursor_count += 1
+        # NOTE: named cursors only live inside a transaction, the read is committed once exhausted
+        cur = self.get_conn().cursor(name='read_chunks_{}'.format(self._cursor_count))
+        cur.itersize = chunk_size
+        chunks = []
+        try:
+            cur.execute(sql, params)
+            while True:
+                rows = cur.fetchmany(chunk_size)
+                if not rows:
+                    break
+                # NOTE: cached under the names of the cursor, the same entry as read_as_dataframe
+                chunk = pd.DataFrame(rows, columns=[desc[0] for desc in cur.description])
+                if key is not None:
+                    chunks.append(chunk)
+                yield chunk if columns is None else chunk.set_axis(columns, axis=1)
+            if key is not None:
+                self._cache.put(key, pd.concat(chunks, ignore_index=True) if chunks else
+                                pd.DataFrame(columns=[desc[0] for desc in cur.description]))
+        finally:
+            cur.close()
+            self.get_conn().commit()
+
+    def copy_as_dataframe(self, table_name, column_set, request_condition='', columns=None, dtype=None,
+                          parse_dates=None, **select_args):
+        """
+        Bulk export the query result with COPY ... TO STDOUT and parse the CSV buffer into typed columns
+        This skips the per-row tuple conversion of the cursor, which dominates reading large tables
+        With a query cache, the parsed result is cached (keyed by the query and the parsing arguments)
+
+        :param table_name: table to read from
+        :param column_set: columns to select
+        :param request_condition: where clause
+        :param columns: column names of the returned DataFrame, defaults to the exported header
+        :param dtype: {column: dtype} passed to pandas.read_csv
+        :param parse_dates: columns to parse as timestamps
+        :param select_args: params, filters, distinct, conditions and group_by of build_select
+        :return: a DataFrame of the query result
+        """
+        sql, params = build_select(table_name, column_set, request_condition, **select_args)
+        copy_sql = 'copy ({}) to stdout with csv header'
+        if self._cache is None:
+            return self._copy_as_dataframe(copy_sql.format(sql), params, columns, dtype, parse_dates)
+
+        # NOTE: parsed by read_csv rather than read_sql, so not the same entry as read_as_dataframe
+        key = self._cache.key(table_name, copy_sql.format(sql), [params, columns, dtype, parse_dates])
+        df = self._cache.get(key)
+        if df is None:
+            df = self._copy_as_dataframe(copy_sql.format(sql), params, columns, dtype, parse_dates)
+            self._cache.put(key, df)
         return df
 
+    def _copy_as_dataframe(self, sql, params, columns, dtype, parse_dates):
+        buffer = io.StringIO()
+        cur = self.get_conn().cursor()
+        try:
+            # NOTE: COPY does not take parameters, bind them on the client side
+            cur.copy_expert(cur.mogrify(sql, params).decode(), buffer)
+        finally:
+            cur.close()
+
+        buffer.seek(0)
+        if columns is None:
+            return pd.read_csv(buffer, dtype=dtype, parse_dates=parse_dates)
+        return pd.read_csv(buffer, header=0, names=columns, dtype=dtype, parse_dates=parse_dates)
 
     def get_conn(self):
+        if self._conn is None:
+            self._connect()
         return self._conn
 
-    def execute_wi_return(self, sql):
-        cur = self._conn.cursor()
+    def execute_wi_return(self, sql, params=None):
+        cur = self.get_conn().cursor()
         try:
-            cur.execute(sql)
+            cur.execute(sql, params)
             res = cur.fetchall()
             cur.close()
             return res
@@ -41,10 +220,10 @@ class Connection:
             cur.close()
 
     def execute_wo_return(self, sql):
-        cur = self._conn.cursor()
+        cur = self.get_conn().cursor()
         try:
             cur.execute(sql)
-            self._conn.commit()
+            self.get_conn().commit()
             cur.close()
         except ConnectionError:
             print('SQL {} execution Fails.'.format(sql))
@@ -53,7 +232,41 @@ class Connection:
             cur.close()
 
     def close_conn(self):
-        self._conn.close()
+        if self._conn is not None:
+            self._conn.close()
 
 
+class ConnectionPool:
+
+    def __init__(self, minconn=1, maxconn=8, host='localhost', port='5432', user='', password='',
+                 database='prisms', cache=None):
+        self._cache = cache
+        try:
+            self._pool = psycopg2.pool.ThreadedConnectionPool(minconn, maxconn, host=host, port=port, user=user,
+                                                              password=password, database=database)
+            self.maxconn = maxconn
+        except:
+            print("Database connection pool creation failed!")
+            exit(1)
+
+    def get_conn(self):
+        """
+        Take a connection out of the pool, it should be given back with put_conn
+
+        :return: a Connection wrapping the pooled connection
+        """
+        return Connection(conn=self._pool.getconn(), cache=self._cache)
+
+    def put_conn(self, conn):
+        self._pool.putconn(conn.get_conn())
+
+    @contextmanager
+    def connection(self):
+        conn = self.get_conn()
+        try:
+            yield conn
+        finally:
+            self.put_conn(conn)
 
+    def close_all(self):
+        self._pool.closeall()
@@ -0,0 +1,104 @@
+import hashlib
+import json
+import os
+import time
+
+import pandas as pd
+
+
+class QueryCache:
+
+    def __init__(self, cache_dir, ttl=None, max_size=None):
+        """
+        Local cache of query results, stored as one Parquet file per query
+        The file mtime is the time the entry was written (for the TTL), the atime is the last hit (for the LRU)
+
+        :param cache_dir: directory of the cache files
+        :param ttl: seconds before an entry expires, never expires if None
+        :param max_size: max total size of the cache in bytes, least recently used entries are evicted first
+        """
+        self._cache_dir = cache_dir
+        self._ttl = ttl
+        self._max_size = max_size
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        Create the cache from the optional 'query_cache' section of a config
+
+        :param config: {'query_cache': {'cache_dir': ..., 'ttl': ..., 'max_size': ...}}
+        :return: a QueryCache, or None if the config has no 'query_cache' section
+        """
+        cache_config = config.get('query_cache')
+        if not cache_config:
+            return None
+        return cls(cache_config['cache_dir'], ttl=cache_config.get('ttl'), max_size=cache_config.get('max_size'))
+
+    def key(self, table_name, sql, params=None):
+        """
+        Key of a query, the table name is kept readable so that a table can be invalidated
+
+        :param table_name: table the query reads from
+        :param sql: query string
+        :param params: query parameters
+        :return: cache key
+        """
+        digest = hashlib.sha1(json.dumps([sql, params], default=str).encode()).hexdigest()
+        return '{}-{}'.format(table_name, digest)
+
+    def _path(self, key):
+        return os.path.join(self._cache_dir, key + '.parquet')
+
+    def get(self, key):
+        """
+        :param key: cache key
+        :return: the cached DataFrame, or None if it is missing or expired
+        """
+        path = self._path(key)
+        if not os.path.exists(path):
+            return None
+
+        now = time.time()
+        written = os.path.getmtime(path)
+        if self._ttl is not None and now - written > self._ttl:
+            os.remove(path)
+            return None
+
+        df = pd.read_parquet(path)
+        os.utime(path, (now, written))
+        return df
+
+    def put(self, key, df):
+        # NOTE: written then renamed, the cache can be shared by concurrent processes
+        tmp_path = '{}.{}.tmp'.format(self._path(key), os.getpid())
+        df.to_parquet(tmp_path, index=False)
+        os.replace(tmp_path, self._path(key))
+        self._evict()
+
+    def invalidate(self, table_name=None):
+        """
+        Remove the entries of a table, or all entries if table_name is None
+
+        :param table_name: table whose results are dropped
+        """
+        for file_name in os.listdir(self._cache_dir):
+            if table_name is None or file_name.startswith(table_name + '-'):
+                os.remove(os.path.join(self._cache_dir, file_name))
+
+    def _evict(self):
+        if self._max_size is None:
+            return
+        entries = []
+        for file_name in os.listdir(self._cache_dir):
+            if not file_name.endswith('.parquet'):
+                continue
+            stat = os.stat(os.path.join(self._cache_dir, file_name))
+            entries.append((stat.st_atime, stat.st_size, file_name))
+
+        total_size = sum(entry[1] for entry in entries)
+        for _, size, file_name in sorted(entries):
+            if total_size <= self._max_size:
+                break
+            os.remove(os.path.join(self._cache_dir, file_name))
+            total_size -= size
@@ -0,0 +1,147 @@
+import os
+import pickle
+
+import numpy as np
+from scipy import sparse
+from sklearn.neighbors import BallTree, KDTree
+
+_EARTH_RADIUS_KM = 6371.0088
+
+
+def _tree_points(coordinates, metric):
+    coordinates = np.asarray(coordinates, dtype=np.float64)
+    if metric == 'haversine':
+        # NOTE: the haversine metric of sklearn takes (lat, lon) in radians
+        return np.radians(coordinates[:, ::-1])
+    return coordinates
+
+
+def build_spatial_index(coordinates, metric='haversine'):
+    """
+    Spatial index of the stations, a BallTree for great-circle distances, a KDTree for planar coordinates
+
+    :param coordinates: array shaped (stations, 2), (lon, lat) in degrees for 'haversine', (x, y) for 'euclidean'
+    :param metric: 'haversine' or 'euclidean'
+    :return: sklearn.neighbors.BallTree or KDTree
+    """
+    if metric == 'haversine':
+        return BallTree(_tree_points(coordinates, metric), metric='haversine')
+    if metric == 'euclidean':
+        return KDTree(_tree_points(coordinates, metric))
+    raise ValueError('Invalid metric: {}'.format(metric))
+
+
+def neighbor_distances(coordinates, k=None, radius=None, metric='haversine'):
+    """
+    Distances from every station to its k nearest neighbors, or to all neighbors within radius,
+    queried for all the stations at once. Each station is its own neighbor (distance 0)
+
+    :param coordinates: see build_spatial_index
+    :param k: number of nearest neighbors (besides the station itself)
+    :param radius: max distance, in km for 'haversine'
+    :param metric: 'haversine' (distances in km) or 'euclidean'
+    :return: (rows, cols, distances) of the neighbor pairs
+    """
+    points = _tree_points(coordinates, metric)
+    tree = build_spatial_index(coordinates, metric)
+    scale = _EARTH_RADIUS_KM if metric == 'haversine' else 1.0
+
+    if k is not None:
+        distances, indices = tree.query(points, k=min(k + 1, len(points)))
+        rows = np.repeat(np.arange(len(points)), indices.shape[1])
+        cols, distances = indices.ravel(), distances.ravel()
+    elif radius is not None:
+        indices, distances = tree.query_radius(points, r=radius / scale, return_distance=True)
+        rows = np.repeat(np.arange(len(points)), [len(i) for i in indices])
+        cols, distances = np.concatenate(indices), np.concatenate(distances)
+    else:
+        raise ValueError('Either k or radius is required')
+    return rows, cols, distances * scale
+
+
+def gaussian_adjacency(coordinates, k=None, radius=None, sigma=None, threshold=0.1, metric='haversine',
+                       symmetric=False):
+    """
+    Thresholded Gaussian kernel adjacency of the stations, as built for DCRNN:
+    w_ij = exp(-(d_ij / sigma)^2) for the neighbors j of i, weights below threshold are dropped
+
+    :param coordinates: see build_spatial_index
+    :param k: number of nearest neighbors
+    :param radius: max distance of the neighbors
+    :param sigma: kernel width, the standard deviation of the neighbor distances by default
+    :param threshold: min weight kept in the matrix
+    :param metric: 'haversine' or 'euclidean'
+    :param symmetric: make the matrix symmetric (w_ij = w_ji = max(w_ij, w_ji)), kNN graphs are not
+    :return: scipy.sparse.csr_matrix shaped (stations, stations)
+    """
+    rows, cols, distances = neighbor_distances(coordinates, k=k, radius=radius, metric=metric)
+    if sigma is None:
+        sigma = distances[rows != cols].std() if (rows != cols).any() else 0.0
+    # NOTE: stations at the same place (or a single station) still get a weight of 1 for distance 0
+    sigma = sigma or 1.0
+
+    weights = np.exp(-np.square(distances / sigma))
+    keep = weights >= threshold
+    num_stations = len(coordinates)
+    adjacency = sparse.coo_matrix((weights[keep], (rows[keep], cols[keep])),
+                                  shape=(num_stations, num_stations)).tocsr()
+    if symmetric:
+        adjacency = adjacency.maximum(adjacency.T).tocsr()
+    return adjacency
+
+
+def coordinates_from_geo_features(geo_feature_model, longitude='location_longitude_0',
+                                  latitude='location_latitude_0'):
+    """
+    Coordinates of the locations of a GEOModel, pulled as the 'longitude' and 'latitude' additional features
+
+    :param geo_feature_model: data_model.geo_model.GEOModel
+    :param longitude: feature name of the longitude
+    :param latitude: feature name of the latitude
+    :return: array shaped (locations, 2) of (lon, lat), in the order of geo_feature_model.locations
+    """
+    feature_name = geo_feature_model.geo_feature_name
+    rows = [feature_name.index(longitude), feature_name.index(latitude)]
+    return geo_feature_model.geo_feature_matrix[rows].toarray().T
+
+
+def save_adjacency(adjacency, sensor_ids, save_path, file_name='adj_mx.npz', pkl_file_name='adj_mx.pkl'):
+    """
+    Save the sparse adjacency with the station id of each row / column, next to the DCRNN training data
+    The pickle is the graph file DCRNN loads ('graph_pkl_filename'): (sensor_ids, sensor_id_to_ind, adj_mx),
+    with a dense adj_mx
+
+    :param adjacency: scipy sparse matrix shaped (stations, stations)
+    :param sensor_ids: station ids, in the order of the time series columns
+    :param save_path: output directory (the one of train.npz)
+    :param file_name: name of the sparse (npz) file
+    :param pkl_file_name: name of the DCRNN pickle
+    :return: paths of the (npz, pickle) files
+    """
+    adjacency = sparse.csr_matrix(adjacency)
+    if adjacency.shape != (len(sensor_ids), len(sensor_ids)):
+        raise ValueError('Adjacency of shape {} for {} sensors'.format(adjacency.shape, len(sensor_ids)))
+    os.makedirs(save_path, exist_ok=True)
+    sensor_ids = np.asarray(list(sensor_ids))
+    path = os.path.join(save_path, file_name)
+    np.savez_compressed(path, data=adjacency.data, indices=adjacency.indices, indptr=adjacency.indptr,
+                        shape=np.array(adjacency.shape), sensor_ids=sensor_ids)
+
+    pkl_path = os.path.join(save_path, pkl_file_name)
+    sensor_ids = sensor_ids.tolist()
+    with open(pkl_path, 'wb') as f:
+        # NOTE: protocol 2, DCRNN reads it with pickle.load (falling back to latin1 for python 2 pickles)
+        pickle.dump((sensor_ids, {sensor_id: i for i, sensor_id in enumerate(sensor_ids)}, adjacency.toarray()),
+                    f, protocol=2)
+    return path, pkl_path
+
+
+def load_adjacency(path):
+    """
+    :param path: file written by save_adjacency
+    :return: (scipy.sparse.csr_matrix, station ids)
+    """
+    stored = np.load(path)
+    adjacency = sparse.csr_matrix((stored['data'], stored['indices'], stored['indptr']),
+                                  shape=tuple(stored['shape']))
+    return adjacency, stored['sensor_ids'].tolist()
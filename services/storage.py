@@ -0,0 +1,170 @@
+import json
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from scipy import sparse
+
+# NOTE: key of the schema metadata describing the stored matrices
+_METADATA_KEY = b'air_quality'
+_TIME_COLUMN = '__time__'
+
+
+def _with_metadata(table, metadata):
+    schema_metadata = dict(table.schema.metadata or {})
+    schema_metadata[_METADATA_KEY] = json.dumps(metadata, default=str).encode()
+    return table.replace_schema_metadata(schema_metadata)
+
+
+def _metadata(schema):
+    return json.loads(schema.metadata[_METADATA_KEY])
+
+
+def _label(value):
+    # NOTE: numpy scalars (e.g. station ids of a factorized column) are not JSON serializable
+    return value.item() if hasattr(value, 'item') else value
+
+
+def save_rows(df, path, key_col='station_id', time_col='date_observed', row_group_size=1000000):
+    """
+    Save the cleaned air quality rows as Parquet, sorted by time so that time ranges only read their row groups
+
+    :param df: rows columned by at least key_col and time_col
+    :param path: Parquet file
+    :param row_group_size: number of rows of each row group
+    """
+    table = pa.Table.from_pandas(df.sort_values([time_col, key_col]), preserve_index=False)
+    table = _with_metadata(table, {'key_col': key_col, 'time_col': time_col})
+    pq.write_table(table, path, row_group_size=row_group_size)
+
+
+def load_rows(path, columns=None, stations=None, since=None, until=None):
+    """
+    Load the rows saved by save_rows, only reading the selected columns and the matching row groups
+
+    :param path: Parquet file
+    :param columns: columns to load, all if None
+    :param stations: only load the rows of these stations
+    :param since: only load the rows observed from `since` on
+    :param until: only load the rows observed before `until`
+    :return: a DataFrame
+    """
+    metadata = _metadata(pq.read_schema(path))
+    filters = []
+    if stations is not None:
+        filters.append((metadata['key_col'], 'in', [_label(station) for station in stations]))
+    if since is not None:
+        filters.append((metadata['time_col'], '>=', pd.Timestamp(since)))
+    if until is not None:
+        filters.append((metadata['time_col'], '<', pd.Timestamp(until)))
+    return pq.read_table(path, columns=columns, filters=filters or None).to_pandas()
+
+
+def save_time_series(time_series, path):
+    """
+    Save the dense station by time matrix as an uncompressed Arrow IPC file, one column per station,
+    so that it can be memory mapped and read column by column. The station labels and the time index
+    are kept in the schema metadata, NaN are stored as values (not nulls) for zero-copy reads.
+    A tz-aware index is stored as UTC, its timezone is kept in the metadata
+
+    :param time_series: DataFrame indexed by time, columned by stations
+    :param path: Arrow IPC file
+    """
+    stations = [_label(station) for station in time_series.columns]
+    arrays = [pa.array(time_series.index.values)]
+    arrays += [pa.array(np.ascontiguousarray(time_series.iloc[:, i].values), from_pandas=False)
+               for i in range(time_series.shape[1])]
+    table = pa.Table.from_arrays(arrays, names=[_TIME_COLUMN] + [str(station) for station in stations])
+    table = _with_metadata(table, {'stations': stations, 'index_name': time_series.index.name,
+                                   'freq': time_series.index.freqstr if hasattr(time_series.index, 'freqstr')
+                                   else None,
+                                   'tz': str(time_series.index.tz) if getattr(time_series.index, 'tz', None)
+                                   else None})
+    with pa.OSFile(path, 'wb') as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+
+
+def load_time_series(path, stations=None, memory_map=True):
+    """
+    Load the matrix saved by save_time_series
+
+    :param path: Arrow IPC file
+    :param stations: only load the columns of these stations
+    :param memory_map: if True, the columns are read-only views of the memory mapped file, only the pages
+                       that are accessed are read. Otherwise the matrix is loaded in memory and writable
+    :return: a DataFrame indexed by time, columned by stations
+    """
+    source = pa.memory_map(path) if memory_map else pa.OSFile(path)
+    reader = pa.ipc.open_file(source)
+    metadata = _metadata(reader.schema)
+    labels = metadata['stations'] if stations is None else [_label(station) for station in stations]
+    if stations is not None:
+        # NOTE: only the buffers of the selected columns are read from the file
+        names = [_TIME_COLUMN] + [str(label) for label in labels]
+        missing = [name for name in names if reader.schema.get_field_index(name) < 0]
+        if missing:
+            raise ValueError('Unknown stations: {}'.format(missing))
+        options = pa.ipc.IpcReadOptions(included_fields=[reader.schema.get_field_index(name) for name in names])
+        reader = pa.ipc.open_file(source, options=options)
+    table = reader.read_all()
+
+    index = pd.DatetimeIndex(table.column(_TIME_COLUMN).to_numpy(), name=metadata['index_name'])
+    if metadata.get('tz') is not None:
+        index = index.tz_localize('UTC').tz_convert(metadata['tz'])
+    index = pd.DatetimeIndex(index, freq=metadata['freq'])
+    columns = {label: table.column(str(label)).to_numpy() for label in labels}
+    return pd.DataFrame(columns, index=index, columns=labels, copy=not memory_map)
+
+
+def save_geo_feature_matrix(matrix, feature_name, locations, path):
+    """
+    Save a sparse (feature, location) matrix as an Arrow IPC file of its non-zero entries
+
+    :param matrix: scipy sparse matrix shaped (features, locations), e.g. GEOModel.geo_feature_matrix
+    :param feature_name: name of each row
+    :param locations: location of each column
+    :param path: Arrow IPC file
+    """
+    coo = sparse.coo_matrix(matrix)
+    table = pa.table({'feature': pa.array(coo.row.astype(np.int32)),
+                      'location': pa.array(coo.col.astype(np.int32)),
+                      'value': pa.array(coo.data, from_pandas=False)})
+    table = _with_metadata(table, {'feature_name': list(feature_name),
+                                   'locations': [_label(location) for location in locations]})
+    with pa.OSFile(path, 'wb') as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+
+
+def load_geo_feature_matrix(path, features=None):
+    """
+    Load the matrix saved by save_geo_feature_matrix
+
+    :param path: Arrow IPC file
+    :param features: only load these features (rows), in this order
+    :return: (scipy.sparse.csr_matrix, feature names, locations)
+    """
+    table = pa.ipc.open_file(pa.memory_map(path)).read_all()
+    metadata = _metadata(table.schema)
+    feature_name, locations = metadata['feature_name'], metadata['locations']
+
+    rows = table.column('feature').to_numpy()
+    cols = table.column('location').to_numpy()
+    values = table.column('value').to_numpy()
+    if features is not None:
+        positions = pd.Index(feature_name).get_indexer(features)
+        if (positions < 0).any():
+            raise ValueError('Unknown features: {}'.format([f for f, p in zip(features, positions) if p < 0]))
+        # NOTE: old row -> new row, -1 for the rows that are not selected
+        row_map = np.full(len(feature_name), -1, dtype=np.int64)
+        row_map[positions] = np.arange(len(features))
+        rows = row_map[rows]
+        keep = rows >= 0
+        rows, cols, values = rows[keep], cols[keep], values[keep]
+        feature_name = list(features)
+
+    # NOTE: tocsr copies the entries out of the memory mapped file
+    matrix = sparse.coo_matrix((values, (rows, cols)), shape=(len(feature_name), len(locations))).tocsr()
+    return matrix, feature_name, locations
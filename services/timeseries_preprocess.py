@@ -1,10 +1,67 @@
 import pandas as pd
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+
+from services.instrumentation import instrumented
+
+
+def _keyed_rows(df, key_col, time_col):
+    """
+    Drop the rows without station or time, pd.factorize codes a missing key as -1,
+    which would scatter the value into the last column
+    """
+    keyed = df[key_col].notna().values & df[time_col].notna().values
+    return df if keyed.all() else df[keyed]
+
+
+@instrumented('time_series.pivot')
+def time_series_pivot(df, key_col='station_id', time_col='date_observed', value_col='value', freq='1H',
+                      fill_range=True, dtype=None):
+    """
+    Vectorized engine behind all the time series construction methods
+    Station ids are factorized to column codes and timestamps are floored to integer offsets of `freq`,
+    then all values are scattered into a preallocated matrix in a single pass
+    If a (station, timestamp) pair appears more than once, the last value wins
+
+    :param df: input dataFrame
+    :param key_col: column name of key
+    :param time_col: column name of time
+    :param value_col: column name of value
+    :param freq: frequency of the time index, the timestamps are not floored if None (requires fill_range=False)
+    :param fill_range: if True, index the result by the full range between the min and max time,
+                       otherwise only by the distinct (floored) timestamps of the input
+    :param dtype: dtype of the matrix, float32 if the values are float32 and float64 otherwise by default
+    :return: time series format data
+    """
+    if freq is None and fill_range:
+        raise ValueError('fill_range requires a freq')
+    df = _keyed_rows(df, key_col, time_col)
+    times = pd.DatetimeIndex(df[time_col])
+    if freq is not None:
+        step = pd.Timedelta(freq)
+        times = times.floor(step)
+    key_codes, keys = pd.factorize(df[key_col], sort=True)
+    # NOTE: categorical station ids (compact mode) are turned back into plain column labels
+    keys = pd.Index(np.asarray(keys))
+    values = df[value_col].values
+    if dtype is None:
+        dtype = np.float32 if values.dtype == np.float32 else np.float64
+
+    if fill_range:
+        min_time = times.min()
+        time_index = pd.date_range(start=min_time, end=times.max(), freq=freq)
+        time_codes = np.asarray((times - min_time) // step, dtype=np.int64)
+    else:
+        time_codes, time_index = pd.factorize(times, sort=True)
+
+    matrix = np.full((len(time_index), len(keys)), np.nan, dtype=dtype)
+    matrix[time_codes, key_codes] = values
+    return pd.DataFrame(matrix, index=time_index, columns=keys)
 
 
 def time_series_construction(df, key_col='station_id', time_col='date_observed', value_col='value'):
     """
     Construct time series vector, indexed by distinct timestamp, columned by locations
-    Using merge function to merge locations one by one
     If there is not timestamp at the location, filled with NaN as default
 
     :param df: input dataFrame
@@ -13,24 +70,14 @@ def time_series_construction(df, key_col='station_id', time_col='date_observed',
     :param value_col: column name of value
     :return: time series format data
     """
-    time_idx = sorted(list(set(df[time_col])))
-    time_series = pd.DataFrame(time_idx, columns=[time_col])
-    time_series.set_index(time_col, inplace=True)
-
-    df_grouped = df.groupby(key_col)
-    for each_group in df_grouped.groups:
-        group = df_grouped.get_group(each_group)
-        sorted_group = group.sort_values(by=time_col)[[time_col, value_col]]
-        sorted_group.set_index(time_col, inplace=True)
-        time_series = time_series.join(sorted_group, how='left')
-        time_series.rename(columns={value_col: each_group}, inplace=True)
+    time_series = time_series_pivot(df, key_col, time_col, value_col, freq=None, fill_range=False)
+    time_series.index.name = time_col
     return time_series
 
 
 def time_series_construction1(df, key_col='station_id', time_col='date_observed', value_col='value'):
     """
-    An updated version from the first construction method
-    Should be faster than the previous method
+    Construct time series vector, indexed by every hour between the min and max timestamp, columned by locations
 
     :param df: input dataFrame
     :param key_col: column name of key
@@ -38,29 +85,12 @@ def time_series_construction1(df, key_col='station_id', time_col='date_observed'
     :param value_col: column name of value
     :return: time series format data
     """
-    min_time = min(df[time_col])
-    max_time = max(df[time_col])
-    times = pd.date_range(start=min_time, end=max_time, freq='1H')
-    times_pd = pd.DataFrame(index=times)
-
-    time_series_list = []
-    # time_series_result = pd.DataFrame(index=times)
-
-    df_grouped = df.groupby(key_col)
-    for each_group in df_grouped.groups:
-        group = df_grouped.get_group(each_group)
-        group.set_index(time_col, inplace=True)
-        time_series = times_pd.join(group[value_col], how='left')
-        time_series.rename(columns={value_col: each_group}, inplace=True)
-        time_series_list.append(time_series)
-    time_series_result = pd.concat(time_series_list, axis=1)
-    return time_series_result
+    return time_series_pivot(df, key_col, time_col, value_col)
 
 
 def time_series_construction2(df, key_col='station_id', time_col='date_observed', value_col='value'):
     """
-    Join operation takes too long if the column number is above 20.
-    This will also takes sometime but short than join when column number is large
+    Kept for backward compatibility, same as time_series_construction1
 
     :param df: input dataFrame
     :param key_col: column name of key
@@ -68,49 +98,137 @@ def time_series_construction2(df, key_col='station_id', time_col='date_observed'
     :param value_col: column name of value
     :return: time series format data
     """
-    min_time = min(df[time_col])
-    max_time = max(df[time_col])
-    times = pd.date_range(start=min_time, end=max_time, freq='1H')
-    keys = list(set(df[key_col]))
+    return time_series_pivot(df, key_col, time_col, value_col)
 
-    result_time_series = pd.DataFrame(index=times, columns=keys)
-    print(df.shape)
 
-    for index, row in df.iterrows():
-        print(index)
-        station_id = row[key_col]
-        time = row[time_col]
-        result_time_series.loc[time, station_id] = row[value_col]
-    return result_time_series
+@instrumented('time_series.tensor', rows_out=lambda result, *args, **kwargs: len(result[0]))
+def time_series_tensor(df, key_col='station_id', time_col='date_observed', value_col='value',
+                       parameter_col='parameter', parameters=None, freq='1H', dtype=np.float32):
+    """
+    (time, station, parameter) counterpart of time_series_pivot, the rows of all the parameters are scattered
+    into one preallocated tensor in a single pass, aligned on one time index (the full range) and one set of stations
+    If a (station, timestamp, parameter) appears more than once, the last value wins
 
+    :param df: input dataFrame
+    :param key_col: column name of key
+    :param time_col: column name of time
+    :param value_col: column name of value
+    :param parameter_col: column name of the parameter (pollutant), a single parameter named value_col if None
+    :param parameters: order of the parameter axis, the sorted distinct parameters by default,
+                       the rows of the other parameters are left out
+    :param freq: frequency of the time index
+    :param dtype: dtype of the tensor
+    :return: (tensor, time index, stations, parameters)
+    """
+    df = _keyed_rows(df, key_col, time_col)
+    if parameter_col is None:
+        parameter_codes, parameters = np.zeros(len(df), dtype=np.int64), [value_col]
+    elif parameters is None:
+        df = df[df[parameter_col].notna()]
+        parameter_codes, parameters = pd.factorize(df[parameter_col], sort=True)
+        parameters = list(np.asarray(parameters))
+    else:
+        df = df[df[parameter_col].isin(parameters)]
+        parameter_codes = pd.Index(parameters).get_indexer(df[parameter_col])
+        parameters = list(parameters)
+
+    step = pd.Timedelta(freq)
+    times = pd.DatetimeIndex(df[time_col]).floor(step)
+    key_codes, keys = pd.factorize(df[key_col], sort=True)
+    keys = pd.Index(np.asarray(keys))
+    min_time = times.min()
+    time_index = pd.date_range(start=min_time, end=times.max(), freq=freq)
+    time_codes = np.asarray((times - min_time) // step, dtype=np.int64)
+
+    tensor = np.full((len(time_index), len(keys), len(parameters)), np.nan, dtype=dtype)
+    tensor[time_codes, key_codes, parameter_codes] = df[value_col].values
+    return tensor, time_index, keys, parameters
+
+
+def time_of_day(time_index):
+    """
+    Time of day of each timestamp as a fraction of the day in [0, 1), the time feature of DCRNN
 
-def time_series_smoothing(time_seires, window_size=24, method='mean'):
+    :param time_index: DatetimeIndex (or datetime64 values), a tz-aware index is taken in its local wall time
+    :return: 1-D float array
+    """
+    time_index = pd.DatetimeIndex(time_index)
+    # NOTE: converting a tz-aware index to datetime64 would give the UTC time of day
+    if time_index.tz is not None:
+        time_index = time_index.tz_localize(None)
+    values = np.asarray(time_index, dtype='datetime64[ns]')
+    return (values - values.astype('datetime64[D]')) / np.timedelta64(1, 'D')
+
+
+def _centered_rolling_mad(values, median, window_size, block_size=4096):
+    """
+    Median absolute deviation of every centered window, around the median of that same window
+    Windows are strided views of the NaN padded matrix, processed in blocks of rows to bound memory
+
+    :param values: 2-D array shaped (time, series)
+    :param median: centered rolling median of values
+    :param window_size: window length, aligned as pandas rolling(center=True)
+    :param block_size: number of rows processed at once
+    :return: 2-D array of the MAD
+    """
+    before = window_size // 2
+    after = window_size - 1 - before
+    padded = np.pad(values.astype(np.float64), ((before, after), (0, 0)), mode='constant', constant_values=np.nan)
+    windows = as_strided(padded, shape=(len(values), window_size, values.shape[1]),
+                         strides=(padded.strides[0],) + padded.strides, writeable=False)
+
+    mad = np.empty(values.shape)
+    for i in range(0, len(values), block_size):
+        deviation = np.abs(windows[i: i + block_size] - median[i: i + block_size, np.newaxis, :])
+        # NOTE: np.sort puts NaN last, the median is taken among the first `count` sorted values
+        deviation.sort(axis=1)
+        count = np.sum(~np.isnan(deviation), axis=1)
+        low = np.take_along_axis(deviation, np.maximum(count - 1, 0)[:, np.newaxis, :] // 2, axis=1)[:, 0, :]
+        high = np.take_along_axis(deviation, (count // 2)[:, np.newaxis, :], axis=1)[:, 0, :]
+        block_mad = (low + high) / 2
+        # NOTE: all-NaN windows give NaN, as the pandas rolling functions do
+        block_mad[count == 0] = np.nan
+        mad[i: i + block_size] = block_mad
+    return mad
+
+
+@instrumented('time_series.smoothing')
+def time_series_smoothing(time_seires, window_size=24, method='mean', n_sigmas=3.0):
     """
         Smooth each time series (each column is a time series)
+        The rolling functions run on the whole DataFrame at once, the index of the input is kept
 
         :param time_seires: input dataFrame
-        :param key_col: column name of key
-        :param time_col: column name of time
-        :param value_col: column name of value
+        :param window_size: size of the rolling window (span of the EWMA)
+        :param method: 'mean' and 'median' are centered rolling mean and median,
+                       'ewma' is the exponentially weighted moving average,
+                       'hampel' replaces the values further than n_sigmas robust standard deviations
+                       from the centered rolling median by that median
+        :param n_sigmas: threshold of the hampel filter
         :return: time series format data
     """
     min_time = min(time_seires.index)
     max_time = max(time_seires.index)
     assert min_time < max_time
 
-    times = pd.date_range(start=min_time, end=max_time, freq='1H')
-    time_series_smooth = pd.DataFrame(index=times)
+    rolling = time_seires.rolling(window=window_size, min_periods=1, center=True)
+    # NOTE: pandas computes the rolling functions in float64, compact (float32) input stays float32
+    dtype = np.float32 if (time_seires.dtypes == np.float32).all() else np.float64
 
     if method == 'mean':
-        for idx, key in enumerate(time_seires.columns):
-            ts = time_seires[key]
-            rolmean = ts.rolling(window=window_size, min_periods=1, center=True).mean()
-            time_series_smooth[key] = rolmean
+        return rolling.mean().astype(dtype, copy=False)
 
     if method == 'median':
-        for idx, key in enumerate(time_seires.columns):
-            ts = time_seires[key]
-            rolmed = ts.rolling(window=window_size, min_periods=1, center=True).median()
-            time_series_smooth[key] = rolmed
+        return rolling.median().astype(dtype, copy=False)
+
+    if method == 'ewma':
+        return time_seires.ewm(span=window_size, min_periods=1).mean().astype(dtype, copy=False)
+
+    if method == 'hampel':
+        median = rolling.median()
+        # NOTE: 1.4826 scales the MAD to the standard deviation of normally distributed data
+        mad = _centered_rolling_mad(time_seires.values, median.values, window_size)
+        outliers = np.abs(time_seires.values - median.values) > n_sigmas * 1.4826 * mad
+        return time_seires.mask(outliers, median.astype(dtype, copy=False))
 
-    return time_series_smooth
+    raise ValueError('Unknown smoothing method: {}'.format(method))
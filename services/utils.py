@@ -1,4 +1,6 @@
 from sklearn import preprocessing
+import numpy as np
+import pandas as pd
 import json
 import time
 import os
@@ -9,6 +11,111 @@ def standard_scaler(df):
     return scl.transform(df)
 
 
+def sparse_standard_scaler(matrix):
+    """
+        Standardize the columns of a sparse matrix without densifying it
+        The columns are only divided by their standard deviation, standard_scaler(matrix) == scaled - offset
+
+    :param matrix: scipy sparse matrix
+    :return: (scaled sparse matrix, offset of each column)
+    """
+    scl = preprocessing.StandardScaler(with_mean=False).fit(matrix)
+    return scl.transform(matrix), scl.mean_ / scl.scale_
+
+
+def duplicate_sums(df, key_col, min_col='min', max_col='max', count_col='count'):
+    """
+        Per-station grouped sums of the (min, max) pairs of the duplicates at the same location & time
+        The sums are additive, sums of disjoint time ranges can be added up (except 'min' / 'max')
+
+    :param df: one row per (location, time), with the min, max and number of the duplicated values
+    :param key_col: column name of key
+    :param min_col: column name of the min of the duplicates
+    :param max_col: column name of the max of the duplicates
+    :param count_col: column name of the number of duplicates
+    :return: a DataFrame indexed by key, columned by the sums
+    """
+    x = df[min_col].values.astype(np.float64)
+    y = df[max_col].values.astype(np.float64)
+    count = df[count_col].values
+    sums = pd.DataFrame({key_col: df[key_col].values,
+                         'num_timestamps': 1,
+                         'num_duplicated': (count > 1).astype(np.int64),
+                         'num_readings': count,
+                         'sum_x': x, 'sum_y': y, 'sum_xy': x * y, 'sum_xx': x * x, 'sum_yy': y * y,
+                         'min': x, 'max': y})
+    grouped = sums.groupby(key_col, observed=True)
+    result = grouped.sum()
+    result['min'] = grouped['min'].min()
+    result['max'] = grouped['max'].max()
+    return result
+
+
+def combine_duplicate_sums(sums_list):
+    """
+        Add up the duplicate_sums of disjoint time ranges
+
+    :param sums_list: outputs of duplicate_sums
+    :return: the duplicate_sums of the union of the time ranges
+    """
+    grouped = pd.concat(sums_list).groupby(level=0, observed=True)
+    result = grouped.sum()
+    result['min'] = grouped['min'].min()
+    result['max'] = grouped['max'].max()
+    return result
+
+
+def duplicate_statistics_from_sums(sums):
+    """
+        Pearson correlation between the min and the max of the duplicates of each station, from duplicate_sums
+
+    :param sums: output of duplicate_sums
+    :return: a DataFrame indexed by key, columned by
+             ['num_timestamps', 'num_duplicated', 'num_readings', 'min', 'max', 'corr']
+    """
+    n = sums['num_timestamps']
+    covariance = n * sums['sum_xy'] - sums['sum_x'] * sums['sum_y']
+    variance_x = n * sums['sum_xx'] - sums['sum_x'] ** 2
+    variance_y = n * sums['sum_yy'] - sums['sum_y'] ** 2
+
+    # NOTE: constant series have no correlation, as in pandas
+    denominator = np.sqrt(variance_x * variance_y)
+    corr = covariance / denominator.where(denominator > 0)
+
+    statistics = sums[['num_timestamps', 'num_duplicated', 'num_readings', 'min', 'max']].copy()
+    statistics['corr'] = corr.clip(-1.0, 1.0)
+    return statistics
+
+
+def duplicate_statistics(df, key_col, time_col, value_col='value'):
+    """
+        Statistics of the duplicates at the same location & time, computed with one aggregation
+        and grouped sums instead of one correlation per station
+
+    :param df: input rows
+    :param key_col: column name of key
+    :param time_col: column name of time
+    :param value_col: column name of value
+    :return: see duplicate_statistics_from_sums
+    """
+    return duplicate_statistics_from_sums(raw_duplicate_sums(df, key_col, time_col, value_col))
+
+
+def raw_duplicate_sums(df, key_col, time_col, value_col='value'):
+    """
+        duplicate_sums of raw rows, the duplicates of each (location, time) are aggregated first
+
+    :param df: input rows
+    :param key_col: column name of key
+    :param time_col: column name of time
+    :param value_col: column name of value
+    :return: see duplicate_sums
+    """
+    aggregated = df.groupby([key_col, time_col], sort=False, observed=True)[value_col]\
+        .agg(['min', 'max', 'count']).reset_index()
+    return duplicate_sums(aggregated, key_col)
+
+
 def check_max_min_correlation(df, stations, key_col, time_col):
     """
         Check the correlation of the duplicates at the same location & time
@@ -17,13 +124,7 @@ def check_max_min_correlation(df, stations, key_col, time_col):
     :param stations
     :param key_col
     :param time_col
+    :return: {station: correlation between the min and the max of the duplicates}
     """
-
-    df_min = df.groupby([key_col, time_col]).min()
-    df_max = df.groupby([key_col, time_col]).max()
-    joint_min_max = df_min.join(df_max, lsuffix='_min', rsuffix='_max')
-    max_min_corr = {}
-    for station in stations:
-        corr = joint_min_max.loc[station].corr(method='pearson')
-        max_min_corr[station] = corr.iloc[0, 1]
-    return max_min_corr
+    statistics = duplicate_statistics(df, key_col, time_col)
+    return {station: statistics.loc[station, 'corr'] for station in stations}
@@ -0,0 +1,92 @@
+import numpy as np
+import pandas as pd
+
+from benchmark.synthetic import InMemoryConnection
+from data_model.air_model import AIRModel
+
+
+class _HourlyTableConnection:
+    """
+    Serves rows of an in-memory hourly table, honouring the `since` parameter of incremental reads
+    """
+
+    def __init__(self, rows):
+        self.rows = rows
+
+    def read(self, table_name, column_set, request_condition='', params=None, **select_args):
+        rows = self.rows
+        if params:
+            rows = rows[rows['date_observed'] >= pd.Timestamp(params[0])]
+        return list(rows.itertuples(index=False, name=None))
+
+
+def _config():
+    return {'air_quality': {'table_name': 'air_quality_data.utah_purple_air_ground_level_hourly',
+                            'column_set': ['station_id', 'date_observed', 'value'],
+                            'request_condition': '',
+                            'late_data_lookback': 2}}
+
+
+def _rows(stations, start, periods):
+    times = pd.date_range(start, periods=periods, freq='1H')
+    return pd.DataFrame([(station, time, float(station * 100 + i)) for station in stations
+                         for i, time in enumerate(times)], columns=['station_id', 'date_observed', 'value'])
+
+
+def test_air_model_refresh(tmp_path):
+    conn = _HourlyTableConnection(_rows([1, 2, 3], '2018-01-01', 10))
+    air_quality_model = AIRModel(_config(), conn)
+    air_quality_model.remove_stations([3])
+    air_quality_model.build_time_series()
+    air_quality_model.save_state(str(tmp_path))
+
+    # NOTE: a late value for 08:00, 5 new hours, and a new station
+    late = pd.DataFrame([(1, pd.Timestamp('2018-01-01 08:00'), 1.5)], columns=['station_id', 'date_observed', 'value'])
+    conn.rows = pd.concat([conn.rows, late, _rows([1, 2, 3, 4], '2018-01-01 10:00', 5)], ignore_index=True)
+    air_quality_model = AIRModel.from_state(_config(), str(tmp_path))
+    time_series = air_quality_model.refresh(conn)
+
+    expected = conn.rows[conn.rows['station_id'] != 3]
+    expected = expected.groupby(['station_id', 'date_observed'])['value'].mean().unstack(0)
+    assert list(time_series.columns) == [1, 2, 4]
+    assert air_quality_model.watermark == pd.Timestamp('2018-01-01 14:00')
+    np.testing.assert_array_equal(time_series.values, expected.values)
+
+
+def test_air_model_state_without_watermark(tmp_path):
+    conn = _HourlyTableConnection(_rows([1, 2], '2018-01-01', 6))
+    air_quality_model = AIRModel(_config(), conn)
+    # NOTE: e.g. the time series stage of the Utah pipeline, build_time_series is not called
+    air_quality_model.time_series = air_quality_model.air_quality_df.pivot(index='date_observed',
+                                                                           columns='station_id', values='value')
+    air_quality_model.save_state(str(tmp_path))
+
+    air_quality_model = AIRModel.from_state(_config(), str(tmp_path))
+    assert air_quality_model.watermark is None
+    conn.rows = pd.concat([conn.rows, _rows([1, 2], '2018-01-01 06:00', 2)], ignore_index=True)
+    time_series = air_quality_model.refresh(conn)
+    assert time_series.shape == (8, 2) and air_quality_model.watermark == pd.Timestamp('2018-01-01 07:00')
+
+
+def test_air_model_tensor_of_several_parameters():
+    rows = pd.concat([_rows([1, 2], '2018-01-01', 6).assign(parameter=parameter, value=lambda df: df['value'] * k)
+                      for k, parameter in enumerate(['pm25', 'pm10', 'o3'], 1)], ignore_index=True)
+    # NOTE: o3 is not measured at station 2, and station 3 only measures pm10 two hours later
+    rows = rows[(rows['parameter'] != 'o3') | (rows['station_id'] == 1)]
+    late = pd.DataFrame([(3, pd.Timestamp('2018-01-01 07:00'), 5.0, 'pm10'), (3, pd.Timestamp('2018-01-01 07:00'),
+                                                                             7.0, 'pm10')], columns=rows.columns)
+    conn = InMemoryConnection({'air_quality': pd.concat([rows, late], ignore_index=True)})
+    config = {'air_quality': {'table_name': 'air_quality', 'request_condition': '',
+                              'column_set': ['station_id', 'date_observed', 'value'],
+                              'parameter_column': 'parameter', 'parameters': ['pm25', 'pm10']}}
+
+    air_quality_model = AIRModel(config, conn)
+    assert len(conn.queries) == 1 and conn.queries[0][2] == {'parameter': ['pm25', 'pm10']}
+    tensor = air_quality_model.build_tensor()
+
+    assert tensor.shape == (8, 3, 2) and tensor.dtype == np.float32
+    assert list(air_quality_model.tensor_stations) == [1, 2, 3]
+    time_series = air_quality_model.build_time_series()
+    np.testing.assert_array_equal(tensor[:6, :2, 0], time_series.values)
+    assert tensor[7, 2, 1] == 6.0 and np.isnan(tensor[7, 2, 0])
+    np.testing.assert_array_equal(tensor[:6, :2, 1], 2 * time_series.values)
@@ -0,0 +1,159 @@
+import asyncio
+import re
+
+import numpy as np
+import pandas as pd
+
+from benchmark.synthetic import InMemoryConnection, synthetic_tables
+from data_model.geo_model import GEOModel
+from preprocess.async_loading import load_models_async
+from services.async_postgres_connection import AsyncConnection, to_asyncpg_sql
+from services.query_cache import QueryCache
+
+
+class _StubPool:
+    """
+    Stands in for an asyncpg pool, serves the rows of a table whatever the query, and tracks concurrent queries
+    """
+
+    def __init__(self, tables, delays):
+        self.tables = tables
+        self.delays = delays
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.queries = []
+
+    def acquire(self):
+        return _StubAcquire(self)
+
+    async def close(self):
+        pass
+
+
+class _StubAcquire:
+
+    def __init__(self, pool):
+        self._pool = pool
+
+    async def __aenter__(self):
+        return _StubConnection(self._pool)
+
+    async def __aexit__(self, *args):
+        pass
+
+
+class _StubTransaction:
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
+
+class _StubConnection:
+
+    def __init__(self, pool):
+        self._pool = pool
+
+    def transaction(self):
+        return _StubTransaction()
+
+    async def prepare(self, sql):
+        return _StubStatement(await self.fetch(sql))
+
+    async def fetch(self, sql, *params):
+        pool = self._pool
+        table_name = re.search(r' from ([\w.]+)', sql).group(1)
+        pool.queries.append((sql, params))
+        pool.in_flight += 1
+        pool.max_in_flight = max(pool.max_in_flight, pool.in_flight)
+        try:
+            await asyncio.sleep(pool.delays.get(table_name, 0.01))
+        finally:
+            pool.in_flight -= 1
+        return pool.tables[table_name]
+
+
+class _StubAttribute:
+
+    def __init__(self, name):
+        self.name = name
+
+
+class _StubStatement:
+    """
+    Prepared statement of the stub, the rows are (station_id, value)
+    """
+
+    def __init__(self, rows):
+        self._rows = list(rows)
+
+    def get_attributes(self):
+        return [_StubAttribute('station_id'), _StubAttribute('value')]
+
+    async def cursor(self, *params):
+        return self
+
+    async def fetch(self, size):
+        rows, self._rows = self._rows[:size], self._rows[size:]
+        return rows
+
+
+def test_to_asyncpg_sql():
+    sql, params = to_asyncpg_sql("select gid from t where (d >= %s and name like 'a%%') and gid = ANY(%s)",
+                                 ['2018-01-01', [1, 2]])
+
+    assert sql == "select gid from t where (d >= $1 and name like 'a%') and gid = ANY($2)"
+    assert params == ['2018-01-01', [1, 2]]
+    assert to_asyncpg_sql("select 1 where name like 'a%%'", None) == ("select 1 where name like 'a%%'", [])
+
+
+def test_load_models_async_overlaps_reads():
+    tables = synthetic_tables(12, 48, geo_features=('roads', 'water'))
+    # NOTE: stations 10 and 11 have no air quality data
+    tables['air_quality'] = tables['air_quality'][tables['air_quality']['station_id'] < 10]
+    stub_tables = {name: list(df.itertuples(index=False, name=None)) for name, df in tables.items()}
+    pool = _StubPool(stub_tables, {'air_quality': 0.2})
+    config = {'air_quality': {'table_name': 'air_quality', 'request_condition': '',
+                              'column_set': ['station_id', 'date_observed', 'value']},
+              'geo_feature': {'table_name_pr': 'geo_features', 'additional_features': {},
+                              'column_set': ['gid', 'geo_feature', 'feature_type', 'buffer_size', 'value']}}
+
+    air_quality_model, geo_feature_model = asyncio.run(
+        load_models_async(['roads', 'water'], config, AsyncConnection(pool)))
+
+    # NOTE: the air quality read, then both geo feature tables at once, for the stations of the air quality data
+    assert pool.max_in_flight == 2
+    assert len(pool.queries) == 3
+    assert [sorted(params[0]) for _, params in pool.queries[1:]] == [list(range(10))] * 2
+    assert geo_feature_model.locations == air_quality_model.get_locations()
+    assert len(air_quality_model.air_quality_df) == (tables['air_quality']['value'] > 0).sum() - \
+        tables['air_quality'].duplicated().sum()
+
+    locations = list(range(0, 12, 2))
+    geo_feature_model.select_locations(locations)
+    expected = GEOModel(locations, ['roads', 'water'], config, InMemoryConnection(tables))
+    assert geo_feature_model.geo_feature_name == expected.geo_feature_name
+    np.testing.assert_allclose(geo_feature_model.scaled_geo_feature_vector.values,
+                               expected.scaled_geo_feature_vector.values)
+
+
+def test_read_chunks_goes_through_the_cache(tmp_path):
+    rows = [(station, station * 1.5) for station in range(5)]
+    pool = _StubPool({'air_quality': rows}, {})
+    conn = AsyncConnection(pool, cache=QueryCache(str(tmp_path)))
+
+    async def read():
+        return [chunk async for chunk in conn.read_chunks('air_quality', ['station_id', 'value'], chunk_size=2,
+                                                           columns=['gid', 'value'])]
+
+    for _ in range(2):
+        chunks = asyncio.run(read())
+        assert [len(chunk) for chunk in chunks] == [2, 2, 1]
+        pd.testing.assert_frame_equal(pd.concat(chunks, ignore_index=True),
+                                      pd.DataFrame(rows, columns=['gid', 'value']))
+    assert len(pool.queries) == 1
+    # NOTE: the same entry as read_as_dataframe
+    df = asyncio.run(conn.read_as_dataframe('air_quality', ['station_id', 'value']))
+    assert list(df.columns) == ['station_id', 'value'] and len(pool.queries) == 1
@@ -0,0 +1,100 @@
+import json
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from benchmark.synthetic import InMemoryConnection, synthetic_tables
+from data_model.air_model import AIRModel
+from data_model.geo_model import GEOModel
+from preprocess.batch import PREPROCESSORS, job_config, run_batch
+from services.query_cache import QueryCache
+from services.storage import load_time_series
+
+
+def _config():
+    return {'feature_set': ['roads'], 'time': 0,
+            'testing': {'air_quality': {'data_source': 'epa', 'table_name': 'air_quality', 'request_condition': '',
+                                        'column_set': ['station_id', 'date_observed', 'value'],
+                                        'parameter_column': 'parameter'},
+                        'geo_feature': {'table_name_pr': 'geo_features', 'additional_features': {},
+                                        'column_set': ['gid', 'geo_feature', 'feature_type', 'buffer_size',
+                                                       'value']}}}
+
+
+def _synthetic_preprocess(feature_set, config):
+    # NOTE: the reads of the real models go through the query cache shared by the jobs
+    tables = synthetic_tables(8, 48, geo_features=feature_set)
+    rows = tables['air_quality']
+    tables['air_quality'] = pd.concat([rows.assign(parameter='pm25'),
+                                       rows.assign(parameter='o3', value=rows['value'] / 10)], ignore_index=True)
+    conn = InMemoryConnection(tables, cache=QueryCache.from_config(config))
+    air_quality_model = AIRModel(config, conn)
+    air_quality_model.build_time_series()
+    geo_feature_model = GEOModel(air_quality_model.get_locations(), feature_set, config, conn)
+    with open(os.path.join(config['output_path'], 'queries.json'), 'w') as f:
+        json.dump([table_name for table_name, _, _ in conn.queries], f)
+    return air_quality_model, geo_feature_model
+
+
+def _allocating_preprocess(feature_set, config):
+    return np.ones(2 ** 31, dtype=np.uint8), None
+
+
+def test_job_config():
+    config = job_config(_config(), ('utah', 'epa', 'o3'), 'out', cache_dir='cache')
+    assert config['air_quality']['data_source'] == 'epa' and config['feature_set'] == ['roads']
+    assert config['air_quality']['parameters'] == ['o3'] and config['max_connections'] == 1
+    assert (config['parameter_name'], config['output_path'], config['query_cache']) == ('o3', 'out',
+                                                                                       {'cache_dir': 'cache'})
+    with pytest.raises(ValueError):
+        job_config(_config(), ('utah', 'purple_air', 'pm25'), 'out')
+    with pytest.raises(ValueError):
+        job_config(_config(), ('utah', 'epa', 'co'), 'out')
+
+    # NOTE: a table of a single parameter, without parameter column, cannot select the others
+    single = _config()
+    del single['testing']['air_quality']['parameter_column']
+    single['parameter_name'] = 'pm25'
+    assert 'parameters' not in job_config(single, ('utah', 'epa', 'pm25'), 'out')['air_quality']
+    with pytest.raises(ValueError):
+        job_config(single, ('utah', 'epa', 'o3'), 'out')
+    assert sorted(PREPROCESSORS) == [('los_angeles', 'epa'), ('los_angeles', 'purple_air'), ('utah', 'epa'),
+                                     ('utah', 'purple_air')]
+
+
+def test_run_batch(tmp_path):
+    jobs = [('utah', 'epa', 'pm25'), ('utah', 'epa', 'o3'), ('los_angeles', 'epa', 'pm25')]
+    # NOTE: one worker, so the jobs run one after the other and the second one finds the geo features cached
+    report = run_batch(jobs, {'utah': _config(), 'los_angeles': _config()}, str(tmp_path), max_workers=1,
+                       memory_limit_mb=1024,
+                       preprocessors={('utah', 'epa'): _synthetic_preprocess,
+                                      ('los_angeles', 'epa'): _allocating_preprocess})
+
+    assert [(job['parameter'], job['status']) for job in report['jobs']] == [('pm25', 'done'), ('o3', 'done'),
+                                                                             ('pm25', 'failed')]
+    assert report['jobs'][2]['error'].startswith('MemoryError')
+    assert all(job['seconds'] > 0 for job in report['jobs'])
+    with open(os.path.join(str(tmp_path), 'batch_summary.json')) as f:
+        assert json.load(f)['jobs'] == report['jobs']
+
+    queries = {}
+    for name in ['utah_epa_pm25', 'utah_epa_o3']:
+        with open(os.path.join(str(tmp_path), name, 'queries.json')) as f:
+            queries[name] = json.load(f)
+    assert queries == {'utah_epa_pm25': ['air_quality', 'geo_features_roads'], 'utah_epa_o3': ['air_quality']}
+
+    # NOTE: each job selected its own parameter
+    pm25 = load_time_series(os.path.join(str(tmp_path), 'utah_epa_pm25', 'time_series.arrow'))
+    o3 = load_time_series(os.path.join(str(tmp_path), 'utah_epa_o3', 'time_series.arrow'))
+    assert pm25.shape == o3.shape == (48, 8)
+    np.testing.assert_allclose(o3.values, pm25.values / 10)
+    assert os.path.exists(os.path.join(str(tmp_path), 'utah_epa_o3', 'geo_features.arrow'))
+
+
+def test_run_batch_rejects_the_jobs_before_running(tmp_path):
+    with pytest.raises(ValueError):
+        run_batch([('utah', 'epa', 'pm25'), ('los_angeles', 'epa', 'pm25')], {'utah': _config()}, str(tmp_path),
+                  preprocessors={('utah', 'epa'): _synthetic_preprocess})
+    assert not os.path.exists(os.path.join(str(tmp_path), 'utah_epa_pm25'))
@@ -0,0 +1,57 @@
+import pandas as pd
+import pytest
+
+from benchmark.bench_suite import compare_reports
+from benchmark.synthetic import InMemoryConnection, synthetic_air_quality_rows, synthetic_tables
+from data_model.air_model import AIRModel
+from data_model.geo_model import GEOModel
+
+
+def test_synthetic_air_quality_rows():
+    df = synthetic_air_quality_rows(10, 100, duplicate_rate=0.2, missing_rate=0.3)
+    readings = df.drop_duplicates(['station_id', 'date_observed'])
+
+    assert 0.6 < len(readings) / 1000 < 0.8
+    assert 0.1 < len(df) / len(readings) - 1 < 0.3
+
+
+def test_in_memory_connection_serves_the_models():
+    conn = InMemoryConnection(synthetic_tables(20, 48, geo_features=('roads', 'water')))
+    config = {'air_quality': {'table_name': 'air_quality', 'request_condition': '', 'load_method': 'copy',
+                              'column_set': ['station_id', 'date_observed::TIMESTAMP as date_observed', 'value']},
+              'geo_feature': {'table_name_pr': 'geo_features', 'additional_features': {},
+                              'column_set': ['gid', 'geo_feature', 'feature_type', 'buffer_size', 'value']}}
+    air_quality_model = AIRModel(config, conn)
+    time_series = air_quality_model.build_time_series()
+    assert time_series.shape == (48, 20)
+
+    locations = air_quality_model.get_locations()[:5]
+    geo_feature_model = GEOModel(locations, ['roads', 'water'], config, conn)
+    assert geo_feature_model.geo_feature_matrix.shape[1] == 5
+    assert conn.queries[-1] == ('geo_features_water', config['geo_feature']['column_set'], {'gid': locations})
+
+
+def test_in_memory_connection_applies_the_conditions():
+    conn = InMemoryConnection(synthetic_tables(5, 48))
+    config = {'air_quality': {'table_name': 'air_quality', 'load_method': 'copy',
+                              'request_condition': "where date_observed >= '2017-11-01 12:00' and station_id < 3",
+                              'column_set': ['station_id', 'date_observed::TIMESTAMP as date_observed', 'value']}}
+    air_quality_model = AIRModel(config, None)
+    air_quality_model.fetch(conn, since='2017-11-01 20:00', until='2017-11-02 06:00')
+    df = air_quality_model.air_quality_df
+
+    assert set(df['station_id']) == {0, 1, 2}
+    assert df['date_observed'].min() == pd.Timestamp('2017-11-01 20:00')
+    assert df['date_observed'].max() == pd.Timestamp('2017-11-02 05:00')
+    with pytest.raises(ValueError):
+        conn.read('air_quality', ['station_id'], "where station_id in (1, 2)")
+
+
+def test_compare_reports():
+    baseline = {'results': {'small': {'load': {'seconds': 1.0, 'peak_mb': 10.0},
+                                      'smoothing_mean': {'seconds': 0.001, 'peak_mb': 1.0}}}}
+    report = {'results': {'small': {'load': {'seconds': 1.5, 'peak_mb': 10.0},
+                                    'smoothing_mean': {'seconds': 0.002, 'peak_mb': 1.0}}}}
+
+    assert [(stage, regressed) for _, stage, _, _, regressed in compare_reports(report, baseline)] == \
+        [('load', True), ('smoothing_mean', False)]
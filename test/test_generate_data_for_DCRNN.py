@@ -0,0 +1,138 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from preprocess import generate_data_for_DCRNN
+from preprocess.generate_data_for_DCRNN import generate_x_y_series_data, split_window_indices, WindowDataset, \
+    _split_windows
+
+
+def _fancy_index_windows(data, x_size, y_size):
+    xs, ys = [], []
+    for i in range(0, len(data) - x_size - y_size + 1):
+        xs.append(data[np.arange(x_size) + i])
+        ys.append(data[np.arange(x_size, x_size + y_size) + i])
+    return np.array(xs), np.array(ys)
+
+
+def test_generate_x_y_series_data_matches_fancy_indexing():
+    data = np.random.rand(100, 5, 1)
+    xs, ys = generate_x_y_series_data(data, 24, 6)
+    expected_xs, expected_ys = _fancy_index_windows(data, 24, 6)
+
+    assert xs.shape == (71, 24, 5, 1) and ys.shape == (71, 6, 5, 1)
+    np.testing.assert_array_equal(xs, expected_xs)
+    np.testing.assert_array_equal(ys, expected_ys)
+    # NOTE: the windows are views of the input, not copies
+    assert np.shares_memory(xs, data) and np.shares_memory(ys, data)
+
+
+def test_generate_x_y_series_data_short_input():
+    xs, ys = generate_x_y_series_data(np.random.rand(10, 5, 1), 6, 6)
+
+    assert xs.shape == (0, 6, 5, 1) and ys.shape == (0, 6, 5, 1)
+
+
+def test_split_window_indices_3week1week():
+    indices = split_window_indices(2000, 24, 6, '3week1week')
+
+    # NOTE: two full 4-week chunks, the remaining 656 hours are split in half into train and val
+    assert len(indices['train']) == 2 * (441 - 29) + (328 - 29)
+    assert len(indices['val']) == 2 * (63 - 29) + (328 - 29)
+    assert len(indices['test']) == 2 * (168 - 29)
+    assert indices['test'][0] == 504 and indices['val'][-1] == 2000 - 30
+
+
+def test_window_dataset_batches(tmp_path):
+    data = np.random.rand(300, 5, 1)
+    dataset = WindowDataset.from_split_rule(data, 24, 6, 'normal')
+    file_path = str(tmp_path / 'window_dataset.npz')
+    dataset.save(file_path)
+    dataset = WindowDataset.load(file_path)
+
+    expected_xs, expected_ys = generate_x_y_series_data(data, 24, 6)
+    batches = list(dataset.iter_batches('train', batch_size=64, shuffle=False))
+    assert [len(x) for x, _ in batches] == [64, 64, 62]
+    np.testing.assert_array_equal(np.concatenate([x for x, _ in batches]), expected_xs[:190])
+    np.testing.assert_array_equal(np.concatenate([y for _, y in batches]), expected_ys[:190])
+
+    shuffled_xs = np.concatenate([x for x, _ in dataset.iter_batches('train', batch_size=64, seed=0)])
+    assert not np.array_equal(shuffled_xs, expected_xs[:190])
+    np.testing.assert_array_equal(np.sort(shuffled_xs[:, 0, 0, 0]), np.sort(expected_xs[:190, 0, 0, 0]))
+
+
+def test_generate_data_config_for_training_from_a_tensor(tmp_path, monkeypatch):
+    monkeypatch.setattr(generate_data_for_DCRNN, 'generate_yaml', lambda *args, **kwargs: None)
+    time_index = pd.date_range('2018-01-01', periods=50, freq='1H')
+    tensor = np.random.RandomState(0).rand(50, 4, 3).astype(np.float32)
+    tensor[5, 1, 2] = np.nan
+
+    generate_data_for_DCRNN.generate_data_config_for_training(tensor, x_window=4, y_window=2,
+                                                              save_path=str(tmp_path), time_of_day=True,
+                                                              time_index=time_index)
+    assert np.isnan(tensor[5, 1, 2])
+    with np.load(str(tmp_path / 'train.npz')) as train:
+        x = train['x']
+    assert x.shape == (31, 4, 4, 4) and x.dtype == np.float32
+    np.testing.assert_array_equal(x[1, :, :, :3], np.nan_to_num(tensor[1:5]))
+    np.testing.assert_allclose(x[1, :, 2, 3], (np.arange(1, 5) / 24).astype(np.float32))
+
+    # NOTE: without time_of_day, the tensor itself is not copied into a larger array
+    generate_data_for_DCRNN.generate_data_config_for_training(tensor, x_window=4, y_window=2, save_path=str(tmp_path))
+    assert np.isnan(tensor[5, 1, 2])
+
+    with pytest.raises(ValueError):
+        generate_data_for_DCRNN.generate_data_config_for_training(tensor, save_path=str(tmp_path), time_of_day=True)
+    with pytest.raises(ValueError):
+        generate_data_for_DCRNN.generate_data_config_for_training(tensor[:, :, 0], save_path=str(tmp_path))
+
+
+def test_split_windows_gathers_the_split_indices(tmp_path):
+    data = np.random.RandomState(0).rand(1500, 3, 2).astype(np.float32)
+    for split_rule in ['normal', 'shuffle', '3week1week']:
+        for memmap_dir in [None, str(tmp_path)]:
+            np.random.seed(1)
+            indices = split_window_indices(len(data), 12, 6, split_rule)
+            np.random.seed(1)
+            split_data = _split_windows(data, 12, 6, split_rule, memmap_dir=memmap_dir)
+            for cat in ['train', 'val', 'test']:
+                starts = indices[cat][:, np.newaxis]
+                np.testing.assert_array_equal(split_data['x_' + cat], data[starts + np.arange(12)])
+                np.testing.assert_array_equal(split_data['y_' + cat], data[starts + np.arange(12, 18)])
+                if memmap_dir is not None:
+                    assert isinstance(split_data['x_' + cat], np.memmap)
+
+    # NOTE: the consecutive windows of the 'normal' split are views of the data
+    split_data = _split_windows(data, 12, 6, 'normal')
+    assert np.shares_memory(split_data['x_train'], data) and np.shares_memory(split_data['y_test'], data)
+
+
+def test_generate_data_configs_matches_one_config_at_a_time(tmp_path, monkeypatch):
+    monkeypatch.setattr(generate_data_for_DCRNN, 'generate_yaml', lambda *args, **kwargs: None)
+    df = pd.DataFrame(np.random.RandomState(0).rand(800, 3), columns=[1, 2, 3])
+    df['date_observed'] = pd.date_range('2018-01-01', periods=800, freq='1H')
+    specs = [{'x_window': 12, 'y_window': 6, 'split_rule': split_rule, 'save_path': str(tmp_path / 'all' / name)}
+             for name, split_rule in [('normal', 'normal'), ('shuffle', 'shuffle'), ('week', '3week1week')]]
+    specs.append({'x_window': 6, 'y_window': 12, 'split_rule': '3week1week', 'lazy': True,
+                  'save_path': str(tmp_path / 'all' / 'lazy')})
+
+    np.random.seed(0)
+    generate_data_for_DCRNN.generate_data_configs_for_training(df, specs, max_workers=2, memmap_dir=str(tmp_path))
+    # NOTE: the specs are split in order, so the one-by-one calls draw the same shuffle
+    np.random.seed(0)
+    for spec in specs:
+        generate_data_for_DCRNN.generate_data_config_for_training(
+            df, x_window=spec['x_window'], y_window=spec['y_window'], split_rule=spec['split_rule'],
+            lazy=spec.get('lazy', False), save_path=str(tmp_path / 'one' / os.path.basename(spec['save_path'])))
+
+    for spec in specs:
+        names = ['window_dataset.npz'] if spec.get('lazy') else ['train.npz', 'val.npz', 'test.npz']
+        for name in names:
+            with np.load(os.path.join(spec['save_path'], name)) as all_specs, \
+                    np.load(str(tmp_path / 'one' / os.path.basename(spec['save_path']) / name)) as one_spec:
+                assert sorted(all_specs.files) == sorted(one_spec.files)
+                for key in all_specs.files:
+                    np.testing.assert_array_equal(all_specs[key], one_spec[key])
+    assert not [path for path in os.listdir(str(tmp_path)) if path not in {'all', 'one'}]
@@ -0,0 +1,124 @@
+import threading
+import time
+from contextlib import contextmanager
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from data_model.geo_model import GEOModel
+from services.utils import standard_scaler
+
+
+class _GeoFeatureConnection:
+    """
+    Serves random rows of the geo feature tables, half of the (location, feature) cells are missing
+    """
+
+    def __init__(self, seed=0):
+        self._random = np.random.RandomState(seed)
+
+    def read(self, table_name, column_set, request_condition='', **select_args):
+        rows = []
+        for gid in range(40):
+            for feature_type in ['primary', 'secondary']:
+                for buffer_size in [100, 500]:
+                    if self._random.rand() < 0.5:
+                        rows.append((gid, table_name.split('_')[-1], feature_type, buffer_size,
+                                     self._random.rand() * 10))
+        return rows
+
+
+def _config():
+    return {'geo_feature': {'table_name_pr': 'geo_features.utah',
+                            'column_set': ['gid', 'geo_feature', 'feature_type', 'buffer_size', 'value'],
+                            'additional_features': {}}}
+
+
+def test_geo_feature_matrix_matches_dense_construction():
+    locations = list(range(32))
+    geo_feature_model = GEOModel(locations, ['roads', 'water'], _config(), _GeoFeatureConnection())
+
+    df = geo_feature_model._geo_feature_df
+    df = df[df['gid'].isin(locations)]
+    feature_name = df['geo_feature'] + '_' + df['feature_type'] + '_' + df['buffer_size'].map(str)
+    expected = df.assign(feature_name=feature_name).pivot(index='feature_name', columns='gid', values='value')
+    expected = expected.reindex(columns=locations).fillna(0.0).sort_index()
+
+    assert geo_feature_model.geo_feature_name == list(expected.index)
+    np.testing.assert_allclose(geo_feature_model.geo_feature_vector.values, expected.values)
+    np.testing.assert_allclose(geo_feature_model.scaled_geo_feature_vector.values,
+                               standard_scaler(expected.T).T)
+    assert geo_feature_model.geo_feature_matrix.nnz == len(df)
+
+
+class _GeoFeaturePool:
+    """
+    Pool of _GeoFeatureConnection seeded by the table, raises like psycopg2 when more than maxconn are taken
+    """
+
+    def __init__(self, maxconn):
+        self.maxconn = maxconn
+        self.in_use = self.max_in_use = 0
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def connection(self):
+        with self._lock:
+            if self.in_use == self.maxconn:
+                raise RuntimeError('connection pool exhausted')
+            self.in_use += 1
+            self.max_in_use = max(self.max_in_use, self.in_use)
+        try:
+            yield self
+        finally:
+            with self._lock:
+                self.in_use -= 1
+
+    def read(self, table_name, column_set, request_condition='', **select_args):
+        time.sleep(0.05)
+        return _GeoFeatureConnection(seed=len(table_name)).read(table_name, column_set)
+
+
+@pytest.mark.parametrize('max_workers', [1, 8])
+def test_pooled_fetch_is_bounded_by_the_pool(max_workers):
+    locations = list(range(32))
+    feature_set = ['roads', 'water', 'landuse', 'buildings']
+    config = _config()
+    config['geo_feature']['max_workers'] = max_workers
+    pool = _GeoFeaturePool(maxconn=2)
+    pooled = GEOModel(locations, feature_set, config, None, pool=pool)
+
+    assert pool.max_in_use == min(max_workers, pool.maxconn)
+    serial = GEOModel(locations, feature_set, config, _GeoFeaturePool(maxconn=1))
+    assert pooled.geo_feature_name == serial.geo_feature_name
+    np.testing.assert_allclose(pooled.geo_feature_vector.values, serial.geo_feature_vector.values)
+
+
+class _TableConnection:
+    """
+    Serves fixed rows per table, already in the geo feature column order
+    """
+
+    def __init__(self, tables):
+        self.tables = tables
+
+    def read(self, table_name, column_set, request_condition='', **select_args):
+        return self.tables[table_name]
+
+
+def test_duplicated_and_unnamed_geo_features():
+    config = _config()
+    config['geo_feature']['additional_features'] = {'longitude': {'table_name': 'stations',
+                                                                  'column_set': ['station_id', 'lon']}}
+    # NOTE: station 1 has two distinct coordinates, and a row of roads has no feature type
+    conn = _TableConnection({'geo_features.utah_roads': [(1, 'roads', 'primary', 100, 2.0),
+                                                         (2, 'roads', None, 100, 5.0)],
+                             'stations': [(1, 'location', 'longitude', 0, -111.9),
+                                          (1, 'location', 'longitude', 0, -111.8),
+                                          (2, 'location', 'longitude', 0, -112.0)]})
+
+    with pytest.warns(UserWarning, match='1 duplicated'):
+        geo_feature_model = GEOModel([1, 2], ['roads'], config, conn)
+    assert geo_feature_model.geo_feature_name == ['location_longitude_0', 'roads_primary_100']
+    np.testing.assert_array_equal(geo_feature_model.geo_feature_matrix.toarray(), [[-111.9, -112.0], [2.0, 0.0]])
@@ -0,0 +1,62 @@
+import json
+
+import numpy as np
+
+from benchmark.synthetic import InMemoryConnection, synthetic_tables
+from data_model.air_model import AIRModel
+from services.instrumentation import StageReport, instrumented, stage, stage_report
+
+
+def test_stage_report_nested_peaks(tmp_path):
+    report = StageReport()
+    with report.tracing(trace_memory=True):
+        with report.stage('outer', rows_in=3) as outer:
+            with report.stage('inner'):
+                inner_data = np.ones(2 ** 20)
+                del inner_data
+            with report.stage('second'):
+                pass
+            outer['rows_out'] = 1
+        report_path = report.write(str(tmp_path))
+
+    with open(report_path) as f:
+        stages = {record['stage']: record for record in json.load(f)['stages']}
+    assert [stages['inner']['parent'], stages['outer']['parent']] == ['outer', None]
+    assert (stages['outer']['rows_in'], stages['outer']['rows_out']) == (3, 1)
+    # NOTE: the 8 MB of the inner stage count in the peak of the outer stage, not in the second one
+    assert stages['inner']['tracemalloc_peak_mb'] >= 8 and stages['outer']['tracemalloc_peak_mb'] >= 8
+    assert stages['second']['tracemalloc_peak_mb'] < 1
+    assert stages['outer']['seconds'] >= stages['inner']['seconds']
+
+
+def test_instrumented_air_model():
+    conn = InMemoryConnection(synthetic_tables(10, 48, duplicate_rate=0.5))
+    config = {'air_quality': {'table_name': 'air_quality', 'request_condition': '',
+                              'column_set': ['station_id', 'date_observed', 'value']}}
+    with stage_report().tracing(), stage('pipeline'):
+        air_quality_model = AIRModel(config, conn)
+        air_quality_model.build_time_series()
+
+    stages = {record['stage']: record for record in stage_report().stages}
+    assert stages['air_quality.cleaning']['rows_in'] == len(conn.tables['air_quality'])
+    assert stages['air_quality.average_duplicates']['rows_in'] == stages['air_quality.cleaning']['rows_out']
+    assert stages['air_quality.average_duplicates']['rows_out'] == len(air_quality_model.air_quality_df)
+    assert stages['time_series.pivot']['parent'] == 'air_quality.build_time_series'
+    assert stages['time_series.pivot']['rows_out'] == 48
+    assert stage_report().stages[-1]['stage'] == 'pipeline'
+
+
+def test_instrumented_default_rows():
+    @instrumented('head')
+    def head(values, n):
+        return values[:n]
+
+    with stage_report().tracing():
+        head(np.arange(10), 4)
+    assert (stage_report().stages[0]['rows_in'], stage_report().stages[0]['rows_out']) == (10, 4)
+
+    # NOTE: outside a tracing scope, e.g. the models used as a library, nothing is recorded
+    for _ in range(3):
+        with stage('outside') as record:
+            head(np.arange(10), 4)
+    assert 'seconds' in record and len(stage_report().stages) == 1
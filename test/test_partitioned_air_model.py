@@ -0,0 +1,79 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from benchmark.synthetic import synthetic_air_quality_rows
+from data_model.air_model import AIRModel
+from data_model.partitioned_air_model import PartitionedAIRModel, open_time_series
+from services.timeseries_preprocess import time_series_smoothing
+
+
+class _TimeRangeConnection:
+    """
+    Serves rows of an in-memory table, honouring the [since, until) parameters and the range / station queries
+    """
+
+    def __init__(self, rows):
+        self.rows = rows
+
+    def read(self, table_name, column_set, request_condition='', params=None, distinct=False, **select_args):
+        rows = self.rows
+        if params:
+            rows = rows[rows['date_observed'] >= pd.Timestamp(params[0])]
+            if len(params) > 1:
+                rows = rows[rows['date_observed'] < pd.Timestamp(params[1])]
+        if column_set[0].startswith('min('):
+            positive = rows[rows['value'] > 0]
+            return [(positive['date_observed'].min(), positive['date_observed'].max())]
+        if distinct:
+            return [(station,) for station in rows.loc[rows['value'] > 0, 'station_id'].unique()]
+        return list(rows.itertuples(index=False, name=None))
+
+
+def _rows():
+    rows = synthetic_air_quality_rows(12, 24 * 75, seed=1)
+    rows['date_observed'] = rows['date_observed'] + pd.Timedelta('17min')
+    rows.loc[rows.sample(frac=0.05, random_state=0).index, 'value'] = -1.0
+    return rows
+
+
+def _config():
+    return {'air_quality': {'table_name': 'air_quality_data.utah_purple_air_ground_level_hourly',
+                            'column_set': ['station_id', 'date_observed', 'value'],
+                            'request_condition': ''}}
+
+
+def test_partitioned_air_model_matches_full_range(tmp_path):
+    air_quality_model = AIRModel(_config(), _TimeRangeConnection(_rows()))
+    duplicate_statistics = air_quality_model.get_duplicate_statistics()
+    time_series = air_quality_model.build_time_series()
+
+    partitioned_model = PartitionedAIRModel(_config(), _TimeRangeConnection(_rows()), str(tmp_path),
+                                            partition='week')
+    # NOTE: a partial first week from Wednesday 2017-11-01, then 10 weeks starting on Mondays
+    assert len(partitioned_model.partitions(time_series.index[0], time_series.index[-1])) == 11
+    pd.testing.assert_frame_equal(partitioned_model.time_series, time_series, check_freq=False, check_names=False)
+    pd.testing.assert_frame_equal(open_time_series(str(tmp_path / 'time_series')), time_series, check_freq=False,
+                                  check_names=False)
+    pd.testing.assert_frame_equal(partitioned_model.get_duplicate_statistics(), duplicate_statistics,
+                                  check_names=False, rtol=1e-12)
+
+    partitioned_model.remove_stations([3])
+    pd.testing.assert_frame_equal(partitioned_model.time_series, time_series.drop(columns=[3]), check_freq=False,
+                                  check_names=False)
+    assert 3 in partitioned_model.stored_time_series.columns
+    for method in ['mean', 'median', 'hampel']:
+        smooth = partitioned_model.smooth(window_size=24, method=method, block_size=100)
+        expected = time_series_smoothing(time_series.drop(columns=[3]), window_size=24, method=method)
+        assert list(smooth.columns) == list(expected.columns)
+        # NOTE: the rolling mean accumulates its sum from the start of the block, hence the rounding differences
+        np.testing.assert_allclose(smooth.values, expected.values, rtol=1e-12)
+        if method != 'mean':
+            np.testing.assert_array_equal(smooth.values, expected.values)
+
+
+def test_partitioned_air_model_without_readings(tmp_path):
+    rows = _rows()
+    rows['value'] = -1.0
+    with pytest.raises(ValueError):
+        PartitionedAIRModel(_config(), _TimeRangeConnection(rows), str(tmp_path))
@@ -0,0 +1,103 @@
+import pytest
+
+from benchmark.synthetic import InMemoryConnection, synthetic_tables
+from preprocess.pipelines import build_utah_pipeline
+from services.pipeline import Pipeline
+
+
+def _counting_pipeline(cache_dir, calls):
+    def stage(name):
+        def func(config, *inputs):
+            calls.append(name)
+            return [name, config, list(inputs)]
+        return func
+
+    pipeline = Pipeline(cache_dir and str(cache_dir))
+    pipeline.add('fetch', stage('fetch'), config_keys=['source'])
+    pipeline.add('clean', stage('clean'), ['fetch'], config_keys=['cleaning'])
+    pipeline.add('smooth', stage('smooth'), ['clean'], config_keys=['smoothing'])
+    pipeline.add('geo', stage('geo'), ['clean'], config_keys=['geo'])
+    return pipeline
+
+
+def test_only_downstream_stages_run_again(tmp_path):
+    calls = []
+    pipeline = _counting_pipeline(tmp_path, calls)
+    config = {'source': 'a', 'cleaning': 1, 'smoothing': {'window_size': 24}, 'geo': 'x', 'time': 1}
+
+    results = pipeline.run(config)
+    assert sorted(results) == ['geo', 'smooth'] and sorted(calls) == ['clean', 'fetch', 'geo', 'smooth']
+
+    # NOTE: sections no stage reads (e.g. the run time) do not change the keys, cached stages skip their inputs
+    calls.clear()
+    assert pipeline.run(dict(config, time=2)) == results and calls == []
+
+    calls.clear()
+    results = pipeline.run(dict(config, smoothing={'window_size': 12}))
+    assert calls == ['smooth'] and results['smooth'][1] == {'smoothing': {'window_size': 12}}
+
+    calls.clear()
+    pipeline.run(dict(config, cleaning=2))
+    assert sorted(calls) == ['clean', 'geo', 'smooth']
+
+
+def test_changing_a_stage_body_invalidates_its_results(tmp_path):
+    def fetch(config):
+        return 1
+
+    assert Pipeline(str(tmp_path)).add('fetch', fetch).run({}) == {'fetch': 1}
+    assert Pipeline(str(tmp_path)).add('fetch', fetch).run({}) == {'fetch': 1}
+
+    # NOTE: same module and qualified name, another body
+    def fetch(config):
+        return 2
+
+    assert Pipeline(str(tmp_path)).add('fetch', fetch).run({}) == {'fetch': 2}
+    assert len(list(tmp_path.iterdir())) == 2
+
+
+def test_pipeline_without_cache_and_invalid_stages(tmp_path):
+    calls = []
+    pipeline = _counting_pipeline(None, calls)
+    pipeline.run({})
+    pipeline.run({}, ['clean'])
+    assert calls.count('fetch') == 2 and not list(tmp_path.iterdir())
+
+    with pytest.raises(ValueError):
+        pipeline.add('fetch', len)
+    with pytest.raises(ValueError):
+        pipeline.add('train', len, ['model'])
+
+
+def test_utah_pipeline_reuses_the_fetched_data(tmp_path):
+    conn = InMemoryConnection(synthetic_tables(12, 96, geo_features=('roads',)))
+    connections = []
+
+    def connection():
+        connections.append(conn)
+        return conn
+
+    config = {'air_quality': {'table_name': 'air_quality', 'request_condition': '', 'load_method': 'copy',
+                              'column_set': ['station_id', 'date_observed::TIMESTAMP as date_observed', 'value']},
+              'geo_feature': {'table_name_pr': 'geo_features', 'additional_features': {},
+                              'column_set': ['gid', 'geo_feature', 'feature_type', 'buffer_size', 'value']},
+              'pipeline_cache': {'cache_dir': str(tmp_path)}}
+    targets = ['average_duplicates', 'smoothing', 'geo_feature']
+
+    pipeline = build_utah_pipeline(['roads'], config, [0, 1], connection, smooth=True)
+    results = pipeline.run(config, targets)
+    assert {0, 1} <= results['average_duplicates'].removed_stations
+    assert results['geo_feature'].locations == results['average_duplicates'].get_locations()
+    num_queries = len(conn.queries)
+
+    smoothing_config = dict(config, smoothing={'window_size': 6, 'method': 'median'})
+    pipeline = build_utah_pipeline(['roads'], smoothing_config, [0, 1], connection, smooth=True)
+    smoothed = pipeline.run(smoothing_config, targets)
+    assert len(conn.queries) == num_queries
+    assert not smoothed['smoothing'].equals(results['smoothing'])
+    assert list(smoothed['smoothing'].columns) == list(results['smoothing'].columns)
+
+    # NOTE: the data fetched from another database is not reused
+    pipeline = build_utah_pipeline(['roads'], config, [0, 1], connection, smooth=True, source={'database': 'other'})
+    pipeline.run(config, targets)
+    assert len(conn.queries) > num_queries
@@ -0,0 +1,108 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from services.postgres_connection import Connection, build_select
+from services.query_cache import QueryCache
+
+
+def test_build_select_with_request_condition():
+    sql, params = build_select('air_quality_data.utah_epa_air_quality', ['station_id', 'date_observed', 'value'],
+                               "where date_observed >= '2017-11-01'")
+
+    assert sql == "select station_id,date_observed,value from air_quality_data.utah_epa_air_quality " \
+                  "where (date_observed >= '2017-11-01')"
+    assert params is None
+
+
+def test_build_select_with_filters():
+    sql, params = build_select('air_quality_data.utah_purple_air_ground_level_hourly', ['station_id as gid', 'lon'],
+                               'where date_observed >= %s', params=['2017-11-01'],
+                               filters={'station_id': np.array([1, 2]), 'source': 'purple_air'}, distinct=True)
+
+    assert sql == 'select distinct station_id as gid,lon from air_quality_data.utah_purple_air_ground_level_hourly ' \
+                  'where (date_observed >= %s) and station_id = ANY(%s) and source = %s'
+    assert params == ['2017-11-01', [1, 2], 'purple_air']
+    assert all(type(station) is int for station in params[1])
+
+
+def test_build_select_rejects_invalid_identifier():
+    with pytest.raises(ValueError):
+        build_select('geo_features.roads; drop table x', ['gid'])
+
+
+def test_build_select_with_group_by():
+    sql, params = build_select('air_quality_data.utah_purple_air_ground_level_hourly',
+                               ['station_id', "date_trunc('hour', date_observed)", 'avg(value)'],
+                               "where date_observed >= '2017-11-01'", conditions=['value > 0'], group_by=[1, 2])
+
+    assert sql == "select station_id,date_trunc('hour', date_observed),avg(value) " \
+                  "from air_quality_data.utah_purple_air_ground_level_hourly " \
+                  "where (date_observed >= '2017-11-01') and value > 0 group by 1,2"
+    assert params is None
+
+
+class _Cursor:
+
+    def __init__(self, conn):
+        self._conn = conn
+        self._rows = []
+        self.description = [('station_id',), ('value',)]
+
+    def execute(self, sql, params=None):
+        self._conn.queries.append(sql)
+        self._rows = list(self._conn.rows)
+
+    def fetchmany(self, size):
+        rows, self._rows = self._rows[:size], self._rows[size:]
+        return rows
+
+    def mogrify(self, sql, params=None):
+        return sql.encode()
+
+    def copy_expert(self, sql, buffer):
+        self._conn.queries.append(sql)
+        buffer.write('station_id,value\n' + ''.join('{},{}\n'.format(*row) for row in self._conn.rows))
+
+    def close(self):
+        pass
+
+
+class _PsycopgConnection:
+    """
+    Serves the same rows to every query and records the queries
+    """
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.queries = []
+
+    def cursor(self, name=None):
+        return _Cursor(self)
+
+    def commit(self):
+        pass
+
+
+def test_read_chunks_and_copy_go_through_the_cache(tmp_path):
+    rows = [(station, station * 1.5) for station in range(5)]
+    conn = _PsycopgConnection(rows)
+    connection = Connection(conn=conn, cache=QueryCache(str(tmp_path)))
+    expected = pd.DataFrame(rows, columns=['gid', 'value'])
+
+    for _ in range(2):
+        chunks = list(connection.read_chunks('air_quality', ['station_id', 'value'], chunk_size=2,
+                                             columns=['gid', 'value']))
+        assert [len(chunk) for chunk in chunks] == [2, 2, 1]
+        pd.testing.assert_frame_equal(pd.concat(chunks, ignore_index=True), expected)
+
+        df = connection.copy_as_dataframe('air_quality', ['station_id', 'value'], columns=['gid', 'value'],
+                                          dtype={'value': 'float32'})
+        pd.testing.assert_frame_equal(df, expected.astype({'value': 'float32'}))
+    assert len(conn.queries) == 2 and conn.queries[1].startswith('copy (')
+
+    # NOTE: the chunked read shares the entry of read_as_dataframe, the copy is parsed with its own arguments
+    pd.testing.assert_frame_equal(connection.read_as_dataframe('air_quality', ['station_id', 'value']),
+                                  expected.set_axis(['station_id', 'value'], axis=1))
+    connection.copy_as_dataframe('air_quality', ['station_id', 'value'])
+    assert len(conn.queries) == 3
@@ -4,6 +4,7 @@ import os
 
 from preprocess.utah_epa import utah_epa_preprocess
 from preprocess.utah_purple_air import utah_purple_air_preprocess
+from services.storage import save_rows, save_time_series, save_geo_feature_matrix
 
 
 def load_config(file_path):
@@ -36,10 +37,13 @@ def get_output_file_path(config):
     return output_path
 
 
-def output_csv_file(file_nmae, air_quality_model):
-    output_data = air_quality_model.time_series
-    output_data['date_observed'] = output_data.index
-    output_data.to_csv(file_nmae, header=True, index=False, sep=',', mode='w')
+def output_files(file_name, air_quality_model, geo_feature_model):
+    # NOTE: Arrow IPC files, readable column by column and memory mapped, see services.storage
+    save_rows(air_quality_model.air_quality_df, file_name + '_rows.parquet')
+    if air_quality_model.time_series is not None:
+        save_time_series(air_quality_model.time_series, file_name + '_time_series.arrow')
+    save_geo_feature_matrix(geo_feature_model.geo_feature_matrix, geo_feature_model.geo_feature_name,
+                            geo_feature_model.locations, file_name + '_geo_features.arrow')
 
 
 def test_los_angeles_epa():
@@ -52,17 +56,19 @@ def test_los_angeles_purple_air():
 
 def test_utah_epa(write_file=True):
     config = load_config('../data/config/utah_model_config.json')
-    air_quality_model, geo_feature_model = utah_epa_preprocess(config['feature_set'], config['testing'])
+    air_quality_model, geo_feature_model = utah_epa_preprocess(config['feature_set'], config['testing'],
+                                                                output_path=config['output_path'])
     assert air_quality_model is not None and geo_feature_model is not None
 
     if write_file:
-        output_csv_file('../data/config/utah_epa_air_pm25', air_quality_model)
+        output_files('../data/config/utah_epa_air_pm25', air_quality_model, geo_feature_model)
 
 
 def test_utah_purple_air(write_file=True):
     config = load_config('../data/config/utah_model_config.json')
-    air_quality_model, geo_feature_model = utah_purple_air_preprocess(config['feature_set'], config['training'])
+    air_quality_model, geo_feature_model = utah_purple_air_preprocess(config['feature_set'], config['training'],
+                                                                       output_path=config['output_path'])
     assert air_quality_model is not None and geo_feature_model is not None
 
     if write_file:
-        output_csv_file('../data/config/utah_epa_air_pm25', air_quality_model)
+        output_files('../data/config/utah_epa_air_pm25', air_quality_model, geo_feature_model)
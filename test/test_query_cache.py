@@ -0,0 +1,39 @@
+import os
+import time
+
+import pandas as pd
+
+from services.query_cache import QueryCache
+
+
+def _frame(n):
+    return pd.DataFrame({'station_id': range(n), 'value': [1.0] * n})
+
+
+def test_query_cache_ttl(tmp_path):
+    cache = QueryCache(str(tmp_path), ttl=60)
+    key = cache.key('air_quality_data.utah_epa_air_quality', 'select station_id,value from t where id = ANY(%s)',
+                    [[1, 2]])
+    cache.put(key, _frame(3))
+    pd.testing.assert_frame_equal(cache.get(key), _frame(3))
+
+    expired = time.time() - 120
+    os.utime(os.path.join(str(tmp_path), key + '.parquet'), (expired, expired))
+    assert cache.get(key) is None
+
+
+def test_query_cache_lru_eviction(tmp_path):
+    cache = QueryCache(str(tmp_path))
+    cache.put('t-a', _frame(10))
+    entry_size = os.path.getsize(os.path.join(str(tmp_path), 't-a.parquet'))
+
+    cache = QueryCache(str(tmp_path), max_size=int(entry_size * 2.5))
+    cache.put('t-b', _frame(10))
+    old = time.time() - 100
+    os.utime(os.path.join(str(tmp_path), 't-b.parquet'), (old - 10, old))
+    os.utime(os.path.join(str(tmp_path), 't-a.parquet'), (old - 20, old))
+    # NOTE: a hit makes t-a the most recently used entry, so t-b is evicted first
+    assert cache.get('t-a') is not None
+    cache.put('t-c', _frame(10))
+
+    assert sorted(os.listdir(str(tmp_path))) == ['t-a.parquet', 't-c.parquet']
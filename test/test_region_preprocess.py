@@ -0,0 +1,68 @@
+from contextlib import contextmanager
+
+import pytest
+
+from benchmark.synthetic import InMemoryConnection, synthetic_tables
+from preprocess import los_angeles_epa, los_angeles_purple_air, pipelines, utah_epa, utah_purple_air
+
+
+class _Pool:
+    """
+    ConnectionPool over an InMemoryConnection, records its size and the reads made through it
+    """
+
+    def __init__(self, conn, minconn=1, maxconn=8, **connect_args):
+        self.conn = conn
+        self.maxconn = maxconn
+        self.reads = 0
+        self.closed = False
+
+    @contextmanager
+    def connection(self):
+        self.reads += 1
+        yield self.conn
+
+    def close_all(self):
+        self.closed = True
+
+
+def _config(tmp_path=None):
+    config = {'max_connections': 3, 'parameter_name': 'pm25',
+              'air_quality': {'table_name': 'air_quality', 'request_condition': '',
+                              'column_set': ['station_id', 'date_observed', 'value']},
+              'geo_feature': {'table_name_pr': 'geo_features', 'additional_features': {},
+                              'column_set': ['gid', 'geo_feature', 'feature_type', 'buffer_size', 'value']}}
+    if tmp_path is not None:
+        config['pipeline_cache'] = {'cache_dir': str(tmp_path)}
+    return config
+
+
+# NOTE: with 'pipeline_cache', the connections are opened by preprocess.pipelines.run_utah_pipeline
+@pytest.mark.parametrize('module, preprocess, pipeline', [
+    (utah_epa, utah_epa.utah_epa_preprocess, False),
+    (utah_purple_air, utah_purple_air.utah_purple_air_preprocess, False),
+    (pipelines, utah_epa.utah_epa_preprocess, True),
+    (los_angeles_epa, los_angeles_epa.los_angeles_epa_preprocess, False),
+    (los_angeles_purple_air, los_angeles_purple_air.los_angeles_ppa_preprocess, False)])
+def test_geo_features_are_fetched_on_a_pool(tmp_path, monkeypatch, module, preprocess, pipeline):
+    conn = InMemoryConnection(synthetic_tables(12, 48, geo_features=('roads', 'water')))
+    pools = []
+
+    def connection_pool(**kwargs):
+        pools.append(_Pool(conn, **kwargs))
+        return pools[-1]
+
+    monkeypatch.setattr(module, 'Connection', lambda **kwargs: conn)
+    monkeypatch.setattr(module, 'ConnectionPool', connection_pool)
+    air_quality_model, geo_feature_model = preprocess(['roads', 'water'], _config(tmp_path if pipeline else None))
+
+    assert len(pools) == 1 and pools[0].maxconn == 3 and pools[0].closed
+    assert pools[0].reads == 2
+    assert geo_feature_model.locations == air_quality_model.get_locations()
+    if module in (los_angeles_epa, los_angeles_purple_air):
+        assert air_quality_model.time_series.shape == (48, len(geo_feature_model.locations))
+
+
+def test_los_angeles_unknown_parameter():
+    with pytest.raises(ValueError):
+        los_angeles_epa.los_angeles_epa_preprocess(['roads'], dict(_config(), parameter_name='co'))
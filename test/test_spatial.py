@@ -0,0 +1,105 @@
+import pickle
+
+import numpy as np
+import pandas as pd
+import pytest
+import yaml
+from scipy import sparse
+
+from preprocess import generate_data_for_DCRNN
+from services.spatial import (coordinates_from_geo_features, gaussian_adjacency, load_adjacency,
+                              neighbor_distances, save_adjacency)
+
+
+def _coordinates(num_stations=60, seed=0):
+    rng = np.random.RandomState(seed)
+    return np.column_stack([rng.uniform(-112.2, -111.6, num_stations), rng.uniform(40.4, 41.0, num_stations)])
+
+
+def _haversine_km(coordinates):
+    lon, lat = np.radians(coordinates[:, 0]), np.radians(coordinates[:, 1])
+    a = np.sin((lat[:, None] - lat[None, :]) / 2) ** 2 + \
+        np.cos(lat[:, None]) * np.cos(lat[None, :]) * np.sin((lon[:, None] - lon[None, :]) / 2) ** 2
+    return 2 * 6371.0088 * np.arcsin(np.sqrt(a))
+
+
+def _brute_force_adjacency(distances, neighbors, threshold):
+    sigma = distances[neighbors & ~np.eye(len(distances), dtype=bool)].std()
+    adjacency = np.exp(-np.square(distances / sigma))
+    adjacency[~neighbors | (adjacency < threshold)] = 0
+    return adjacency
+
+
+def test_knn_adjacency_matches_brute_force():
+    coordinates = _coordinates()
+    distances = _haversine_km(coordinates)
+    k = 5
+    neighbors = np.zeros(distances.shape, dtype=bool)
+    np.put_along_axis(neighbors, np.argsort(distances, axis=1)[:, :k + 1], True, axis=1)
+
+    adjacency = gaussian_adjacency(coordinates, k=k, threshold=0.1)
+    assert sparse.isspmatrix_csr(adjacency)
+    np.testing.assert_allclose(adjacency.toarray(), _brute_force_adjacency(distances, neighbors, 0.1), atol=1e-9)
+
+
+def test_radius_adjacency_matches_brute_force():
+    coordinates = _coordinates()
+    distances = _haversine_km(coordinates)
+    neighbors = distances <= 10.0
+
+    adjacency = gaussian_adjacency(coordinates, radius=10.0, threshold=0.05)
+    np.testing.assert_allclose(adjacency.toarray(), _brute_force_adjacency(distances, neighbors, 0.05), atol=1e-9)
+    # NOTE: radius graphs are symmetric by construction
+    assert abs(adjacency - adjacency.T).max() < 1e-12
+
+
+def test_euclidean_and_symmetric():
+    coordinates = np.array([[0.0, 0.0], [1.0, 0.0], [3.0, 0.0]])
+    rows, cols, distances = neighbor_distances(coordinates, k=1, metric='euclidean')
+    assert sorted(zip(rows, cols, distances)) == [(0, 0, 0.0), (0, 1, 1.0), (1, 0, 1.0), (1, 1, 0.0),
+                                                  (2, 1, 2.0), (2, 2, 0.0)]
+
+    adjacency = gaussian_adjacency(coordinates, k=1, sigma=2.0, threshold=0.0, metric='euclidean', symmetric=True)
+    assert adjacency[1, 2] == adjacency[2, 1] == pytest.approx(np.exp(-1.0))
+    with pytest.raises(ValueError):
+        gaussian_adjacency(coordinates)
+
+
+def test_coordinates_from_geo_features():
+    class _GeoModel:
+        geo_feature_name = ['elevation', 'location_latitude_0', 'location_longitude_0']
+        geo_feature_matrix = sparse.csr_matrix(np.array([[1.0, 2.0], [40.5, 40.7], [-111.9, -111.8]]))
+
+    np.testing.assert_array_equal(coordinates_from_geo_features(_GeoModel()), [[-111.9, 40.5], [-111.8, 40.7]])
+
+
+def test_adjacency_saved_next_to_training_data(tmp_path):
+    yaml_path = tmp_path / 'dcrnn.yaml'
+    yaml_path.write_text(yaml.dump({'base_dir': '', 'data': {'dataset_dir': '', 'graph_pkl_filename': ''},
+                                    'model': {'seq_len': 12, 'horizon': 12}}))
+    save_path = tmp_path / 'utah'
+    coordinates = _coordinates(num_stations=4)
+    adjacency = gaussian_adjacency(coordinates, k=2)
+    index = pd.date_range('2020-01-01', periods=80, freq='1H')
+    df = pd.DataFrame(np.random.RandomState(0).rand(80, 4), columns=[11, 12, 13, 14])
+    df['date_observed'] = index
+
+    generate_data_for_DCRNN.generate_data_config_for_training(df, x_window=3, y_window=3, yaml_path=str(yaml_path),
+                                                              save_path=str(save_path), adjacency=adjacency)
+    assert (save_path / 'train.npz').exists()
+    loaded, sensor_ids = load_adjacency(str(save_path / 'adj_mx.npz'))
+    assert sensor_ids == [11, 12, 13, 14]
+    np.testing.assert_array_equal(loaded.toarray(), adjacency.toarray())
+
+    # NOTE: the graph as DCRNN loads it (utils.load_graph_data)
+    with open(str(save_path / 'adj_mx.pkl'), 'rb') as f:
+        sensor_ids, sensor_id_to_ind, adj_mx = pickle.load(f)
+    assert sensor_ids == [11, 12, 13, 14] and sensor_id_to_ind == {11: 0, 12: 1, 13: 2, 14: 3}
+    assert isinstance(adj_mx, np.ndarray)
+    np.testing.assert_array_equal(adj_mx, adjacency.toarray())
+    with open(str(save_path / 'config.yaml')) as f:
+        config = yaml.safe_load(f)
+    assert config['data'] == {'dataset_dir': 'data/utah', 'graph_pkl_filename': 'data/utah/adj_mx.pkl'}
+
+    with pytest.raises(ValueError):
+        save_adjacency(adjacency, [11, 12], str(tmp_path))
@@ -0,0 +1,62 @@
+import numpy as np
+import pandas as pd
+import pytest
+from scipy import sparse
+
+from services.storage import save_rows, load_rows, save_time_series, load_time_series, save_geo_feature_matrix, \
+    load_geo_feature_matrix
+
+
+def _time_series():
+    values = np.random.RandomState(0).rand(48, 3)
+    values[5, 1] = np.nan
+    return pd.DataFrame(values, index=pd.date_range('2018-01-01', periods=48, freq='1H'), columns=[20, 3, 7])
+
+
+def test_time_series_round_trip(tmp_path):
+    path = str(tmp_path / 'time_series.arrow')
+    save_time_series(_time_series(), path)
+
+    time_series = load_time_series(path)
+    pd.testing.assert_frame_equal(time_series, _time_series())
+    # NOTE: memory mapped columns are read-only views of the file
+    assert not time_series[3].values.flags.writeable
+
+    pd.testing.assert_frame_equal(load_time_series(path, stations=[7, 20], memory_map=False),
+                                  _time_series()[[7, 20]])
+
+
+def test_time_series_keeps_the_timezone(tmp_path):
+    path = str(tmp_path / 'time_series.arrow')
+    expected = _time_series().tz_localize('America/Denver')
+    save_time_series(expected, path)
+
+    pd.testing.assert_frame_equal(load_time_series(path), expected)
+    pd.testing.assert_frame_equal(load_time_series(path, stations=[3], memory_map=False), expected[[3]])
+    with pytest.raises(ValueError):
+        load_time_series(path, stations=[4])
+
+
+def test_rows_select_stations_and_time(tmp_path):
+    path = str(tmp_path / 'rows.parquet')
+    times = pd.date_range('2018-01-01', periods=10, freq='1H')
+    rows = pd.DataFrame({'station_id': np.repeat([1, 2, 3], 10), 'date_observed': np.tile(times, 3),
+                         'value': np.arange(30.0)})
+    save_rows(rows, path)
+
+    selected = load_rows(path, columns=['station_id', 'value'], stations=[np.int64(2)], since=times[5])
+    assert list(selected.columns) == ['station_id', 'value']
+    assert sorted(selected['value']) == list(np.arange(15.0, 20.0))
+
+
+def test_geo_feature_matrix_round_trip(tmp_path):
+    path = str(tmp_path / 'geo_features.arrow')
+    matrix = sparse.random(5, 8, density=0.3, format='csr', random_state=0)
+    save_geo_feature_matrix(matrix, list('abcde'), list(range(8)), path)
+
+    loaded, feature_name, locations = load_geo_feature_matrix(path)
+    assert (feature_name, locations) == (list('abcde'), list(range(8)))
+    np.testing.assert_array_equal(loaded.toarray(), matrix.toarray())
+
+    loaded, feature_name, _ = load_geo_feature_matrix(path, features=['d', 'a'])
+    np.testing.assert_array_equal(loaded.toarray(), matrix.toarray()[[3, 0]])
@@ -0,0 +1,125 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from services.timeseries_preprocess import time_series_pivot, time_series_construction, time_series_construction1, \
+    time_series_smoothing, time_series_tensor, time_of_day
+
+
+def _air_quality_rows():
+    times = pd.to_datetime(['2018-01-01 00:00', '2018-01-01 01:00', '2018-01-01 03:00',
+                            '2018-01-01 01:00', '2018-01-01 02:30'])
+    return pd.DataFrame({'station_id': [20, 20, 20, 3, 3],
+                         'date_observed': times,
+                         'value': [1.0, 2.0, 3.0, 4.0, 5.0]})
+
+
+def test_time_series_pivot():
+    time_series = time_series_pivot(_air_quality_rows())
+
+    assert list(time_series.columns) == [3, 20]
+    assert list(time_series.index) == list(pd.date_range('2018-01-01 00:00', '2018-01-01 03:00', freq='1H'))
+    expected = np.array([[np.nan, 1.0],
+                         [4.0, 2.0],
+                         [5.0, np.nan],
+                         [np.nan, 3.0]])
+    np.testing.assert_array_equal(time_series.values, expected)
+
+
+def test_time_series_construction_distinct_timestamps():
+    time_series = time_series_construction(_air_quality_rows())
+
+    assert time_series.index.name == 'date_observed'
+    # NOTE: the distinct timestamps, 02:30 is kept as it is
+    assert list(time_series.index) == list(pd.to_datetime(['2018-01-01 00:00', '2018-01-01 01:00',
+                                                           '2018-01-01 02:30', '2018-01-01 03:00']))
+    assert time_series.loc['2018-01-01 03:00', 20] == 3.0 and time_series.loc['2018-01-01 02:30', 3] == 5.0
+
+
+def test_time_series_construction1_matches_pivot():
+    df = _air_quality_rows()
+    pd.testing.assert_frame_equal(time_series_construction1(df), time_series_pivot(df))
+
+
+def _time_series(num_hours=200, num_stations=4):
+    values = np.random.RandomState(0).rand(num_hours, num_stations)
+    values[20:50, 1] = np.nan
+    return pd.DataFrame(values, index=pd.date_range('2018-01-01', periods=num_hours, freq='1H'))
+
+
+def test_time_series_smoothing_matches_per_column():
+    time_series = _time_series()
+    for method in ['mean', 'median']:
+        smooth = time_series_smoothing(time_series, window_size=24, method=method)
+        for key in time_series.columns:
+            rolling = time_series[key].rolling(window=24, min_periods=1, center=True)
+            expected = rolling.mean() if method == 'mean' else rolling.median()
+            pd.testing.assert_series_equal(smooth[key], expected)
+
+
+def test_time_series_smoothing_keeps_index():
+    time_series = _time_series().drop(index=pd.date_range('2018-01-02', periods=5, freq='1H'))
+    smooth = time_series_smoothing(time_series, method='ewma')
+
+    assert smooth.index.equals(time_series.index)
+
+
+def test_time_series_smoothing_hampel():
+    time_series = _time_series()
+    time_series.iloc[100, 0] = 100.0
+    smooth = time_series_smoothing(time_series, window_size=24, method='hampel')
+
+    assert smooth.iloc[100, 0] < 1.0
+    assert smooth.iloc[20:50, 1].isna().all()
+    assert (smooth.values == time_series.values).sum() >= time_series.notna().values.sum() - 5
+
+
+def test_time_series_smoothing_unknown_method():
+    with pytest.raises(ValueError, match='Unknown smoothing method'):
+        time_series_smoothing(_time_series(), method='kalman')
+    with pytest.raises(ValueError):
+        time_series_pivot(_air_quality_rows(), freq=None)
+
+
+def test_time_series_tensor_matches_pivot_of_each_parameter():
+    rows = _air_quality_rows()
+    rows = pd.concat([rows.assign(parameter='pm25'), rows.iloc[::2].assign(parameter='o3', value=rows['value'] + 1)],
+                     ignore_index=True)
+    tensor, time_index, stations, parameters = time_series_tensor(rows)
+
+    assert parameters == ['o3', 'pm25'] and tensor.dtype == np.float32
+    for k, parameter in enumerate(parameters):
+        expected = time_series_pivot(rows[rows['parameter'] == parameter]).reindex(index=time_index, columns=stations)
+        np.testing.assert_array_equal(tensor[:, :, k], expected.values.astype(np.float32))
+
+    tensor, _, _, parameters = time_series_tensor(rows, parameters=['pm25'])
+    assert parameters == ['pm25'] and tensor.shape[2] == 1
+    tensor, _, _, parameters = time_series_tensor(rows[rows['parameter'] == 'pm25'], parameter_col=None)
+    assert parameters == ['value']
+    np.testing.assert_array_equal(tensor[:, :, 0], time_series_pivot(rows[rows['parameter'] == 'pm25']).values)
+
+
+def test_time_of_day():
+    index = pd.date_range('2018-01-01 18:00', periods=4, freq='3H')
+    np.testing.assert_allclose(time_of_day(index), [0.75, 0.875, 0.0, 0.125])
+    # NOTE: the local wall time of a tz-aware index (and series), not its UTC time (7 hours later in Utah)
+    local = index.tz_localize('America/Denver')
+    np.testing.assert_allclose(time_of_day(local), [0.75, 0.875, 0.0, 0.125])
+    np.testing.assert_allclose(time_of_day(pd.Series(local)), [0.75, 0.875, 0.0, 0.125])
+
+
+def test_rows_without_station_or_time_are_dropped():
+    rows = _air_quality_rows()
+    missing = pd.DataFrame({'station_id': [np.nan, 20], 'date_observed': pd.to_datetime(['2018-01-01 01:00', None]),
+                            'value': [99.0, 98.0]})
+    with_missing = pd.concat([rows, missing], ignore_index=True)
+
+    # NOTE: the missing station id makes the station column float
+    pd.testing.assert_frame_equal(time_series_pivot(with_missing), time_series_pivot(rows), check_column_type=False)
+    pd.testing.assert_frame_equal(time_series_construction(with_missing), time_series_construction(rows),
+                                  check_column_type=False)
+
+    with_missing['parameter'] = ['pm25'] * (len(rows) + 1) + [None]
+    tensor, _, stations, parameters = time_series_tensor(with_missing)
+    assert parameters == ['pm25'] and list(stations) == [3, 20]
+    np.testing.assert_array_equal(tensor[:, :, 0], time_series_pivot(rows).values)
@@ -0,0 +1,37 @@
+import numpy as np
+import pandas as pd
+
+from services.utils import duplicate_statistics, check_max_min_correlation
+
+
+def _duplicated_rows():
+    rng = np.random.RandomState(0)
+    num_rows = 5000
+    return pd.DataFrame({'station_id': rng.randint(0, 20, num_rows),
+                         'date_observed': pd.Timestamp('2018-01-01') + pd.to_timedelta(rng.randint(0, 300, num_rows),
+                                                                                       unit='h'),
+                         'value': rng.rand(num_rows) * 50})
+
+
+def test_duplicate_statistics_matches_pandas_corr():
+    df = _duplicated_rows()
+    statistics = duplicate_statistics(df, key_col='station_id', time_col='date_observed')
+
+    grouped = df.groupby(['station_id', 'date_observed'])['value']
+    joint_min_max = pd.DataFrame({'min': grouped.min(), 'max': grouped.max(), 'count': grouped.count()})
+    for station in range(20):
+        expected = joint_min_max.loc[station]
+        assert np.isclose(statistics.loc[station, 'corr'], expected['min'].corr(expected['max']))
+        assert statistics.loc[station, 'num_timestamps'] == len(expected)
+        assert statistics.loc[station, 'num_duplicated'] == (expected['count'] > 1).sum()
+        assert statistics.loc[station, 'num_readings'] == expected['count'].sum()
+
+
+def test_check_max_min_correlation_constant_station():
+    df = pd.DataFrame({'station_id': [1, 1, 1, 1],
+                       'date_observed': pd.to_datetime(['2018-01-01 00:00', '2018-01-01 00:00',
+                                                        '2018-01-01 01:00', '2018-01-01 01:00']),
+                       'value': [2.0, 2.0, 2.0, 2.0]})
+    corr = check_max_min_correlation(df, [1], key_col='station_id', time_col='date_observed')
+
+    assert np.isnan(corr[1])